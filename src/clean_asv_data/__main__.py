@@ -1,8 +1,25 @@
+import numpy as np
 import pandas as pd
 import yaml
 import os
 import importlib.resources
+import collections
+import contextlib
+import glob
+import io
+import itertools
+import json
+import queue
+import random
 import sys
+import threading
+import time
+
+PARTITION_FORMAT = "clean_asv_data.partition"
+PARTITION_MANIFEST_FORMAT = "clean_asv_data.partition_manifest"
+PARTITION_ASVS_FORMAT = "clean_asv_data.partition_asvs"
+PARTITION_ASVS_FILE = "asvs.zip"
+PARTITION_VERSION = 2
 
 
 class objectview(object):
@@ -178,6 +195,19 @@ def read_config(configfile, args):
     return args
 
 
+def file_fingerprint(f):
+    """
+    Returns a fingerprint (path, size and modification time) of a file, used to
+    check that indexes and other derived files are up to date with their input
+    """
+    st = os.stat(f)
+    return {
+        "path": os.path.abspath(f),
+        "size": st.st_size,
+        "mtime": int(st.st_mtime),
+    }
+
+
 def read_blanks(f=None):
     if f is None:
         return []
@@ -188,37 +218,861 @@ def read_blanks(f=None):
     return blanks
 
 
+class SharedInputs:
+    """
+    Keeps parsed input files in memory, keyed by path, arguments and
+    fingerprint, so that steps run in the same process (e.g. by run-workflow)
+    parse each input only once. Each caller gets its own copy.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+        self._data = {}
+
+    def get(self, f, read, **kwargs):
+        key = (
+            json.dumps(file_fingerprint(f), sort_keys=True),
+            json.dumps(kwargs, sort_keys=True),
+        )
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        # Only one thread parses a file, others wait for it to finish
+        with lock:
+            if key not in self._data:
+                self._data[key] = read(f, **kwargs)
+            return self._data[key].copy()
+
+
+_shared_inputs = None
+
+
+@contextlib.contextmanager
+def shared_inputs():
+    """
+    Within this context read_metadata and read_clustfile reuse files that have
+    already been parsed
+    """
+    global _shared_inputs
+    _shared_inputs = SharedInputs()
+    try:
+        yield _shared_inputs
+    finally:
+        _shared_inputs = None
+
+
 def read_metadata(f, index_name="sampleID_SEQ"):
+    if _shared_inputs is not None:
+        return _shared_inputs.get(f, _read_metadata, index_name=index_name)
+    return _read_metadata(f, index_name=index_name)
+
+
+def _read_metadata(f, index_name="sampleID_SEQ"):
     sys.stderr.write("####\n" f"Reading metadata from {f}\n")
     df = pd.read_csv(f, sep="\t", header=0, comment="#")
     return df.set_index(index_name)
 
 
-def read_clustfile(f, sep="\t"):
+class AsvDictionary:
+    """
+    Interns ASV ids into int32 codes so that joins between the clustfile,
+    chunks of the counts file and aggregates are made on integer keys. Ids
+    are only decoded back to strings when writing output.
+    """
+
+    def __init__(self, asvs):
+        self.ids = pd.Index(asvs).unique()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def encode(self, asvs):
+        """
+        Returns codes of <asvs>, with -1 for ids not in the dictionary
+        """
+        return self.ids.get_indexer(asvs).astype(np.int32)
+
+    def decode(self, codes):
+        return self.ids[np.asarray(codes)]
+
+    def intern(self, df):
+        """
+        Replaces the ASV index of <df> with codes, dropping unknown ASVs
+        """
+        codes = self.encode(df.index)
+        keep = np.flatnonzero(codes >= 0)
+        return df.iloc[keep].set_axis(codes[keep], axis=0)
+
+
+def read_clustfile(f, sep="\t", columns=None, categorical=None):
     """
     Reads a cluster membership file for ASVs
 
     :param f:
     :param sep:
+    :param columns: Only read these columns (in addition to the ASV ids)
+    :param categorical: Store these columns (e.g. clusters and rank labels) as
+    categoricals with one shared dictionary of labels
     :return:
     """
-    return pd.read_csv(f, sep=sep, index_col=0, header=0)
+    if _shared_inputs is not None:
+        return _shared_inputs.get(
+            f, _read_clustfile, sep=sep, columns=columns, categorical=categorical
+        )
+    return _read_clustfile(f, sep=sep, columns=columns, categorical=categorical)
+
+
+def _read_clustfile(f, sep="\t", columns=None, categorical=None):
+    usecols = None
+    dtype = None
+    if columns is not None:
+        columns = list(dict.fromkeys(columns))
+        index_name = pd.read_csv(f, sep=sep, index_col=0, header=0, nrows=0).index.name
+        usecols = [index_name] + columns
+    if categorical:
+        # Parse labels directly into categoricals to avoid holding them as
+        # python strings
+        categorical = list(dict.fromkeys(categorical))
+        dtype = {c: "category" for c in categorical}
+    df = pd.read_csv(f, sep=sep, index_col=0, header=0, usecols=usecols, dtype=dtype)
+    if categorical:
+        for c in categorical:
+            df[c] = df[c].cat.rename_categories(parse_categories(df[c].cat.categories))
+        df = share_categories(df, categorical)
+    return df
 
 
-def generate_reader(f, chunksize, nrows):
+def parse_categories(categories):
     """
-    Sets up a reader with pandas. Handles both chunksize>=1 and chunksize=None
+    Parses labels as numbers if they all are, as read_csv does for a column
+    without a dtype, e.g. so that numeric cluster ids sort as numbers
+    """
+    try:
+        parsed = pd.Index(pd.to_numeric(categories))
+    except (ValueError, TypeError):
+        return categories
+    return parsed if parsed.is_unique else categories
+
+
+def share_categories(df, columns):
+    """
+    Converts <columns> of <df> to categoricals sharing one sorted dictionary of
+    labels, e.g. after concatenating dataframes with different dictionaries.
+    Columns with labels of another type, e.g. numeric cluster ids, share a
+    dictionary of their own.
+    """
+    groups = {}
+    for c in columns:
+        dtype = df[c].astype("category").cat.categories.dtype
+        groups.setdefault(str(dtype), []).append(c)
+    for group in groups.values():
+        categories = pd.api.types.union_categoricals(
+            [df[c].astype("category") for c in group]
+        ).categories.sort_values()
+        # Unordered categoricals with the same categories in another order
+        # have an equal dtype, so astype would keep their order
+        for c in group:
+            df[c] = df[c].astype("category").cat.set_categories(categories)
+    return df
+
+
+def expand_countsfiles(countsfile, samples=None):
+    """
+    Expands one or more countsfile paths or glob patterns (e.g.
+    'counts/run*.tsv') into a list of files. A partition manifest written by
+    partition-counts, or its directory, is expanded into its partitions.
+
+    :param countsfile: Path, glob pattern or list of these
+    :param samples: If given, leave out partitions without any of these
+    samples. Partitions in a manifest are selected from the samples listed in
+    the manifest, partitions given as files from their meta entry.
+    :return: list of files, in the order given (glob matches sorted)
+    """
+    if countsfile is None:
+        return []
+    if isinstance(countsfile, str):
+        countsfile = [countsfile]
+    files = []
+    for pattern in countsfile:
+        if os.path.isdir(pattern) or pattern.endswith(".json"):
+            files += [
+                f
+                for f, f_samples in read_partition_manifest(pattern).items()
+                if samples is None or pd.Index(f_samples).isin(samples).any()
+            ]
+            continue
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+            if len(matches) == 0:
+                raise FileNotFoundError(f"No countsfiles match '{pattern}'")
+        else:
+            matches = [pattern]
+        files += [
+            f
+            for f in matches
+            if samples is None
+            or not is_partition(f)
+            or countsfile_columns(f).isin(samples).any()
+        ]
+    return list(dict.fromkeys(files))
+
+
+def multiple_countsfiles(args, unsupported=(), samples=None):
+    """
+    Expands the countsfile argument of <args>. A single file is stored back as
+    a path, several files are returned for reading as one matrix, after
+    checking that none of the <unsupported> options are set. If <samples> is
+    given, partitions without any of these samples are not read.
+
+    :return: list of countsfiles if several are given, otherwise None
+    """
+    countsfiles = expand_countsfiles(args.countsfile, samples=samples)
+    if samples is not None:
+        all_files = expand_countsfiles(args.countsfile)
+        if any(is_partition(f) for f in all_files):
+            sys.stderr.write(
+                "####\n"
+                f"Reading {len(countsfiles)} of {len(all_files)} partitions\n"
+            )
+    if len(countsfiles) <= 1:
+        args.countsfile = countsfiles[0] if countsfiles else None
+        return None
+    for option in unsupported:
+        if getattr(args, option, None):
+            sys.exit(f"ERROR: --{option} can not be used with several countsfiles")
+    return countsfiles
+
+
+def is_partition(f):
+    """
+    Returns True if <f> is named like a dataset partition of a countsfile,
+    as written by partition-counts
+    """
+    return isinstance(f, (str, os.PathLike)) and str(f).endswith(".npz")
+
+
+def read_partition_meta(f):
+    """
+    Reads the description of a countsfile partition (samples, index name and
+    number of rows and chunks)
+    """
+    with np.load(f, allow_pickle=False) as archive:
+        try:
+            meta = json.loads(str(archive["meta"]))
+        except KeyError:
+            raise ValueError(f"{f} is not a countsfile partition")
+    if meta.get("format") != PARTITION_FORMAT:
+        raise ValueError(f"{f} is not a countsfile partition")
+    if meta["version"] > PARTITION_VERSION:
+        raise ValueError(
+            f"{f} has partition version {meta['version']}, "
+            f"only versions <= {PARTITION_VERSION} are supported"
+        )
+    return meta
+
+
+def read_partition_manifest(f):
+    """
+    Returns the partition files listed in a manifest written by
+    partition-counts, with the samples in each. <f> is the manifest or the
+    directory holding it.
+    """
+    if os.path.isdir(f):
+        f = os.path.join(f, "manifest.json")
+    with open(f, "r") as fhin:
+        manifest = json.load(fhin)
+    if manifest.get("format") != PARTITION_MANIFEST_FORMAT:
+        raise ValueError(f"{f} is not a partition manifest")
+    outdir = os.path.dirname(f)
+    return {
+        os.path.join(outdir, info["file"]): info["samples"]
+        for info in manifest["datasets"].values()
+    }
+
+
+def countsfile_columns(f):
+    """
+    Returns the samples of a countsfile or partition
+    """
+    if is_partition(f):
+        return pd.Index(read_partition_meta(f)["samples"])
+    return pd.read_csv(f, sep="\t", index_col=0, nrows=0).columns
+
+
+def read_partition(f, chunksize=None, nrows=None, shard=None, skip_rows=0):
+    """
+    Reads a partition in the chunks it was written in, as dataframes like
+    those of a countsfile read with pandas. Rows without counts in the
+    partition, which are not stored, are read with zeros from the ASV ids of
+    all rows stored next to it. Row shards are made of every <n>:th chunk.
+
+    :param f: Partition file
+    :param chunksize: If None, all chunks are returned as one dataframe
+    :param nrows: Number of rows to read
+    :param shard: Only read chunks in this shard, given as '<k>/<n>'
+    :param skip_rows: Skip this many rows (of the shard) before reading
+    """
+    meta = read_partition_meta(f)
+    k, n = parse_shard(shard) if shard is not None else (1, 1)
+
+    def chunks():
+        skip = skip_rows
+        remaining = nrows
+        with contextlib.ExitStack() as stack:
+            archive = stack.enter_context(np.load(f, allow_pickle=False))
+            asv_archive = archive
+            if meta["version"] >= 2:
+                asv_archive = stack.enter_context(
+                    np.load(partition_asvs_file(f, meta), allow_pickle=False)
+                )
+            for i in range(k - 1, meta["n_chunks"], n):
+                asvs = asv_archive[f"asvs_{i}"]
+                if skip >= len(asvs):
+                    skip -= len(asvs)
+                    continue
+                end = len(asvs) if remaining is None else skip + remaining
+                if meta["version"] >= 2:
+                    counts = np.zeros((len(asvs), len(meta["samples"])), meta["dtype"])
+                    if f"rows_{i}" in archive.files:
+                        counts[archive[f"rows_{i}"]] = archive[f"counts_{i}"]
+                else:
+                    counts = archive[f"counts_{i}"]
+                df = pd.DataFrame(
+                    counts[skip:end],
+                    index=pd.Index(asvs[skip:end], name=meta["index_name"]),
+                    columns=meta["samples"],
+                )
+                skip = 0
+                if remaining is not None:
+                    remaining -= df.shape[0]
+                yield df
+                if remaining == 0:
+                    return
+
+    if chunksize is None:
+        frames = list(chunks())
+        if len(frames) == 0:
+            return [
+                pd.DataFrame(
+                    index=pd.Index([], name=meta["index_name"]),
+                    columns=meta["samples"],
+                    dtype=meta["dtype"],
+                )
+            ]
+        return [pd.concat(frames)]
+    return chunks()
+
+
+def partition_asvs_file(f, meta):
+    """
+    Returns the file with the ASV ids of all rows of partition <f>, checking
+    that it was written from the same countsfile
+    """
+    asvs = os.path.join(os.path.dirname(f), meta["asvs"])
+    if not os.path.exists(asvs):
+        raise ValueError(f"ASV ids of partition {f} not found ({asvs})")
+    with np.load(asvs, allow_pickle=False) as archive:
+        asvs_meta = json.loads(str(archive["meta"]))
+    if asvs_meta.get("format") != PARTITION_ASVS_FORMAT:
+        raise ValueError(f"{asvs} is not a list of partition ASV ids")
+    if any(asvs_meta[key] != meta[key] for key in ["source", "n_chunks"]):
+        raise ValueError(f"{asvs} was not written with partition {f}")
+    return asvs
+
+
+def parse_shard(shard):
+    """
+    Parses a shard specification of the form '<k>/<n>' (1-based)
+
+    :param shard: Shard specification, e.g. '2/4'
+    :return: tuple of (k, n)
+    """
+    try:
+        k, n = [int(x) for x in shard.split("/")]
+    except ValueError:
+        raise ValueError(f"Invalid shard '{shard}', expected '<k>/<n>' e.g. '2/4'")
+    if n < 1 or not 1 <= k <= n:
+        raise ValueError(f"Invalid shard '{shard}', <k> must be between 1 and <n>")
+    return k, n
+
+
+class ShardReader(io.RawIOBase):
+    """
+    File-like object exposing the header line plus the k:th of n byte ranges
+    of a tab-separated file. Range boundaries are moved forward to the next
+    line start so that every row belongs to exactly one shard. The first
+    <skip_rows> rows of the range are skipped, e.g. when resuming a scan.
+    """
+
+    def __init__(self, f, k=1, n=1, skip_rows=0):
+        super().__init__()
+        self._fh = open(f, "rb")
+        self._header = self._fh.readline()
+        body_start = self._fh.tell()
+        body_size = os.fstat(self._fh.fileno()).st_size - body_start
+        start = self._align(body_start + (k - 1) * body_size // n, body_start)
+        end = self._align(body_start + k * body_size // n, body_start)
+        self._fh.seek(start)
+        if skip_rows > 0:
+            # Skip lines without parsing them
+            collections.deque(itertools.islice(self._fh, skip_rows), maxlen=0)
+            start = min(self._fh.tell(), end)
+            self._fh.seek(start)
+        self._remaining = end - start
+
+    def _align(self, offset, body_start):
+        if offset <= body_start:
+            return body_start
+        self._fh.seek(offset - 1)
+        self._fh.readline()
+        return self._fh.tell()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if len(self._header) > 0:
+            n = min(len(b), len(self._header))
+            b[:n] = self._header[:n]
+            self._header = self._header[n:]
+            return n
+        data = self._fh.read(min(len(b), self._remaining))
+        b[: len(data)] = data
+        self._remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        self._fh.close()
+        super().close()
+
+
+class UnsortedInputError(ValueError):
+    pass
+
+
+def read_sorted_column(f, column, chunksize=None, sep="\t"):
+    """
+    Reads one column of a tab-separated file (e.g. cluster membership of ASVs)
+    in chunks, checking that the index (first column) is sorted in increasing
+    order
 
     :param f: Input file
+    :param column: Column to read
+    :param chunksize: Number of rows to read per chunk
+    :return: generator of Series
+    """
+    index_name = pd.read_csv(f, sep=sep, nrows=0).columns[0]
+    reader = pd.read_csv(
+        f,
+        sep=sep,
+        usecols=[index_name, column],
+        index_col=0,
+        header=0,
+        chunksize=chunksize,
+    )
+    if chunksize is None:
+        reader = [reader]
+    last = None
+    for df in reader:
+        if df.shape[0] == 0:
+            continue
+        if not df.index.is_monotonic_increasing or not df.index.is_unique or (
+            last is not None and df.index[0] <= last
+        ):
+            raise UnsortedInputError(f"{f} is not sorted by {index_name}")
+        last = df.index[-1]
+        yield df[column]
+
+
+def merge_join(reader, right):
+    """
+    Joins chunks from a reader with chunks of a Series, walking both in
+    lockstep. Both inputs must be sorted by their index, so only the part of
+    <right> overlapping the current chunk is held in memory.
+
+    :param reader: Iterable of dataframes, sorted by index
+    :param right: Iterable of Series, sorted by index (e.g. read_sorted_column)
+    :return: generator of (dataframe, Series) with the Series values for the
+    rows of the dataframe (NaN where missing from <right>)
+    """
+    right = iter(right)
+    buffer = pd.Series(dtype=object)
+    exhausted = False
+    last = None
+    for df in reader:
+        if df.shape[0] == 0:
+            yield df, buffer.iloc[:0]
+            continue
+        if not df.index.is_monotonic_increasing or not df.index.is_unique or (
+            last is not None and df.index[0] <= last
+        ):
+            raise UnsortedInputError("Counts are not sorted by ASV id")
+        last = df.index[-1]
+        # Read from <right> until it has passed the last row of the chunk
+        while not exhausted and (buffer.shape[0] == 0 or buffer.index[-1] < last):
+            try:
+                buffer = pd.concat([buffer, next(right)])
+            except StopIteration:
+                exhausted = True
+        start = buffer.index.searchsorted(df.index[0], side="left")
+        end = buffer.index.searchsorted(last, side="right")
+        part = buffer.iloc[start:end]
+        buffer = buffer.iloc[end:]
+        yield df, part.reindex(df.index)
+
+
+class PrefetchReader:
+    """
+    Iterates over the chunks of <reader> while a background thread parses up
+    to <depth> chunks ahead, so that reading and parsing overlap with the
+    processing of the current chunk. Queue depth and the time spent waiting
+    on either side are reported when iteration ends.
+    """
+
+    _done = object()
+
+    def __init__(self, reader, depth=2):
+        self.reader = reader
+        self.depth = depth
+        self.n_chunks = 0
+        self.stall_time = 0.0
+        self.blocked_time = 0.0
+        self._depth_sum = 0
+        self._n_gets = 0
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        start = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self.blocked_time += time.perf_counter() - start
+
+    def _fill(self):
+        try:
+            for df in self.reader:
+                self._put((df, None))
+                if self._stop.is_set():
+                    return
+        except BaseException as e:
+            self._put((None, e))
+            return
+        self._put((self._done, None))
+
+    def __iter__(self):
+        try:
+            while True:
+                self._depth_sum += self._queue.qsize()
+                self._n_gets += 1
+                start = time.perf_counter()
+                df, error = self._queue.get()
+                self.stall_time += time.perf_counter() - start
+                if error is not None:
+                    raise error
+                if df is self._done:
+                    break
+                self.n_chunks += 1
+                yield df
+        finally:
+            self._stop.set()
+            self.report()
+
+    @property
+    def mean_depth(self):
+        return self._depth_sum / max(self._n_gets, 1)
+
+    def report(self):
+        sys.stderr.write(
+            "####\n"
+            f"Prefetched {self.n_chunks} chunks (queue size {self.depth}): "
+            f"mean queue depth {self.mean_depth:.2f}, "
+            f"waited {self.stall_time:.2f}s for chunks, "
+            f"reader blocked {self.blocked_time:.2f}s on full queue\n"
+        )
+
+
+class SharedScan:
+    """
+    Reads a countsfile once for several consumers, each running in a thread
+    of its own, e.g. the scans of the tools run by run-workflow. Consumers
+    that call generate_reader for the countsfile (with the same chunksize and
+    nrows) all get the same chunks, which must not be modified in place.
+    Reading starts once every consumer has subscribed or finished, and is
+    kept at most <depth> chunks ahead of the slowest consumer. Consumers
+    reading the countsfile a second time, or with other options, read it on
+    their own.
+    """
+
+    _done = object()
+
+    def __init__(self, countsfile, chunksize=None, nrows=None, depth=2):
+        self.countsfile = str(countsfile)
+        self.chunksize = chunksize
+        self.nrows = nrows or None
+        self.depth = depth
+        self.n_chunks = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._state = {}
+        self._queues = {}
+
+    def run(self, funcs):
+        """
+        Runs each function in <funcs> in its own thread while feeding them the
+        chunks of the countsfile. Errors of consumers are raised once all
+        consumers have finished.
+
+        :return: list of return values of <funcs>
+        """
+        results = [None] * len(funcs)
+        errors = []
+        self._state = {i: "pending" for i in range(len(funcs))}
+
+        def consume(i, func):
+            self._local.slot = i
+            try:
+                results[i] = func()
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                self._close(i)
+
+        threads = [
+            threading.Thread(target=consume, args=(i, func), daemon=True)
+            for i, func in enumerate(funcs)
+        ]
+        producer = threading.Thread(target=self._produce, daemon=True)
+        producer.start()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        producer.join()
+        if len(errors) > 0:
+            raise errors[0]
+        sys.stderr.write(
+            "####\n"
+            f"Read {self.n_chunks} chunks of {self.countsfile} once for "
+            f"{len(funcs)} consumers\n"
+        )
+        return results
+
+    def subscribe(self, f, chunksize, nrows):
+        """
+        Returns an iterator over the shared chunks if called from a consumer
+        that has not subscribed yet, otherwise None
+        """
+        slot = getattr(self._local, "slot", None)
+        if slot is None or str(f) != self.countsfile:
+            return None
+        if chunksize != self.chunksize or (nrows or None) != self.nrows:
+            return None
+        with self._cond:
+            if self._state.get(slot) != "pending":
+                return None
+            self._queues[slot] = queue.Queue(maxsize=self.depth)
+            self._state[slot] = "subscribed"
+            self._cond.notify_all()
+        return self._iterate(slot)
+
+    def _iterate(self, slot):
+        try:
+            while True:
+                df, error = self._queues[slot].get()
+                if error is not None:
+                    raise error
+                if df is self._done:
+                    return
+                yield df
+        finally:
+            self._close(slot)
+
+    def _close(self, slot):
+        with self._cond:
+            self._state[slot] = "closed"
+            self._cond.notify_all()
+
+    def _subscribed(self):
+        return [i for i, state in self._state.items() if state == "subscribed"]
+
+    def _put_all(self, item):
+        """
+        Puts <item> on the queue of each subscribed consumer, skipping those
+        that stop reading. Returns False if no consumer is left.
+        """
+        for slot in self._subscribed():
+            while self._state[slot] == "subscribed":
+                try:
+                    self._queues[slot].put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+        return len(self._subscribed()) > 0
+
+    def _produce(self):
+        with self._cond:
+            self._cond.wait_for(
+                lambda: all(state != "pending" for state in self._state.values())
+            )
+        if len(self._subscribed()) == 0:
+            return
+        try:
+            reader = generate_reader(self.countsfile, self.chunksize, self.nrows)
+            for df in reader:
+                if not self._put_all((df, None)):
+                    return
+                self.n_chunks += 1
+        except BaseException as e:
+            self._put_all((None, e))
+            return
+        self._put_all((self._done, None))
+
+
+_shared_scan = None
+
+
+@contextlib.contextmanager
+def shared_scan(countsfile, chunksize=None, nrows=None, depth=2):
+    """
+    Within this context consumers run with SharedScan.run read <countsfile>
+    in one shared pass
+    """
+    global _shared_scan
+    _shared_scan = SharedScan(countsfile, chunksize, nrows, depth=depth)
+    try:
+        yield _shared_scan
+    finally:
+        _shared_scan = None
+
+
+def sample_rows(f, n_rows=None, fraction=None, method="seek", seed=None):
+    """
+    Draws a random sample of rows from a tab-separated file without parsing it
+
+    With method 'seek', rows are picked by seeking to random byte offsets and
+    taking the next complete line. This only touches the sampled lines but
+    favours rows following long lines, so it is close to uniform when rows
+    have similar lengths. With method 'reservoir' all lines are read (but not
+    parsed) and the sample is exactly uniform.
+
+    :param f: Input file
+    :param n_rows: Number of rows to sample
+    :param fraction: Fraction of rows to sample (used if n_rows is not given)
+    :param method: 'seek' or 'reservoir'
+    :param seed: Seed for the random number generator
+    :return: tuple of (file-like object with header and sampled rows, number of
+    rows sampled, (estimated) number of rows in the file)
+    """
+    rng = random.Random(seed)
+    with open(f, "rb") as fh:
+        header = fh.readline()
+        body_start = fh.tell()
+        body_size = os.fstat(fh.fileno()).st_size - body_start
+        if method == "reservoir":
+            lines = []
+            n_total = 0
+            for n_total, line in enumerate(fh, start=1):
+                if n_rows is None:
+                    if rng.random() < fraction:
+                        lines.append(line)
+                elif len(lines) < n_rows:
+                    lines.append(line)
+                else:
+                    j = rng.randrange(n_total)
+                    if j < n_rows:
+                        lines[j] = line
+        elif method == "seek":
+
+            def line_at(offset):
+                fh.seek(offset - 1)
+                fh.readline()
+                start = fh.tell()
+                line = fh.readline()
+                if len(line) == 0:
+                    # Wrap around to the first row
+                    start = body_start
+                    fh.seek(start)
+                    line = fh.readline()
+                return start, line
+
+            if n_rows is None:
+                # Estimate number of rows from the length of a pilot sample
+                pilot = [
+                    line_at(body_start + rng.randrange(body_size))[1]
+                    for _ in range(min(1000, body_size))
+                ]
+                mean_length = sum(len(x) for x in pilot) / max(len(pilot), 1)
+                n_rows = round(fraction * body_size / max(mean_length, 1))
+            sampled = {}
+            for _ in range(10 * n_rows):
+                if len(sampled) >= n_rows or body_size == 0:
+                    break
+                start, line = line_at(body_start + rng.randrange(body_size))
+                sampled[start] = line
+            lines = [sampled[start] for start in sorted(sampled)]
+            mean_length = sum(len(x) for x in lines) / max(len(lines), 1)
+            n_total = round(body_size / max(mean_length, 1))
+        else:
+            raise ValueError(f"Unknown sampling method '{method}'")
+    lines = [x if x.endswith(b"\n") else x + b"\n" for x in lines]
+    return io.BytesIO(header + b"".join(lines)), len(lines), max(n_total, len(lines))
+
+
+def generate_reader(f, chunksize, nrows, shard=None, prefetch=0, skip_rows=0):
+    """
+    Sets up a reader with pandas. Handles both chunksize>=1 and chunksize=None
+
+    :param f: Input file, a countsfile or a partition written by partition-counts
     :param chunksize: Number of rows to read per chunk
     :param nrows: Number of total rows to read
+    :param shard: Only read rows in this row shard, given as '<k>/<n>'
+    :param prefetch: Number of chunks to parse ahead in a background thread
+    :param skip_rows: Skip this many rows (of the shard) before reading, e.g.
+    to resume a scan from a checkpoint
     :return:
     """
     if nrows == 0:
         nrows = None
+    if _shared_scan is not None and shard is None and skip_rows == 0:
+        reader = _shared_scan.subscribe(f, chunksize, nrows)
+        if reader is not None:
+            return reader
+    if nrows is not None and skip_rows > 0:
+        nrows -= skip_rows
+        if nrows <= 0:
+            return []
+    if is_partition(f):
+        r = read_partition(f, chunksize, nrows, shard=shard, skip_rows=skip_rows)
+        if prefetch and chunksize is not None:
+            return PrefetchReader(r, depth=prefetch)
+        return r
+    skiprows = None
+    if shard is not None or skip_rows > 0:
+        if str(f).endswith(".gz"):
+            if shard is not None:
+                raise ValueError("Row shards can not be read from compressed files")
+            # Compressed files can not be seeked, let pandas skip the rows
+            skiprows = range(1, skip_rows + 1)
+        else:
+            k, n = parse_shard(shard) if shard is not None else (1, 1)
+            f = io.BufferedReader(ShardReader(f, k, n, skip_rows=skip_rows))
     r = pd.read_csv(
-        f, sep="\t", index_col=0, header=0, nrows=nrows, chunksize=chunksize
+        f,
+        sep="\t",
+        index_col=0,
+        header=0,
+        nrows=nrows,
+        chunksize=chunksize,
+        skiprows=skiprows,
     )
-    if chunksize is not None:
-        return r
-    return [r]
+    if chunksize is None:
+        return [r]
+    if prefetch:
+        return PrefetchReader(r, depth=prefetch)
+    return r
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+import hashlib
+import json
+import os
+import pickle
+import sys
+import time
+import pandas as pd
+from clean_asv_data.__main__ import file_fingerprint
+
+CHECKPOINT_FORMAT = "clean_asv_data.checkpoint"
+CHECKPOINT_VERSION = 1
+
+
+def digest(values):
+    """
+    Returns a short hash of a list of values, e.g. ASV ids or cluster names,
+    to include in checkpoint parameters
+    """
+    return hashlib.sha1(
+        pd.util.hash_pandas_object(pd.Series(values), index=False).to_numpy()
+    ).hexdigest()
+
+
+class Checkpoint:
+    """
+    Saves the state of a scan over the counts file (accumulated aggregates
+    and the number of rows processed) at most every <interval> seconds, so
+    that an interrupted scan can be resumed from the last checkpoint. The
+    checkpoint is only valid for the same counts file and <params>.
+    """
+
+    def __init__(self, f, countsfile, params=None, interval=600):
+        self.f = f
+        self.countsfile = countsfile
+        self.params = hashlib.sha1(
+            json.dumps(params or {}, sort_keys=True, default=str).encode()
+        ).hexdigest()
+        self.interval = interval
+        self.rows = self.chunks = 0
+        self.n_saves = 0
+        self.save_time = 0.0
+        self._last = time.time()
+
+    def load(self):
+        """
+        Loads the state saved in the checkpoint file
+
+        :return: saved state, or None if there is no checkpoint file
+        """
+        if not os.path.exists(self.f):
+            sys.stderr.write(
+                "####\n"
+                f"WARNING: No checkpoint found at {self.f}, starting from the "
+                "beginning\n"
+            )
+            return None
+        with open(self.f, "rb") as fhin:
+            checkpoint = pickle.load(fhin)
+        if (
+            not isinstance(checkpoint, dict)
+            or checkpoint.get("format") != CHECKPOINT_FORMAT
+        ):
+            raise ValueError(f"{self.f} is not a checkpoint file")
+        if checkpoint["version"] > CHECKPOINT_VERSION:
+            raise ValueError(
+                f"{self.f} has checkpoint version {checkpoint['version']}, "
+                f"only versions <= {CHECKPOINT_VERSION} are supported"
+            )
+        current = file_fingerprint(self.countsfile)
+        if any(checkpoint["fingerprint"][k] != current[k] for k in ["size", "mtime"]):
+            raise ValueError(
+                f"Checkpoint {self.f} is out of date with {self.countsfile}"
+            )
+        if checkpoint["params"] != self.params:
+            raise ValueError(
+                f"Checkpoint {self.f} was written with different parameters"
+            )
+        self.rows = checkpoint["rows"]
+        self.chunks = checkpoint["chunks"]
+        sys.stderr.write(
+            "####\n"
+            f"Resuming from checkpoint {self.f} after {self.rows} rows "
+            f"({self.chunks} chunks)\n"
+        )
+        return checkpoint["state"]
+
+    def update(self, n_rows, state):
+        """
+        Registers a processed chunk of <n_rows> rows, and saves the state if
+        the last save was at least <interval> seconds ago
+
+        :param n_rows: Number of rows in the chunk
+        :param state: Function returning the state to save
+        """
+        self.rows += n_rows
+        self.chunks += 1
+        if time.time() - self._last >= self.interval:
+            self.save(state())
+
+    def save(self, state):
+        start = time.time()
+        checkpoint = {
+            "format": CHECKPOINT_FORMAT,
+            "version": CHECKPOINT_VERSION,
+            "fingerprint": file_fingerprint(self.countsfile),
+            "params": self.params,
+            "rows": self.rows,
+            "chunks": self.chunks,
+            "state": state,
+        }
+        # Write to a temporary file first so that an interruption while
+        # saving leaves the previous checkpoint intact
+        tmp = f"{self.f}.tmp"
+        with open(tmp, "wb") as fhout:
+            pickle.dump(checkpoint, fhout, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.f)
+        self._last = time.time()
+        self.n_saves += 1
+        self.save_time += self._last - start
+
+    def finish(self):
+        """
+        Removes the checkpoint file after a completed scan
+        """
+        if os.path.exists(self.f):
+            os.remove(self.f)
+        sys.stderr.write(
+            "####\n"
+            f"Saved {self.n_saves} checkpoints in {self.save_time:.1f} seconds\n"
+        )
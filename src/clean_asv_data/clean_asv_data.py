@@ -1,16 +1,37 @@
 #!/usr/bin/env python
 import argparse
 from argparse import ArgumentParser
+import numpy as np
 import pandas as pd
 import sys
 import os
 import tqdm
 from clean_asv_data.__main__ import (
+    AsvDictionary,
+    countsfile_columns,
+    multiple_countsfiles,
     read_config,
     generate_reader,
     read_clustfile,
     read_metadata,
 )
+from clean_asv_data.checkpoint import Checkpoint, digest
+from clean_asv_data.partials import write_partial, load_partials, scan_countsfiles
+from clean_asv_data.preflight import preflight as run_preflight
+from clean_asv_data.presence import POPCOUNT, PresenceIndexBuilder
+from clean_asv_data.libsize import (
+    LibrarySizeBuilder,
+    filter_rel_abundance,
+    get_library_sizes,
+)
+from clean_asv_data.sparse import SPARSE_FORMATS, read_taxonomy, sparse_writer
+from clean_asv_data.preview import (
+    depth_estimates,
+    proportion_estimate,
+    sample_counts,
+    total_estimate,
+    write_report,
+)
 
 
 def read_counts(
@@ -20,37 +41,133 @@ def read_counts(
     blanks=None,
     chunksize=None,
     nrows=None,
+    shard=None,
+    partial=None,
+    presence_index=None,
+    asvs=None,
+    prefetch=0,
+    library_index=None,
+    library_sizes=None,
+    min_rel_abundance=None,
+    checkpoint=None,
+    resume=False,
+    checkpoint_interval=600,
+    clusters=None,
 ):
     """
     Read the counts file in chunks, if list of blanks is given, count occurrence
     in blanks and return as a column <in_n_blanks>. Also calculate max and
     sum for each ASV.
+
+    If <partial> is given the aggregates are also written to this file so that
+    they can be merged with aggregates from other row or column shards. If
+    <presence_index> is given, a presence index is built during the scan.
+
+    If an AsvDictionary is given as <asvs>, only ASVs in the dictionary are
+    kept and the returned dataframes are indexed by their integer codes.
+
+    If <library_index> is given, per-sample read depth and richness are
+    written to this file. If <min_rel_abundance> is given, counts below this
+    percentage of the sample's library size (Series <library_sizes>) are set
+    to zero before aggregating.
+
+    If <checkpoint> is given, the aggregates are saved to this file every
+    <checkpoint_interval> seconds. With <resume>, reading continues from the
+    last saved checkpoint.
+
+    If <clusters> (cluster codes of the ASVs in <asvs>) is given, the
+    occurrence of clusters in blanks, i.e. the number of blanks in which any
+    member ASV is present, is returned in the columns <cluster_in_n_blanks>
+    and <cluster_in_percent_blanks>. Presence in blanks is accumulated as one
+    bitset per cluster.
     """
     if blanks is None:
         blanks = []
-    reader = generate_reader(countsfile, chunksize=chunksize, nrows=nrows)
-    sys.stderr.write("####\n" f"Reading counts from {countsfile}\n")
+    builder = None
+    if presence_index is not None:
+        builder = PresenceIndexBuilder(countsfile, shard=shard, nrows=nrows)
+    lib_builder = None
+    if library_index is not None:
+        lib_builder = LibrarySizeBuilder(countsfile, shard=shard, nrows=nrows)
     data = {}
+    plan = {}
+    cluster_blanks = {}
+    n_clusters = 0
+    if clusters is not None and len(clusters) > 0:
+        n_clusters = int(clusters.max()) + 1
     warnings = []
-    n_asvs = n_samples = 0
+    n_asvs = n_samples = n_kept = 0
     n_datasets = []
+    ckpt = None
+    if checkpoint is not None:
+        datasets = None
+        if metadata is not None:
+            datasets = digest(
+                metadata.index.astype(str) + "\t" + metadata[split_col].astype(str)
+            )
+        ckpt = Checkpoint(
+            checkpoint,
+            countsfile,
+            params={
+                "datasets": datasets,
+                "split_col": split_col,
+                "blanks": sorted(blanks),
+                "nrows": nrows,
+                "shard": shard,
+                "asvs": None if asvs is None else digest(asvs.ids),
+                "presence_index": presence_index,
+                "library_index": library_index,
+                "min_rel_abundance": min_rel_abundance,
+                "clusters": None if clusters is None else digest(clusters),
+            },
+            interval=checkpoint_interval,
+        )
+        state = ckpt.load() if resume else None
+        if state is not None:
+            data, plan, warnings = state["data"], state["plan"], state["warnings"]
+            n_asvs, n_samples = state["n_asvs"], state["n_samples"]
+            n_kept = state.get("n_kept", 0)
+            cluster_blanks = state.get("cluster_blanks", {})
+            n_datasets = state["n_datasets"]
+            builder, lib_builder = state["builder"], state["lib_builder"]
+    reader = generate_reader(
+        countsfile,
+        chunksize=chunksize,
+        nrows=nrows,
+        shard=shard,
+        prefetch=prefetch,
+        skip_rows=0 if ckpt is None else ckpt.rows,
+    )
+    sys.stderr.write("####\n" f"Reading counts from {countsfile}\n")
+    if builder is not None:
+        reader = builder.track(reader)
+    if lib_builder is not None:
+        reader = lib_builder.track(reader)
     for i, df in enumerate(
         tqdm.tqdm(
             reader,
             unit=" chunks",
-        )
+        ),
+        start=0 if ckpt is None else ckpt.chunks,
     ):
         n_asvs += df.shape[0]
+        n_rows = df.shape[0]
+        if asvs is not None:
+            # Skip ASVs not in the dictionary before aggregating
+            df = asvs.intern(df)
+            n_kept += df.shape[0]
+        if min_rel_abundance:
+            df = filter_rel_abundance(df, library_sizes, min_rel_abundance)
         if i == 0:
             n_samples = df.shape[1]
+        if metadata is None:
+            # set up dummy metadata
             sample_names = list(df.columns)
-            if metadata is None:
-                # set up dummy metadata
-                split_col = "dataset"
-                metadata = pd.DataFrame(
-                    data={split_col: [split_col] * len(sample_names)},
-                    index=sample_names,
-                )
+            split_col = "dataset"
+            metadata = pd.DataFrame(
+                data={split_col: [split_col] * len(sample_names)},
+                index=sample_names,
+            )
         # get unique values of split_col
         split_col_vals = metadata[split_col].unique()
         for val in split_col_vals:
@@ -60,10 +177,13 @@ def read_counts(
             val_samples = metadata.loc[metadata[split_col] == val].index
             # get intersection of val_samples and the df columns
             val_samples_intersect = list(set(val_samples).intersection(df.columns))
-            if len(val_samples_intersect) == 0 and i == 0:
-                warnings.append(
-                    "####\n" f"No samples found in counts data for {val}, skipping...\n"
-                )
+            if len(val_samples_intersect) == 0:
+                # Datasets without samples are skipped in every chunk
+                if i == 0:
+                    warnings.append(
+                        "####\n"
+                        f"No samples found in counts data for {val}, skipping...\n"
+                    )
                 continue
             n_datasets.append(val)
             # get samples in val_samples missing from df columns
@@ -88,6 +208,10 @@ def read_counts(
                 warnings.append(
                     "####\n" f"{len(val_blanks_intersect)} blanks found for {val}\n"
                 )
+                plan[val] = {
+                    "samples": sorted(val_samples_intersect),
+                    "blanks": sorted(val_blanks_intersect),
+                }
             # calculate ASV sum (remove blanks)
             asv_sum = pd.DataFrame(
                 split_df.drop(val_blanks_intersect, axis=1).sum(axis=1),
@@ -111,110 +235,585 @@ def read_counts(
                 _dataframe = pd.merge(
                     _dataframe, asv_blank_count, left_index=True, right_index=True
                 )
+                if clusters is not None:
+                    add_cluster_blanks(
+                        cluster_blanks,
+                        val,
+                        clusters[blank_counts.index],
+                        blank_counts.loc[:, plan[val]["blanks"]],
+                        n_clusters=n_clusters,
+                    )
             data[val] = pd.concat([data[val], _dataframe])
+        if ckpt is not None:
+            ckpt.update(
+                n_rows,
+                lambda: {
+                    "data": data,
+                    "plan": plan,
+                    "warnings": warnings,
+                    "n_asvs": n_asvs,
+                    "n_kept": n_kept,
+                    "cluster_blanks": cluster_blanks,
+                    "n_samples": n_samples,
+                    "n_datasets": n_datasets,
+                    "builder": builder,
+                    "lib_builder": lib_builder,
+                },
+            )
     sys.stderr.write(
         f"Read counts for {n_asvs} ASVs in "
         f"{n_samples} samples and {len(set(n_datasets))} datasets\n"
     )
+    if asvs is not None:
+        sys.stderr.write(f"Kept {n_kept} of {n_asvs} ASVs, skipped the rest\n")
     for item in warnings:
         sys.stderr.write(item)
+    for val, bits in cluster_blanks.items():
+        # Occurrence of the cluster of each ASV in blanks
+        n_blanks = POPCOUNT[bits].sum(axis=1, dtype=np.int64)
+        df = data[val]
+        codes = clusters[df.index]
+        df["cluster_in_n_blanks"] = np.where(codes >= 0, n_blanks[codes], 0)
+        df["cluster_in_percent_blanks"] = (
+            df["cluster_in_n_blanks"].div(len(plan[val]["blanks"])) * 100
+        )
+    if ckpt is not None:
+        ckpt.finish()
+    if builder is not None:
+        builder.save(presence_index)
+    if lib_builder is not None:
+        lib_builder.save(library_index)
+    if partial is not None:
+        sys.stderr.write("####\n" f"Writing partial aggregates to {partial}\n")
+        write_partial(
+            partial,
+            "clean",
+            {
+                val: df.drop("in_percent_blanks", axis=1, errors="ignore").set_axis(
+                    df.index if asvs is None else asvs.decode(df.index), axis=0
+                )
+                for val, df in data.items()
+                if val in plan
+            },
+            params={"split_col": split_col, "min_rel_abundance": min_rel_abundance},
+            plan=plan,
+            source={"countsfile": countsfile, "shard": shard, "nrows": nrows},
+        )
     return data
 
 
-def clean_by_taxonomy(dataframe, skip_ambig=False, skip_unclass=False, rank="Family"):
+def add_cluster_blanks(cluster_blanks, dataset, codes, blank_counts, n_clusters):
     """
-    Removes ASVs if they are 'unassigned' at <rank> or <rank> contains '_X'
+    ORs the presence of ASVs in blanks into the bitsets of their clusters
+
+    :param cluster_blanks: Dictionary of arrays with a packed bitset of
+    blanks for each cluster, updated in place
+    :param dataset: Dataset of <blank_counts>
+    :param codes: Cluster codes of the rows of <blank_counts>
+    :param blank_counts: Counts of ASVs in the blanks of <dataset>, in the
+    same column order for every chunk
+    :param n_clusters: Total number of clusters
     """
-    df = dataframe.copy()
-    before = df.shape[0]
-    cl_before = len(df["cluster"].unique())
-    if skip_ambig and skip_unclass:
-        sys.stderr.write("####\n" "Skipping cleaning by taxonomy\n")
-        return df
-    if not skip_ambig:
-        sys.stderr.write("####\n" f"Removing ASVs ambiguous at {rank}\n")
-        cleaned = df.loc[~df[rank].str.contains("_X+$")]
-        n_ambig = before - cleaned.shape[0]
-        cl_ambig = cl_before - len(cleaned["cluster"].unique())
-        sys.stderr.write(f"{n_ambig} ASVs removed ({cl_ambig} clusters)\n")
-    else:
-        n_ambig = 0
-        cl_ambig = 0
-        cleaned = df.copy()
-    if not skip_unclass:
-        sys.stderr.write("####\n" f"Removing ASVs unclassified at {rank}\n")
-        cleaned = cleaned.loc[~cleaned[rank].str.startswith("unclassified")]
-        n_unclass = before - cleaned.shape[0] - n_ambig
-        cl_unclass = cl_before - len(cleaned["cluster"].unique()) - cl_ambig
-        sys.stderr.write(f"{n_unclass} ASVs removed ({cl_unclass} clusters)\n")
+    if dataset not in cluster_blanks:
+        cluster_blanks[dataset] = np.zeros(
+            (n_clusters, (blank_counts.shape[1] + 7) // 8), dtype=np.uint8
+        )
+    bits = cluster_blanks[dataset]
+    present = codes >= 0
+    if not present.any():
+        return
+    codes = codes[present]
+    asv_bits = np.packbits(blank_counts.to_numpy()[present] > 0, axis=1)
+    # Reduce ASV bitsets of the chunk to one bitset per cluster
+    order = np.argsort(codes, kind="stable")
+    uniq, starts = np.unique(codes[order], return_index=True)
+    bits[uniq] |= np.bitwise_or.reduceat(asv_bits[order], starts, axis=0)
+
+
+def read_countsfiles(
+    countsfiles,
+    metadata=None,
+    split_col="dataset",
+    blanks=None,
+    chunksize=None,
+    nrows=None,
+    prefetch=0,
+    min_rel_abundance=None,
+    asvs=None,
+    threads=None,
+):
+    """
+    Reads several countsfiles with different samples as one counts matrix
+    joined on ASV ids, returning the same aggregates as read_counts would for
+    the joined matrix. The files are read in parallel and their aggregates
+    are merged as partials.
+
+    With <min_rel_abundance>, library sizes of the samples are taken from the
+    file each sample is in. If an AsvDictionary is given as <asvs>, only ASVs
+    in the dictionary are kept while reading (ASV ids are not interned).
+    """
+    columns = {f: countsfile_columns(f) for f in countsfiles}
+    if metadata is not None:
+        samples = pd.Index([]).append(list(columns.values()))
+        missing = metadata.index[~metadata.index.isin(samples)]
+        if len(missing) > 0:
+            sys.stderr.write(
+                "####\n"
+                f"WARNING: {len(missing)} samples in metadata file are missing "
+                "from all countsfiles\n"
+            )
+
+    def scan(countsfile, partial):
+        # Only split the samples of this file into datasets
+        file_metadata = None
+        if metadata is not None:
+            file_metadata = metadata.loc[metadata.index.isin(columns[countsfile])]
+        library_sizes = None
+        if min_rel_abundance:
+            library_sizes = get_library_sizes(
+                countsfile, chunksize=chunksize, nrows=nrows, prefetch=prefetch
+            )["reads"]
+        read_counts(
+            countsfile=countsfile,
+            metadata=file_metadata,
+            split_col=split_col,
+            blanks=blanks,
+            chunksize=chunksize,
+            nrows=nrows,
+            partial=partial,
+            prefetch=prefetch,
+            library_sizes=library_sizes,
+            min_rel_abundance=min_rel_abundance,
+            asvs=asvs,
+        )
+
+    return scan_countsfiles(countsfiles, scan, kind="clean", threads=threads)
+
+
+def dataset_samples(countsfile, metadata=None, split_col="dataset"):
+    """
+    Reads the header of the counts file and returns the samples of each dataset
+    in the order they appear in the counts file
+    """
+    columns = list(countsfile_columns(countsfile))
+    if metadata is None:
+        return {"dataset": columns}
+    samples = {}
+    for val in metadata[split_col].unique():
+        val_samples = set(metadata.loc[metadata[split_col] == val].index)
+        samples[val] = [c for c in columns if c in val_samples]
+    return samples
+
+
+def write_cleaned_counts(
+    countsfile,
+    keep,
+    samples,
+    outfiles,
+    chunksize=None,
+    nrows=None,
+    prefetch=0,
+    library_sizes=None,
+    min_rel_abundance=None,
+    counts_format=None,
+    taxonomy=None,
+):
+    """
+    Streams the counts file and writes the counts of retained ASVs in the
+    samples of each dataset to one output file per dataset. With a sparse
+    <counts_format> ('biom', 'mtx' or 'parquet') only non-zero counts are
+    written.
+
+    :param countsfile: Counts file of ASVs
+    :param keep: Dictionary with index of ASVs to keep for each dataset
+    :param samples: Dictionary with list of samples for each dataset
+    :param outfiles: Dictionary with output file for each dataset
+    :param chunksize: Number of rows to read per chunk
+    :param nrows: Number of total rows to read
+    :param prefetch: Number of chunks to read ahead in a background thread
+    :param library_sizes: Series with total reads of each sample
+    :param min_rel_abundance: Set counts below this percentage of the library
+    size of the sample to zero
+    :param counts_format: Output format, 'tsv' (default) or a sparse format
+    :param taxonomy: Dataframe with taxonomy of ASVs, stored as observation
+    metadata in BIOM output
+    :return:
+    """
+    keep_all = pd.Index([]).append([keep[dataset] for dataset in outfiles]).unique()
+    handles = {}
+    writers = {}
+    if counts_format in SPARSE_FORMATS:
+        writers = {
+            dataset: sparse_writer(
+                f, counts_format, samples[dataset], taxonomy=taxonomy, row_name="ASV"
+            )
+            for dataset, f in outfiles.items()
+        }
     else:
-        n_unclass = 0
-        cl_unclass = 0
+        handles = {dataset: open(f, "w") for dataset, f in outfiles.items()}
+    n_written = {dataset: 0 for dataset in outfiles}
+    reader = generate_reader(
+        countsfile, chunksize=chunksize, nrows=nrows, prefetch=prefetch
+    )
+    try:
+        for i, df in enumerate(
+            tqdm.tqdm(reader, desc="writing cleaned counts", unit=" chunks")
+        ):
+            # Skip chunks without any retained ASVs
+            df = df.loc[df.index.isin(keep_all)]
+            if min_rel_abundance:
+                df = filter_rel_abundance(df, library_sizes, min_rel_abundance)
+            for dataset in outfiles:
+                _df = df.loc[df.index.isin(keep[dataset]), samples[dataset]]
+                _df.index.name = "ASV"
+                if dataset in writers:
+                    writers[dataset].add(_df)
+                elif i == 0 or _df.shape[0] > 0:
+                    _df.to_csv(handles[dataset], sep="\t", header=(i == 0))
+                n_written[dataset] += _df.shape[0]
+    finally:
+        for fhout in handles.values():
+            fhout.close()
+        for writer in writers.values():
+            writer.close()
+    for dataset, f in outfiles.items():
+        sys.stderr.write(
+            "####\n"
+            f"Wrote counts for {n_written[dataset]} ASVs in "
+            f"{len(samples[dataset])} samples of {dataset} to {f}\n"
+        )
 
-    after = cleaned.shape[0]
-    cl_after = len(cleaned["cluster"].unique())
-    sys.stderr.write(
-        f"{before - after} ASVs removed, {cleaned.shape[0]} ASVs remaining\n"
+
+def write_cleaned_clustfile(clustfile, cleaned, chunksize=None):
+    """
+    Writes all clustfile columns of retained ASVs together with their counts
+    aggregates. The clustfile is read in chunks so that only the columns used
+    for cleaning have to be kept in memory. Clustfile values are written as
+    they appear in the input.
+
+    :param clustfile: Clustfile with ASV taxonomy and cluster designations
+    :param cleaned: Dictionary of output files and dataframes with retained
+    ASVs as index and the columns to add to the clustfile columns
+    :param chunksize: Number of clustfile rows to read per chunk
+    :return:
+    """
+    reader = pd.read_csv(
+        clustfile,
+        sep="\t",
+        index_col=0,
+        header=0,
+        dtype=str,
+        keep_default_na=False,
+        chunksize=chunksize or None,
     )
-    sys.stderr.write(
-        f"{cl_before-cl_after} clusters removed, {cl_after} clusters remaining\n"
+    if not chunksize:
+        reader = [reader]
+    fhs = {outfile: open(outfile, "w") for outfile in cleaned.keys()}
+    for i, chunk in enumerate(reader):
+        chunk.index.name = "ASV"
+        for outfile, df in cleaned.items():
+            pd.merge(chunk, df, left_index=True, right_index=True).to_csv(
+                fhs[outfile], sep="\t", header=i == 0
+            )
+    for fhout in fhs.values():
+        fhout.close()
+
+
+class CleaningPlan:
+    """
+    Lazily cleans a dataframe of ASVs that belong to clusters. Each cleaning
+    step computes a boolean mask of ASVs to remove from arrays of the
+    dataframe, without copying it, and the numbers of removed ASVs and
+    clusters are counted from the masks. The dataframe is only subset once,
+    by materialize().
+    """
+
+    def __init__(self, dataframe, clusters=None):
+        """
+        :param dataframe: Dataframe with ASVs as index
+        :param clusters: Cluster of each ASV in <dataframe>, defaults to its
+        'cluster' column
+        """
+        self.dataframe = dataframe
+        if clusters is None:
+            clusters = dataframe["cluster"]
+        # Clusters as integer codes, with missing clusters as code 0
+        self.clusters = label_codes(clusters) + 1
+        self.n_clusters = int(self.clusters.max()) + 1 if len(self.clusters) else 1
+        self.keep = np.ones(dataframe.shape[0], dtype=bool)
+
+    @property
+    def n_asvs(self):
+        return int(self.keep.sum())
+
+    def cluster_mask(self, asvs):
+        """
+        Returns a mask of clusters with at least one ASV in the mask <asvs>
+        """
+        return np.bincount(self.clusters[asvs], minlength=self.n_clusters) > 0
+
+    def count_clusters(self):
+        return int(self.cluster_mask(self.keep).sum())
+
+    def remove(self, asvs):
+        """
+        Removes ASVs in the mask <asvs> from the plan
+
+        :return: number of ASVs and clusters removed
+        """
+        n_asvs, n_clusters = self.n_asvs, self.count_clusters()
+        self.keep &= ~asvs
+        return n_asvs - self.n_asvs, n_clusters - self.count_clusters()
+
+    def by_taxonomy(self, skip_ambig=False, skip_unclass=False, rank="Family"):
+        """
+        Removes ASVs if they are 'unassigned' at <rank> or <rank> contains '_X'
+        """
+        if skip_ambig and skip_unclass:
+            sys.stderr.write("####\n" "Skipping cleaning by taxonomy\n")
+            return self
+        before, cl_before = self.n_asvs, self.count_clusters()
+        labels = self.dataframe[rank]
+        if not skip_ambig:
+            sys.stderr.write("####\n" f"Removing ASVs ambiguous at {rank}\n")
+            n_ambig, cl_ambig = self.remove(
+                label_mask(labels, lambda x: x.str.contains("_X+$"))
+            )
+            sys.stderr.write(f"{n_ambig} ASVs removed ({cl_ambig} clusters)\n")
+        if not skip_unclass:
+            sys.stderr.write("####\n" f"Removing ASVs unclassified at {rank}\n")
+            n_unclass, cl_unclass = self.remove(
+                label_mask(labels, lambda x: x.str.startswith("unclassified"))
+            )
+            sys.stderr.write(f"{n_unclass} ASVs removed ({cl_unclass} clusters)\n")
+        after, cl_after = self.n_asvs, self.count_clusters()
+        sys.stderr.write(f"{before - after} ASVs removed, {after} ASVs remaining\n")
+        sys.stderr.write(
+            f"{cl_before-cl_after} clusters removed, {cl_after} clusters remaining\n"
+        )
+        return self
+
+    def by_blanks(self, blanks=None, mode="asv", max_blank_occurrence=5):
+        """
+        Removes ASVs present in > <max_blank_occurrence>% of blanks, or with
+        mode 'cluster' all ASVs in clusters with such an ASV. With mode
+        'cluster_occurrence' all ASVs in clusters of which any member is
+        present in > <max_blank_occurrence>% of blanks are removed, using
+        the <cluster_in_percent_blanks> column.
+        """
+        column = "in_percent_blanks"
+        if mode == "cluster_occurrence":
+            column = "cluster_in_percent_blanks"
+        if blanks is None or len(blanks) == 0 or column not in self.dataframe.columns:
+            return self
+        if mode == "cluster_occurrence":
+            sys.stderr.write(
+                "####\n"
+                f"Removing clusters present in >{max_blank_occurrence}% of blanks\n"
+            )
+        else:
+            sys.stderr.write(
+                "####\n" f"Removing {mode}s in >{max_blank_occurrence}% of blanks\n"
+            )
+        to_remove = self.keep & (
+            self.dataframe[column].to_numpy() > max_blank_occurrence
+        )
+        if mode == "cluster":
+            to_remove = self.cluster_mask(to_remove)[self.clusters]
+        n_asvs, n_clusters = self.remove(to_remove)
+        sys.stderr.write(
+            f"{n_asvs} ASVs removed ({n_clusters} clusters), {self.n_asvs} ASVs "
+            "remaining\n"
+        )
+        return self
+
+    def by_reads(self, min_clust_count=3):
+        """
+        Removes clusters with a sum less than <min_clust_count> across samples
+        """
+        sys.stderr.write(
+            "####\n" f"Removing ASVs in clusters with <{min_clust_count} total reads\n"
+        )
+        cl_sum = np.bincount(
+            self.clusters[self.keep],
+            weights=self.dataframe["ASV_sum"].to_numpy()[self.keep],
+            minlength=self.n_clusters,
+        )
+        cl_to_remove = self.cluster_mask(self.keep) & (cl_sum < min_clust_count)
+        # ASVs without a cluster are not summed
+        cl_to_remove[0] = False
+        n_asvs, n_clusters = self.remove(cl_to_remove[self.clusters])
+        sys.stderr.write(
+            f"{n_asvs} ASVs removed ({n_clusters} clusters), {self.n_asvs} ASVs "
+            "remaining\n"
+        )
+        return self
+
+    def materialize(self, taxonomy=None):
+        """
+        Returns the retained rows of the dataframe
+
+        :param taxonomy: If given, join these columns (indexed like the
+        dataframe) to the retained rows, in the order of <taxonomy>
+        """
+        if taxonomy is None:
+            return self.dataframe.iloc[np.flatnonzero(self.keep)]
+        kept = self.dataframe.index[self.keep]
+        # Subset the (narrow) taxonomy rather than the dataframe, so that the
+        # join is the only copy of the retained counts
+        return pd.merge(
+            taxonomy.loc[taxonomy.index.isin(kept)],
+            self.dataframe,
+            left_index=True,
+            right_index=True,
+        )
+
+
+def label_codes(labels):
+    """
+    Returns integer codes of <labels>, with -1 for missing values
+    """
+    if isinstance(labels.dtype, pd.CategoricalDtype):
+        return labels.cat.codes.to_numpy().astype(np.int64)
+    return pd.factorize(labels)[0].astype(np.int64)
+
+
+def label_mask(labels, func):
+    """
+    Evaluates the string predicate <func> on <labels>, once per distinct label
+    for categoricals. Missing labels do not match.
+    """
+    if isinstance(labels.dtype, pd.CategoricalDtype):
+        matches = np.asarray(func(labels.cat.categories.astype(str)), dtype=bool)
+        codes = labels.cat.codes.to_numpy()
+        return np.where(codes >= 0, matches[codes], False)
+    return func(labels.astype(str)).to_numpy(dtype=bool) & labels.notna().to_numpy()
+
+
+def clean_by_taxonomy(dataframe, skip_ambig=False, skip_unclass=False, rank="Family"):
+    """
+    Removes ASVs if they are 'unassigned' at <rank> or <rank> contains '_X'
+    """
+    return (
+        CleaningPlan(dataframe)
+        .by_taxonomy(skip_ambig=skip_ambig, skip_unclass=skip_unclass, rank=rank)
+        .materialize()
     )
-    return cleaned
 
 
 def clean_by_reads(dataframe, min_clust_count=3):
     """
     Remove clusters with a sum less than <min_reads> across samples
     """
-    sys.stderr.write(
-        "####\n" f"Removing ASVs in clusters with <{min_clust_count} total reads\n"
-    )
-    df = dataframe.copy()
-    # Groupby cluster column and sum values in ASV_sum
-    cl_sum = df.groupby("cluster").sum(numeric_only=True)
-    # Get list of clusters to remove
-    cl_to_remove = cl_sum.loc[cl_sum["ASV_sum"] < min_clust_count].index
-    # Get list of ASVs in said clusters
-    asvs_to_remove = df.loc[df["cluster"].isin(cl_to_remove)].index
-    before = df.shape[0]
-    df.drop(asvs_to_remove, inplace=True)
-    after = df.shape[0]
-    sys.stderr.write(f"{before - after} ASVs removed, {df.shape[0]} ASVs remaining\n")
-    return df
+    return CleaningPlan(dataframe).by_reads(min_clust_count).materialize()
 
 
 def clean_by_blanks(dataframe, blanks=None, mode="asv", max_blank_occurrence=5):
     """
     Removes ASVs present in > <max_blank_occurrence>% of blanks
     """
-    if (
-        blanks is None
-        or len(blanks) == 0
-        or "in_percent_blanks" not in dataframe.columns
-    ):
-        return dataframe
-    sys.stderr.write(
-        "####\n" f"Removing {mode}s in >{max_blank_occurrence}% of blanks\n"
-    )
-    df = dataframe.copy()
-    before = df.shape[0]
-    # Get list of ASVs to remove
-    to_remove = df.loc[df.in_percent_blanks > max_blank_occurrence].index
-    if mode == "cluster":
-        # Get clusters for said ASVs
-        to_remove_cl = df.loc[to_remove, "cluster"]
-        # Get all ASVs in said clusters
-        to_remove = list(df.loc[df["cluster"].isin(list(to_remove_cl))].index)
-    df.drop(to_remove, inplace=True)
-    after = df.shape[0]
-    sys.stderr.write(f"{before - after} ASVs removed, {df.shape[0]} ASVs remaining\n")
-    return df
+    return (
+        CleaningPlan(dataframe)
+        .by_blanks(
+            blanks=blanks, mode=mode, max_blank_occurrence=max_blank_occurrence
+        )
+        .materialize()
+    )
+
+
+def preview(args, asv_taxa, metadata=None, blanks=None):
+    """
+    Estimates the outcome of cleaning from a random sample of rows in the
+    counts file and writes the estimates with confidence intervals to stdout
+    """
+    sample, n, n_total = sample_counts(
+        args.countsfile,
+        n_rows=args.sample_rows,
+        fraction=args.sample_fraction,
+        method=args.sample_method,
+        seed=args.seed,
+    )
+    counts = read_counts(sample, metadata=metadata, split_col=args.split_col, blanks=blanks)
+    sample.seek(0)
+    sample_df = pd.read_csv(sample, sep="\t", index_col=0)
+    samples = dataset_samples(args.countsfile, metadata, args.split_col)
+    asv_taxa_cleaned = clean_by_taxonomy(
+        dataframe=asv_taxa,
+        skip_ambig=args.skip_ambig,
+        skip_unclass=args.skip_unclass,
+        rank=args.clean_rank,
+    )
+    rows = []
+    for dataset, df in counts.items():
+        if df.shape[0] == 0:
+            continue
+        in_clustfile = df.index.isin(asv_taxa.index)
+        kept = df.index.isin(asv_taxa_cleaned.index)
+        rows.append(proportion_estimate("ASVs", n, n, n_total, dataset))
+        rows.append(
+            proportion_estimate(
+                "ASVs_in_clustfile", in_clustfile.sum(), n, n_total, dataset
+            )
+        )
+        rows.append(
+            proportion_estimate(
+                "ASVs_after_taxonomy_cleaning", kept.sum(), n, n_total, dataset
+            )
+        )
+        if "in_percent_blanks" in df.columns:
+            rows.append(
+                proportion_estimate(
+                    "ASVs_in_blanks", (df["in_n_blanks"] > 0).sum(), n, n_total, dataset
+                )
+            )
+            rows.append(
+                proportion_estimate(
+                    "ASVs_after_taxonomy_cleaning_above_max_blank_occurrence",
+                    (kept & (df["in_percent_blanks"] > args.max_blank_occurrence)).sum(),
+                    n,
+                    n_total,
+                    dataset,
+                )
+            )
+        rows.append(total_estimate("reads", df["ASV_sum"], n_total, dataset))
+        rows.append(
+            total_estimate(
+                "reads_after_taxonomy_cleaning",
+                df["ASV_sum"].where(kept, 0),
+                n_total,
+                dataset,
+            )
+        )
+        rows += depth_estimates(
+            sample_df.loc[df.index, samples[dataset]], n_total, dataset
+        )
+    write_report(rows)
 
 
 def main(args):
     data = {}
     # Read config
     args = read_config(args.configfile, args)
+    countsfiles = multiple_countsfiles(
+        args,
+        unsupported=[
+            "shard",
+            "write_partial",
+            "presence_index",
+            "library_index",
+            "checkpoint",
+            "counts_output",
+            "sample_rows",
+            "sample_fraction",
+        ],
+    )
+    if args.blank_removal_mode == "cluster_occurrence" and (
+        args.write_partial or args.from_partials or countsfiles
+    ):
+        sys.exit(
+            "ERROR: --blank_removal_mode cluster_occurrence can not be used with "
+            "partials or several countsfiles"
+        )
     if not args.output:
         outdir = "."
         output = "cleaned.tsv"
@@ -223,13 +822,6 @@ def main(args):
         if outdir=="":
             outdir = "."
         output = os.path.basename(args.output)
-    # Read taxonomy + clusters
-    sys.stderr.write("####\n" f"Reading clustfile {args.clustfile}\n")
-    asv_taxa = read_clustfile(args.clustfile)
-    sys.stderr.write(
-        "###\n"
-        f"Found {asv_taxa.shape[0]} ASVs in {len(asv_taxa['cluster'].unique())} clusters\n"
-    )
     # Read metadata
     metadata = None
     blanks = None
@@ -243,49 +835,184 @@ def main(args):
             sys.stderr.write("####\n" f"Found {len(blanks)} blanks in metadata\n")
         else:
             blanks = []
-    # Read counts (returns a dictionary)
-    counts = read_counts(
-        countsfile=args.countsfile,
-        metadata=metadata,
-        split_col=args.split_col,
-        blanks=blanks,
-        chunksize=args.chunksize,
-        nrows=args.nrows,
-    )
-    # Clean by taxonomy
+    if args.preflight:
+        report = run_preflight(args)
+        report.write(sys.stderr)
+        if not report.ok:
+            sys.exit("Preflight checks failed, exiting")
+    # Get library sizes of samples for relative abundance filtering
+    library_sizes = None
+    library_index = args.library_index
+    if args.min_rel_abundance and not (args.from_partials or countsfiles):
+        library_sizes = get_library_sizes(
+            args.countsfile,
+            index=args.library_index,
+            chunksize=args.chunksize,
+            nrows=args.nrows,
+            prefetch=args.prefetch,
+        )["reads"]
+        library_index = None
+    if args.write_partial:
+        read_counts(
+            countsfile=args.countsfile,
+            metadata=metadata,
+            split_col=args.split_col,
+            blanks=blanks,
+            chunksize=args.chunksize,
+            nrows=args.nrows,
+            shard=args.shard,
+            partial=args.write_partial,
+            presence_index=args.presence_index,
+            prefetch=args.prefetch,
+            library_index=library_index,
+            library_sizes=library_sizes,
+            min_rel_abundance=args.min_rel_abundance,
+            checkpoint=args.checkpoint,
+            resume=args.resume,
+            checkpoint_interval=args.checkpoint_interval,
+        )
+        return
+    # Read taxonomy + clusters
+    sys.stderr.write("####\n" f"Reading clustfile {args.clustfile}\n")
+    # Only cluster and rank used for cleaning are needed until output is written
+    asv_taxa = read_clustfile(
+        args.clustfile,
+        columns=["cluster", args.clean_rank],
+        categorical=["cluster", args.clean_rank],
+    )
+    sys.stderr.write(
+        "###\n"
+        f"Found {asv_taxa.shape[0]} ASVs in {len(asv_taxa['cluster'].unique())} clusters\n"
+    )
+    if args.sample_rows or args.sample_fraction:
+        preview(args, asv_taxa, metadata=metadata, blanks=blanks)
+        return
+    # Clean by taxonomy first so that rejected ASVs are skipped while reading
+    # counts
     asv_taxa_cleaned = clean_by_taxonomy(dataframe=asv_taxa, skip_ambig=args.skip_ambig, skip_unclass=args.skip_unclass, rank=args.clean_rank)
-    # Merge counts + taxonomy
+    # Intern ASV ids of retained ASVs so that counts and taxonomy are joined on
+    # integer codes. ASVs not in the dictionary are dropped from each chunk.
+    asvs = AsvDictionary(asv_taxa_cleaned.index)
+    asv_taxa_cleaned = asvs.intern(asv_taxa_cleaned)
+    # Cluster of each interned ASV, as codes shared by all datasets
+    cluster_of = pd.Categorical(
+        np.empty(len(asvs), dtype=object),
+        categories=asv_taxa_cleaned["cluster"].cat.categories,
+    )
+    cluster_of[asv_taxa_cleaned.index] = asv_taxa_cleaned["cluster"]
+    # Read counts (returns a dictionary)
+    if args.from_partials:
+        counts = {
+            dataset: asvs.intern(df)
+            for dataset, df in load_partials(args.from_partials, kind="clean").items()
+        }
+    elif countsfiles:
+        counts = {
+            dataset: asvs.intern(df)
+            for dataset, df in read_countsfiles(
+                countsfiles,
+                metadata=metadata,
+                split_col=args.split_col,
+                blanks=blanks,
+                chunksize=args.chunksize,
+                nrows=args.nrows,
+                prefetch=args.prefetch,
+                min_rel_abundance=args.min_rel_abundance,
+                asvs=asvs,
+                threads=args.threads,
+            ).items()
+        }
+    else:
+        counts = read_counts(
+            countsfile=args.countsfile,
+            metadata=metadata,
+            split_col=args.split_col,
+            blanks=blanks,
+            chunksize=args.chunksize,
+            nrows=args.nrows,
+            shard=args.shard,
+            presence_index=args.presence_index,
+            prefetch=args.prefetch,
+            asvs=asvs,
+            library_index=library_index,
+            library_sizes=library_sizes,
+            min_rel_abundance=args.min_rel_abundance,
+            checkpoint=args.checkpoint,
+            resume=args.resume,
+            checkpoint_interval=args.checkpoint_interval,
+            clusters=cluster_of.codes
+            if args.blank_removal_mode == "cluster_occurrence"
+            else None,
+        )
+    keep = {}
+    cleaned = {}
     for dataset, dataframe in counts.items():
         sys.stderr.write("####\n" f"Cleaning {dataset}\n")
-        dataframe = pd.merge(
-            asv_taxa_cleaned, dataframe, left_index=True, right_index=True
+        plan = CleaningPlan(
+            dataframe, clusters=pd.Series(cluster_of[dataframe.index])
         )
         # Clean by blanks
-        dataframe = clean_by_blanks(
-            dataframe=dataframe,
+        plan.by_blanks(
             blanks=blanks,
             mode=args.blank_removal_mode,
             max_blank_occurrence=args.max_blank_occurrence,
         )
         # Clean by read sum
-        dataframe = clean_by_reads(
-            dataframe=dataframe, min_clust_count=args.min_clust_count
-        )
+        plan.by_reads(min_clust_count=args.min_clust_count)
+        # Merge retained counts + taxonomy
+        dataframe = plan.materialize(taxonomy=asv_taxa_cleaned)
+        # Decode ASV ids for output
+        dataframe.index = asvs.decode(dataframe.index)
         dataframe.index.name = "ASV"
-        # Write to output
         if len(counts.keys()) > 1:
             outfile = f"{outdir}/{dataset}.{output}"
         else:
             outfile = f"{outdir}/{output}"
-        with open(outfile, "w") as fhout:
-            sys.stderr.write(
-                "####\n"
-                f"Writing cleaned {dataset} with {dataframe.shape[0]} ASVs to {outfile}\n"
+        sys.stderr.write(
+            "####\n"
+            f"Writing cleaned {dataset} with {dataframe.shape[0]} ASVs to {outfile}\n"
+        )
+        cleaned[outfile] = dataframe.drop(["cluster", args.clean_rank], axis=1)
+        keep[dataset] = dataframe.index
+    # Write to output, adding the remaining clustfile columns of retained ASVs
+    write_cleaned_clustfile(args.clustfile, cleaned, chunksize=args.chunksize)
+    if args.counts_output:
+        # Write counts of retained ASVs in one more pass over the countsfile
+        samples = dataset_samples(args.countsfile, metadata, args.split_col)
+        outfiles = {}
+        for dataset in keep.keys():
+            if len(keep.keys()) > 1:
+                outfiles[dataset] = f"{outdir}/{dataset}.{args.counts_output}"
+            else:
+                outfiles[dataset] = f"{outdir}/{args.counts_output}"
+        taxonomy = None
+        if args.taxonomy and args.counts_format == "biom":
+            # ASVs get the consensus taxonomy of their cluster
+            clusters = asv_taxa.loc[
+                asv_taxa.index.isin(pd.Index([]).append(list(keep.values()))),
+                "cluster",
+            ]
+            taxonomy = (
+                read_taxonomy(args.taxonomy)
+                .reindex(clusters.astype(str))
+                .set_axis(clusters.index, axis=0)
             )
-            dataframe.to_csv(fhout, sep="\t")
+        write_cleaned_counts(
+            args.countsfile,
+            keep=keep,
+            samples=samples,
+            outfiles=outfiles,
+            chunksize=args.chunksize,
+            nrows=args.nrows,
+            prefetch=args.prefetch,
+            library_sizes=library_sizes,
+            min_rel_abundance=args.min_rel_abundance,
+            counts_format=args.counts_format,
+            taxonomy=taxonomy,
+        )
 
 
-def main_cli():
+def build_parser():
     parser = ArgumentParser(
         """
         This script cleans clustering results by removing ASVs if:
@@ -296,7 +1023,19 @@ def main_cli():
         """
     )
     io_group = parser.add_argument_group("input/output")
-    io_group.add_argument("--countsfile", type=str, help="Counts file of ASVs")
+    io_group.add_argument(
+        "--countsfile",
+        type=str,
+        nargs="+",
+        help="Counts file of ASVs. Several files (or glob patterns) with different "
+        "samples are read in parallel as one counts matrix joined on ASV ids",
+    )
+    io_group.add_argument(
+        "--threads",
+        type=int,
+        help="Number of countsfiles to read at the same time when several are "
+        "given (default: all)",
+    )
     io_group.add_argument(
         "--clustfile",
         type=str,
@@ -327,6 +1066,60 @@ def main_cli():
         "into multiple datasets there will be one cleaned file per dataset"
         "with this parameter used to set the file name ending",
     )
+    io_group.add_argument(
+        "--counts_output",
+        type=str,
+        help="Also write counts of retained ASVs in the samples of each dataset "
+        "to this file (placed in the same directory as --output). If input data "
+        "will be split into multiple datasets there will be one file per dataset",
+    )
+    io_group.add_argument(
+        "--counts_format",
+        type=str,
+        choices=["tsv"] + SPARSE_FORMATS,
+        help="Format of --counts_output: a dense table ('tsv', default) or the "
+        "non-zero counts as a BIOM 2.1 (HDF5) table ('biom', requires h5py), a "
+        "Matrix Market file ('mtx') or (ASV, sample, value) triplets in a "
+        "Parquet file ('parquet', requires pyarrow)",
+    )
+    io_group.add_argument(
+        "--taxonomy",
+        type=str,
+        help="Consensus taxonomy of clusters (output of consensus-taxonomy). "
+        "ASVs in BIOM --counts_output get the taxonomy of their cluster as "
+        "observation metadata",
+    )
+    io_group.add_argument(
+        "--presence_index",
+        type=str,
+        help="Write a presence/absence index of ASVs in samples to this file "
+        "while reading the countsfile. Can be queried with query-presence",
+    )
+    io_group.add_argument(
+        "--library_index",
+        type=str,
+        help="File with total reads and richness of each sample. Written while "
+        "reading the countsfile and used for --min_rel_abundance",
+    )
+    io_group.add_argument(
+        "--write_partial",
+        type=str,
+        help="Only aggregate counts and write them to this partial aggregate "
+        "file. Partials from several shards can be combined with merge-partials",
+    )
+    io_group.add_argument(
+        "--from_partials",
+        type=str,
+        nargs="+",
+        help="Use (merged) partial aggregate files instead of reading the "
+        "countsfile",
+    )
+    io_group.add_argument(
+        "--shard",
+        type=str,
+        help="Only read row shard <k> of <n> from the countsfile, e.g. '2/4'. "
+        "Use together with --write_partial",
+    )
     params_group = parser.add_argument_group("params")
     params_group.add_argument(
         "--configfile",
@@ -377,7 +1170,7 @@ def main_cli():
     params_group.add_argument(
         "--blank_removal_mode",
         type=str,
-        choices=["cluster", "asv"],
+        choices=["cluster", "asv", "cluster_occurrence"],
         default="asv",
         help="How to remove sequences based on "
         "occurrence in blanks. If 'asv' ("
@@ -386,7 +1179,18 @@ def main_cli():
         "<max_blank_occurrence>%% of blanks. If "
         "'cluster', remove ASVs in clusters where "
         "one or more ASVs is above the "
-        "<max_blank_occurrence> threshold",
+        "<max_blank_occurrence> threshold. If "
+        "'cluster_occurrence', remove ASVs in clusters "
+        "that, counting all member ASVs, are present in "
+        "more than <max_blank_occurrence>%% of blanks",
+    )
+    params_group.add_argument(
+        "--min_rel_abundance",
+        type=float,
+        help="Set counts of ASVs to zero in samples where they make up less "
+        "than <min_rel_abundance>%% of the sample's reads, before any other "
+        "cleaning. Library sizes are read from --library_index if it is up to "
+        "date, otherwise calculated in an extra pass over the countsfile",
     )
     params_group.add_argument(
         "--min_clust_count",
@@ -394,16 +1198,75 @@ def main_cli():
         help="Remove clusters with < <min_clust_count> "
         "summed across samples (default 3)",
     )
+    params_group.add_argument(
+        "--preflight",
+        action="store_true",
+        help="Check inputs (countsfile header, metadata and clustfile ASVs) "
+        "before reading counts and exit if there are errors",
+    )
+    preview_group = parser.add_argument_group("preview")
+    preview_group.add_argument(
+        "--sample_rows",
+        type=int,
+        help="Preview mode: estimate cleaning outcome, blank contamination and "
+        "read depths from this many randomly sampled rows of the countsfile "
+        "and write the estimates to stdout",
+    )
+    preview_group.add_argument(
+        "--sample_fraction",
+        type=float,
+        help="Preview mode: as --sample_rows but sample this fraction of rows",
+    )
+    preview_group.add_argument(
+        "--sample_method",
+        type=str,
+        choices=["seek", "reservoir"],
+        default="seek",
+        help="Sample rows by seeking to random byte offsets ('seek', default, "
+        "fast but assumes rows of similar length) or by reading all lines "
+        "('reservoir', exactly uniform)",
+    )
+    preview_group.add_argument(
+        "--seed",
+        type=int,
+        help="Seed for random sampling of rows",
+    )
+    checkpoint_group = parser.add_argument_group("checkpointing")
+    checkpoint_group.add_argument(
+        "--checkpoint",
+        type=str,
+        help="Periodically save aggregates of the countsfile scan to this file",
+    )
+    checkpoint_group.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume the countsfile scan from the file given by --checkpoint",
+    )
+    checkpoint_group.add_argument(
+        "--checkpoint_interval",
+        type=int,
+        help="Minimum number of seconds between checkpoints (default 600)",
+    )
     debug_group = parser.add_argument_group("debug")
     debug_group.add_argument(
         "--chunksize",
         type=int,
         help="Size of chunks (in lines) to read from " "countsfile",
     )
+    debug_group.add_argument(
+        "--prefetch",
+        type=int,
+        help="Number of chunks to read ahead from the countsfile in a background "
+        "thread (default 0, no prefetching)",
+    )
     debug_group.add_argument(
         "--nrows",
         type=int,
         help=argparse.SUPPRESS,
     )
-    args = parser.parse_args()
+    return parser
+
+
+def main_cli():
+    args = build_parser().parse_args()
     main(args)
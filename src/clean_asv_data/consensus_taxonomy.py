@@ -3,43 +3,163 @@ import argparse
 from argparse import ArgumentParser
 import pandas as pd
 from clean_asv_data.__main__ import (
+    _read_clustfile,
     generate_reader,
+    multiple_countsfiles,
     read_clustfile,
     read_config,
-    read_metadata,)
+    read_metadata,
+    share_categories,
+)
+from clean_asv_data.partials import write_partial, load_partials, scan_countsfiles
+from clean_asv_data.presence import PresenceIndexBuilder
+from clean_asv_data.libsize import LibrarySizeBuilder
 import tqdm
 import sys
+import hashlib
+import heapq
+import json
+import os
+import sqlite3
+import shutil
+import tempfile
+import time
 from collections import defaultdict
+import numpy as np
 
 
-def find_consensus_taxonomies(
-    clustdf, clust_column, ranks, consensus_ranks, consensus_threshold
-):
-    cluster_taxonomies = {}
-    cons_ranks_reversed = consensus_ranks.copy()
-    cons_ranks_reversed.reverse()
-    for cluster in tqdm.tqdm(
-        clustdf[clust_column].unique(),
-        desc="finding consensus taxonomies",
-        unit=" clusters",
-    ):
-        rows = clustdf.loc[clustdf[clust_column] == cluster]
-        lineage = {cluster: defaultdict(lambda: "unresolved")}
-        lineage[cluster].update({rank: "unresolved" for rank in ranks})
-        taxlabel = "unresolved"
-        for rank in cons_ranks_reversed:
+class ConsensusCache:
+    """
+    Persistent cache of resolved cluster taxonomies, stored in an sqlite
+    database. Clusters are keyed by a hash of their member ASVs, rank labels
+    and ASV sums together with the consensus parameters, so that a cluster is
+    only resolved again if any of these change. When the cache holds more than
+    <max_entries> clusters the least recently used ones are evicted.
+    """
+
+    def __init__(self, f, max_entries=1000000):
+        self.f = f
+        self.max_entries = max_entries
+        self.hits = self.misses = 0
+        self._used = []
+        self._new = []
+        self.con = sqlite3.connect(f)
+        self.con.execute(
+            "CREATE TABLE IF NOT EXISTS consensus "
+            "(key TEXT PRIMARY KEY, lineage TEXT, used INTEGER)"
+        )
+
+    @staticmethod
+    def key(rows, columns, params):
+        """
+        Hashes member ASVs, their <columns> and the consensus <params>
+        """
+        return ConsensusCache.keys(rows, columns, [params])[0]
+
+    @staticmethod
+    def keys(rows, columns, params_list):
+        """
+        Returns one key for each set of consensus parameters in <params_list>,
+        hashing the cluster rows only once
+        """
+        rows_hash = pd.util.hash_pandas_object(
+            rows.loc[:, columns], index=True
+        ).to_numpy()
+        keys = []
+        for params in params_list:
+            h = hashlib.sha1(json.dumps(params).encode())
+            h.update(rows_hash)
+            keys.append(h.hexdigest())
+        return keys
+
+    def get(self, key):
+        row = self.con.execute(
+            "SELECT lineage FROM consensus WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._used.append(key)
+        return json.loads(row[0])
+
+    def put(self, key, lineage):
+        self._new.append((key, json.dumps(lineage)))
+
+    def close(self):
+        """
+        Stores new results, marks used results and evicts old ones
+        """
+        used = time.time_ns()
+        with self.con:
+            self.con.executemany(
+                "INSERT OR REPLACE INTO consensus VALUES (?, ?, ?)",
+                [(key, lineage, used) for key, lineage in self._new],
+            )
+            self.con.executemany(
+                "UPDATE consensus SET used = ? WHERE key = ?",
+                [(used, key) for key in self._used],
+            )
+            self.con.execute(
+                "DELETE FROM consensus WHERE key IN (SELECT key FROM consensus "
+                "ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+        n_entries = self.con.execute("SELECT COUNT(*) FROM consensus").fetchone()[0]
+        self.con.close()
+        sys.stderr.write(
+            "####\n"
+            f"Consensus cache {self.f}: {self.hits} hits, {self.misses} misses, "
+            f"{n_entries} clusters cached\n"
+        )
+
+
+def resolve_cluster(rows, ranks, cons_ranks_reversed, consensus_threshold):
+    """
+    Resolves the consensus taxonomy of the ASVs of a single cluster
+
+    :param rows: Dataframe with ASVs of the cluster
+    :param ranks: Ranks to include in the output
+    :param cons_ranks_reversed: Ranks used for consensus, lowest rank first
+    :param consensus_threshold: Threshold (in %) for assigning taxonomy
+    :return: dictionary with taxonomic label for each rank
+    """
+    return resolve_cluster_thresholds(
+        rows, ranks, cons_ranks_reversed, [consensus_threshold]
+    )[consensus_threshold]
+
+
+def resolve_cluster_thresholds(rows, ranks, cons_ranks_reversed, thresholds):
+    """
+    Resolves the consensus taxonomy of the ASVs of a single cluster at several
+    thresholds. Percentages of rank labels are calculated once per rank and
+    only for the ranks needed to resolve the cluster at all thresholds.
+
+    :param rows: Dataframe with ASVs of the cluster
+    :param ranks: Ranks to include in the output
+    :param cons_ranks_reversed: Ranks used for consensus, lowest rank first
+    :param thresholds: Thresholds (in %) for assigning taxonomy
+    :return: dictionary with a taxonomy dictionary for each threshold
+    """
+    percents = {}
+
+    def rank_percent(rank):
+        if rank not in percents:
             # Sum ASV sums up to rank
-            rank_sums = rows.groupby(rank).sum(numeric_only=True)
+            rank_sums = rows.groupby(rank, observed=True).sum(numeric_only=True)
             # Calculate percent for rank labels
-            rank_sums_percent = rank_sums.div(rank_sums.sum()) * 100
-            # Sort percent values in descending order
-            rank_sums_percent.sort_values("ASV_sum", ascending=False, inplace=True)
-            # Create a list <above_thresh> of number of labels at or above threshold
-            above_thresh = list(
-                rank_sums_percent.loc[
-                    rank_sums_percent["ASV_sum"] >= consensus_threshold
-                ].index
-            )
+            percents[rank] = (rank_sums.div(rank_sums.sum()) * 100)["ASV_sum"]
+        return percents[rank]
+
+    taxonomies = {}
+    for consensus_threshold in thresholds:
+        lineage = {0: defaultdict(lambda: "unresolved")}
+        lineage[0].update({rank: "unresolved" for rank in ranks})
+        taxlabel = "unresolved"
+        for rank in cons_ranks_reversed:
+            # Labels at or above threshold
+            percent = rank_percent(rank)
+            above_thresh = list(percent.loc[percent >= consensus_threshold].index)
             # If only one assignment is above threshold, use this lineage to resolve taxonomy
             if len(above_thresh) == 1:
                 taxlabel = above_thresh[0]
@@ -49,21 +169,105 @@ def find_consensus_taxonomies(
                     .to_dict(orient="index")
                 )
                 break
-        cluster_taxonomies[cluster] = list(lineage.values())[0]
+        taxonomy = dict(list(lineage.values())[0])
         ranks_below = cons_ranks_reversed[0 : cons_ranks_reversed.index(rank)]
         if taxlabel == "unresolved":
             prefix = ""
         else:
             prefix = "unresolved."
         for r in ranks_below:
-            cluster_taxonomies[cluster][r] = f"{prefix}{taxlabel}"
-    return pd.DataFrame(cluster_taxonomies).T
+            taxonomy[r] = f"{prefix}{taxlabel}"
+        taxonomies[consensus_threshold] = taxonomy
+    return taxonomies
+
 
+def find_consensus_taxonomies(
+    clustdf, clust_column, ranks, consensus_ranks, consensus_threshold, cache=None
+):
+    """
+    Resolves consensus taxonomies for all clusters in <clustdf>
 
-def sum_asvs(countsfile, blanks=None, chunksize=None, nrows=None):
+    If a ConsensusCache is given, clusters whose members, labels and ASV sums
+    are unchanged since a previous run are taken from the cache.
+
+    If <consensus_threshold> is a list, clusters are resolved at each
+    threshold from the same label percentages and a dictionary with a
+    dataframe for each threshold is returned.
+    """
+    thresholds = consensus_threshold
+    if not isinstance(consensus_threshold, list):
+        thresholds = [consensus_threshold]
+    cluster_taxonomies = {t: {} for t in thresholds}
+    cons_ranks_reversed = consensus_ranks.copy()
+    cons_ranks_reversed.reverse()
+    key_columns = ["ASV_sum"] + list(dict.fromkeys(ranks + consensus_ranks))
+    params = [[t, ranks, consensus_ranks] for t in thresholds]
+    for cluster, rows in tqdm.tqdm(
+        clustdf.groupby(clust_column, sort=False, dropna=False, observed=True),
+        desc="finding consensus taxonomies",
+        unit=" clusters",
+    ):
+        if cache is not None:
+            keys = cache.keys(rows, key_columns, params)
+            taxonomies = {t: cache.get(key) for t, key in zip(thresholds, keys)}
+            missing = [t for t in thresholds if taxonomies[t] is None]
+            if len(missing) > 0:
+                resolved = resolve_cluster_thresholds(
+                    rows, ranks, cons_ranks_reversed, missing
+                )
+                for t, key in zip(thresholds, keys):
+                    if t in resolved:
+                        taxonomies[t] = resolved[t]
+                        cache.put(key, resolved[t])
+        else:
+            taxonomies = resolve_cluster_thresholds(
+                rows, ranks, cons_ranks_reversed, thresholds
+            )
+        for t in thresholds:
+            cluster_taxonomies[t][cluster] = taxonomies[t]
+    resolved = {t: pd.DataFrame(cluster_taxonomies[t]).T for t in thresholds}
+    if not isinstance(consensus_threshold, list):
+        return resolved[consensus_threshold]
+    return resolved
+
+
+def sum_asvs(
+    countsfile,
+    blanks=None,
+    chunksize=None,
+    nrows=None,
+    shard=None,
+    partial=None,
+    presence_index=None,
+    prefetch=0,
+    library_index=None,
+):
+    """
+    Sums counts of ASVs across all non-blank samples
+
+    If <partial> is given the sums are also written to this file so that they
+    can be merged with sums from other row or column shards. If
+    <presence_index> is given, a presence index is built during the scan.
+    If <library_index> is given, per-sample read depth and richness are
+    written to this file.
+    """
     if blanks is None:
         blanks = []
-    reader = generate_reader(f=countsfile, chunksize=chunksize, nrows=nrows)
+    reader = generate_reader(
+        f=countsfile,
+        chunksize=chunksize,
+        nrows=nrows,
+        shard=shard,
+        prefetch=prefetch,
+    )
+    builder = None
+    if presence_index is not None:
+        builder = PresenceIndexBuilder(countsfile, shard=shard, nrows=nrows)
+        reader = builder.track(reader)
+    lib_builder = None
+    if library_index is not None:
+        lib_builder = LibrarySizeBuilder(countsfile, shard=shard, nrows=nrows)
+        reader = lib_builder.track(reader)
     asv_sum = pd.DataFrame()
     for df in tqdm.tqdm(reader, unit="chunks"):
         _asv_sum = pd.DataFrame(
@@ -71,12 +275,255 @@ def sum_asvs(countsfile, blanks=None, chunksize=None, nrows=None):
             columns=["ASV_sum"],
         )
         asv_sum = pd.concat([asv_sum, _asv_sum])
+    if builder is not None:
+        builder.save(presence_index)
+    if lib_builder is not None:
+        lib_builder.save(library_index)
+    if partial is not None:
+        sys.stderr.write(f"Writing partial aggregates to {partial}\n")
+        write_partial(
+            partial,
+            "asv_sum",
+            {"asv_sum": asv_sum},
+            params={"blanks": sorted(blanks)},
+            source={"countsfile": countsfile, "shard": shard, "nrows": nrows},
+        )
     return asv_sum.sort_values(by="ASV_sum", ascending=False)
 
 
+def _spill(chunks, files, key):
+    """
+    Writes dataframe <chunks> to <files> by a hash of <key>(chunk), so that
+    rows with the same key end up in the same file
+    """
+    has_header = [False] * len(files)
+    fhs = [open(f, "w") for f in files]
+    try:
+        for df in chunks:
+            part = pd.util.hash_pandas_object(key(df), index=False)
+            for i, _df in df.groupby((part % len(files)).values):
+                _df.to_csv(fhs[i], sep="\t", header=not has_header[i])
+                has_header[i] = True
+    finally:
+        for fh in fhs:
+            fh.close()
+    return files
+
+
+def _dedupe_spill_files(files):
+    """
+    Reads spill files partitioned by ASV one at a time and yields their rows,
+    keeping for each ASV only the rows of the first clustfile it was found in
+    """
+    for f in files:
+        if os.path.getsize(f) == 0:
+            os.remove(f)
+            continue
+        # Values are kept as strings to write them back unchanged
+        df = pd.read_csv(f, sep="\t", index_col=0, header=0, dtype=str)
+        os.remove(f)
+        n = df["_file"].astype(int)
+        first = n.groupby(level=0).transform("min")
+        yield df.loc[n == first].drop(columns="_file")
+
+
+def partition_clusters(
+    clustfiles,
+    labels,
+    clust_column,
+    spill_dir,
+    partitions=64,
+    asv_sum=None,
+    chunksize=100000,
+):
+    """
+    Writes the ASV records of <clustfiles> to <partitions> spill files by a
+    hash of their cluster, so that all ASVs of a cluster end up in the same
+    file. Clustfiles are read <chunksize> rows at a time.
+
+    ASV sums are taken from <asv_sum> if given (ASVs not in <asv_sum> are
+    dropped), otherwise from the ASV_sum column of the clustfiles. The
+    position of each ASV in <asv_sum> (or the clustfiles) is stored in an
+    '_order' column so that partitions can be put in the same row order as
+    the in-memory clustdf.
+
+    ASVs are only deduplicated across files, as when reading them into
+    memory. With several clustfiles the records are first spilled by a hash
+    of the ASV id, and each of these files is deduplicated on its own before
+    the records are spilled by cluster.
+
+    :return: list of spill files
+    """
+    columns = list(dict.fromkeys(labels))
+    if asv_sum is None:
+        columns = ["ASV_sum"] + columns
+    else:
+        position = pd.Series(np.arange(asv_sum.shape[0]), index=asv_sum.index)
+    dedupe = len(clustfiles) > 1
+
+    def read_chunks():
+        offset = 0
+        for n, f in enumerate(clustfiles):
+            sys.stderr.write("####\n" f"Partitioning ASV clusters from {f}\n")
+            index_name = pd.read_csv(f, sep="\t", index_col=0, nrows=0).index.name
+            reader = pd.read_csv(
+                f,
+                sep="\t",
+                index_col=0,
+                header=0,
+                usecols=[index_name] + columns,
+                dtype={c: str for c in labels},
+                chunksize=chunksize,
+            )
+            for df in tqdm.tqdm(reader, unit=" chunks"):
+                if asv_sum is None:
+                    df = df.assign(_order=np.arange(offset, offset + df.shape[0]))
+                    offset += df.shape[0]
+                else:
+                    df = df.loc[df.index.isin(asv_sum.index)]
+                    df = df.assign(
+                        ASV_sum=asv_sum.loc[df.index, "ASV_sum"].values,
+                        _order=position.loc[df.index].values,
+                    )
+                if dedupe:
+                    df = df.assign(_file=n)
+                yield df
+
+    chunks = read_chunks()
+    if dedupe:
+        asv_files = [
+            os.path.join(spill_dir, f"asvs.{i}.tsv") for i in range(partitions)
+        ]
+        _spill(chunks, asv_files, key=lambda df: df.index.to_series())
+        chunks = _dedupe_spill_files(asv_files)
+    files = [os.path.join(spill_dir, f"partition.{i}.tsv") for i in range(partitions)]
+    return _spill(chunks, files, key=lambda df: df[clust_column])
+
+
+def stream_consensus_taxonomies(
+    clustfiles,
+    clust_column,
+    ranks,
+    consensus_ranks,
+    thresholds,
+    outputs,
+    spill_dir,
+    partitions=64,
+    asv_sum=None,
+    chunksize=100000,
+    cache=None,
+):
+    """
+    Resolves consensus taxonomies without holding all ASVs in memory: ASVs
+    are partitioned by cluster into spill files, partitions are resolved one
+    at a time and the sorted results of each partition are merged into the
+    output files, giving the same output as the in-memory mode.
+
+    :param outputs: Function that arranges the resolved taxonomies of each
+    threshold into a dictionary of output files and dataframes
+    """
+    labels = [clust_column] + ranks + consensus_ranks
+    files = partition_clusters(
+        clustfiles,
+        labels,
+        clust_column,
+        spill_dir,
+        partitions=partitions,
+        asv_sum=asv_sum,
+        chunksize=chunksize,
+    )
+    results = defaultdict(list)
+    headers = {}
+    n_asvs = n_clusters = 0
+    for i, f in enumerate(files):
+        if os.path.getsize(f) == 0:
+            continue
+        # Spill files are read directly, not through the shared input cache
+        clustdf = _read_clustfile(f, sep="\t", categorical=labels)
+        os.remove(f)
+        clustdf = clustdf.sort_values("_order", kind="stable")
+        clustdf = clustdf.loc[:, ["ASV_sum", clust_column] + ranks]
+        n_asvs += clustdf.shape[0]
+        n_clusters += len(clustdf[clust_column].unique())
+        resolved = find_consensus_taxonomies(
+            clustdf=clustdf,
+            clust_column=clust_column,
+            ranks=ranks,
+            consensus_ranks=consensus_ranks,
+            consensus_threshold=thresholds,
+            cache=cache,
+        )
+        del clustdf
+        for df in resolved.values():
+            df.index.name = "cluster"
+            df.sort_index(inplace=True)
+        for j, (output, df) in enumerate(outputs(resolved).items()):
+            result = os.path.join(spill_dir, f"result.{i}.{j}.tsv")
+            df.to_csv(result, sep="\t", header=False)
+            results[output].append(result)
+            headers[output] = "\t".join([df.index.name] + list(df.columns)) + "\n"
+    sys.stderr.write(
+        "####\n"
+        f"Resolved {n_asvs} ASVs in {n_clusters} clusters from {partitions} partitions\n"
+    )
+    for output, result_files in results.items():
+        merge_sorted_results(result_files, headers[output], output)
+
+
+def merge_sorted_results(files, header, output):
+    """
+    Merges result files that are each sorted by cluster into one sorted output,
+    reading one line at a time from each file. Missing clusters (empty first
+    field) are placed last, as by DataFrame.sort_index.
+    """
+    fhins = [open(f, "r") for f in files]
+    try:
+        with open(output, "w") if output else sys.stdout as fhout:
+            fhout.write(header)
+            for line in heapq.merge(*fhins, key=_cluster_sort_key):
+                fhout.write(line)
+    finally:
+        for fh in fhins:
+            fh.close()
+            os.remove(fh.name)
+
+
+def _cluster_sort_key(line):
+    cluster = line.split("\t", 1)[0]
+    return (cluster == "", cluster)
+
+
+def arrange_outputs(resolved, thresholds, threshold_output, output):
+    """
+    Arranges the resolved taxonomies of each threshold into output tables
+
+    :return: dictionary of output files (None for stdout) and dataframes
+    """
+    if len(thresholds) == 1:
+        return {output: resolved[thresholds[0]]}
+    if threshold_output == "files":
+        # One file per threshold, named like the output of each dataset in
+        # clean-asv-data
+        outdir = os.path.dirname(output)
+        basename = os.path.basename(output)
+        return {
+            os.path.join(outdir, f"{t}.{basename}"): resolved[t] for t in thresholds
+        }
+    # One wide table with the ranks at each threshold
+    return {
+        output: pd.concat(
+            [resolved[t].add_suffix(f"_{t}") for t in thresholds], axis=1
+        )
+    }
+
+
 def main(args):
     if args.configfile:
         args = read_config(args.configfile, args)
+    countsfiles = multiple_countsfiles(
+        args,
+        unsupported=["shard", "write_partial", "presence_index", "library_index"],
+    )
     blanks = None
     if args.metadata:
         metadata = read_metadata(args.metadata, index_name=args.metadata_index_name)
@@ -88,22 +535,107 @@ def main(args):
             sys.stderr.write("####\n" f"Found {len(blanks)} blanks in metadata\n")
         else:
             blanks = []
+    if args.write_partial:
+        sys.stderr.write("####\n Summing counts for ASVs\n")
+        sum_asvs(
+            countsfile=args.countsfile,
+            blanks=blanks,
+            chunksize=args.chunksize,
+            nrows=args.nrows,
+            shard=args.shard,
+            partial=args.write_partial,
+            presence_index=args.presence_index,
+            prefetch=args.prefetch,
+            library_index=args.library_index,
+        )
+        return
+    thresholds = args.consensus_threshold
+    if not isinstance(thresholds, list):
+        thresholds = [thresholds]
+    if len(thresholds) > 1 and args.threshold_output == "files" and not args.output:
+        sys.exit("ERROR: --threshold_output files requires --output")
+    asv_sum = None
+    if args.countsfile or args.from_partials:
+        if args.from_partials:
+            asv_sum = load_partials(args.from_partials, kind="asv_sum")
+        elif countsfiles:
+            asv_sum = scan_countsfiles(
+                countsfiles,
+                lambda countsfile, partial: sum_asvs(
+                    countsfile=countsfile,
+                    blanks=blanks,
+                    chunksize=args.chunksize,
+                    nrows=args.nrows,
+                    partial=partial,
+                    prefetch=args.prefetch,
+                ),
+                kind="asv_sum",
+                threads=args.threads,
+            )
+        else:
+            sys.stderr.write("####\n Summing counts for ASVs\n")
+            asv_sum = sum_asvs(
+                countsfile=args.countsfile,
+                blanks=blanks,
+                chunksize=args.chunksize,
+                nrows=args.nrows,
+                shard=args.shard,
+                presence_index=args.presence_index,
+                prefetch=args.prefetch,
+                library_index=args.library_index,
+            )
+    cache = None
+    if args.cache:
+        cache = ConsensusCache(args.cache, max_entries=args.cache_size)
+
+    def outputs(resolved):
+        return arrange_outputs(
+            resolved, thresholds, args.threshold_output, args.output
+        )
+
+    if args.spill_dir:
+        sys.stderr.write(
+            "####\n"
+            f"Resolving taxonomies using {', '.join(str(t) for t in thresholds)}% "
+            f"majority rule threshold in {args.partitions} partitions\n"
+        )
+        os.makedirs(args.spill_dir, exist_ok=True)
+        spill_dir = tempfile.mkdtemp(prefix="consensus.", dir=args.spill_dir)
+        try:
+            stream_consensus_taxonomies(
+                clustfiles=args.clustfile,
+                clust_column=args.clust_column,
+                ranks=args.ranks,
+                consensus_ranks=args.consensus_ranks,
+                thresholds=thresholds,
+                outputs=outputs,
+                spill_dir=spill_dir,
+                partitions=args.partitions,
+                asv_sum=asv_sum,
+                chunksize=args.chunksize,
+                cache=cache,
+            )
+        finally:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+        if cache is not None:
+            cache.close()
+        return
+    labels = [args.clust_column] + args.ranks + args.consensus_ranks
+    columns = labels
+    if asv_sum is None:
+        columns = ["ASV_sum"] + labels
     clustdf = pd.DataFrame()
     for f in args.clustfile:
         sys.stderr.write("####\n" f"Reading ASV clusters from {f}\n")
-        _clustdf = read_clustfile(f, sep="\t")
+        _clustdf = read_clustfile(f, sep="\t", columns=columns, categorical=labels)
         # extract ASVs not in clustdf
         if clustdf.shape[0] > 0:
             _clustdf = _clustdf.loc[~_clustdf.index.isin(clustdf.index), :]
         clustdf = pd.concat([clustdf, _clustdf])
-    if args.countsfile:
-        sys.stderr.write("####\n Summing counts for ASVs\n")
-        asv_sum = sum_asvs(
-            countsfile=args.countsfile,
-            blanks=blanks,
-            chunksize=args.chunksize,
-            nrows=args.nrows,
-        )
+    if len(args.clustfile) > 1:
+        # Labels from different files are combined into one dictionary
+        clustdf = share_categories(clustdf, list(dict.fromkeys(labels)))
+    if asv_sum is not None:
         clustdf = clustdf.loc[:, [args.clust_column] + args.ranks]
         clustdf = pd.merge(asv_sum, clustdf, left_index=True, right_index=True)
     else:
@@ -114,24 +646,76 @@ def main(args):
     )
     sys.stderr.write(
         "####\n"
-        f"Resolving taxonomies using {args.consensus_threshold}% majority rule threshold\n"
+        f"Resolving taxonomies using {', '.join(str(t) for t in thresholds)}% "
+        "majority rule threshold\n"
     )
     resolved = find_consensus_taxonomies(
         clustdf=clustdf,
         clust_column=args.clust_column,
         ranks=args.ranks,
         consensus_ranks=args.consensus_ranks,
-        consensus_threshold=args.consensus_threshold,
+        consensus_threshold=thresholds,
+        cache=cache,
     )
-    resolved.index.name = "cluster"
-    resolved.sort_index(inplace=True)
-    with sys.stdout as fhout:
-        resolved.to_csv(fhout, sep="\t")
+    if cache is not None:
+        cache.close()
+    for df in resolved.values():
+        df.index.name = "cluster"
+        df.sort_index(inplace=True)
+    for output, df in outputs(resolved).items():
+        with open(output, "w") if output else sys.stdout as fhout:
+            df.to_csv(fhout, sep="\t")
 
 
-def main_cli():
+def build_parser():
     parser = ArgumentParser()
-    parser.add_argument("--countsfile", type=str, help="Counts file of ASVs")
+    parser.add_argument(
+        "--countsfile",
+        type=str,
+        nargs="+",
+        help="Counts file of ASVs. Several files (or glob patterns) with different "
+        "samples are read in parallel as one counts matrix joined on ASV ids",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="Number of countsfiles to read at the same time when several are "
+        "given (default: all)",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Write consensus taxonomies of clusters to this file instead of stdout",
+    )
+    parser.add_argument(
+        "--presence_index",
+        type=str,
+        help="Write a presence/absence index of ASVs in samples to this file "
+        "while reading the countsfile. Can be queried with query-presence",
+    )
+    parser.add_argument(
+        "--library_index",
+        type=str,
+        help="Write total reads and richness of each sample to this file while reading the countsfile",
+    )
+    parser.add_argument(
+        "--write_partial",
+        type=str,
+        help="Only sum ASV counts and write them to this partial aggregate file. "
+        "Partials from several shards can be combined with merge-partials",
+    )
+    parser.add_argument(
+        "--from_partials",
+        type=str,
+        nargs="+",
+        help="Use (merged) partial aggregate files instead of reading the countsfile",
+    )
+    parser.add_argument(
+        "--shard",
+        type=str,
+        help="Only read row shard <k> of <n> from the countsfile, e.g. '2/4'. "
+        "Use together with --write_partial",
+    )
     parser.add_argument(
         "--clustfile",
         type=str,
@@ -195,8 +779,19 @@ def main_cli():
     parser.add_argument(
         "--consensus_threshold",
         type=int,
+        nargs="+",
         default=80,
-        help="Threshold (in %%) at which to assign taxonomy to a cluster (default: 80))",
+        help="Threshold (in %%) at which to assign taxonomy to a cluster (default: 80)). "
+        "Several thresholds can be given to resolve clusters at all of them in one run",
+    )
+    parser.add_argument(
+        "--threshold_output",
+        type=str,
+        choices=["wide", "files"],
+        default="wide",
+        help="With several thresholds, write one table with '<rank>_<threshold>' "
+        "columns ('wide', default) or one file per threshold named "
+        "'<threshold>.<output>' ('files', requires --output)",
     )
     parser.add_argument(
         "--consensus_ranks",
@@ -204,12 +799,49 @@ def main_cli():
         default=["Family", "Genus", "Species", "BOLD_bin"],
         help="Ranks to use for calculating consensus. Must be present in the clustfile (default: Family Genus Species BOLD_bin))",
     )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        help="Cache file (sqlite) of resolved cluster taxonomies. Clusters that "
+        "are unchanged since a previous run are taken from the cache",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=int,
+        default=1000000,
+        help="Maximum number of clusters to keep in the cache, least recently "
+        "used clusters are evicted (default: 1000000)",
+    )
+    parser.add_argument(
+        "--spill_dir",
+        type=str,
+        help="Resolve taxonomies in streaming mode: partition ASVs by cluster "
+        "into temporary files under this directory and resolve one partition at "
+        "a time, so that the clustfile(s) do not have to fit in memory",
+    )
+    parser.add_argument(
+        "--partitions",
+        type=int,
+        default=64,
+        help="Number of cluster partitions in streaming mode (default: 64)",
+    )
     parser.add_argument(
         "--chunksize",
         type=int,
         default=10000,
-        help="If countsfile is very large, specify chunksize to read it in a number of lines at a time",
+        help="If countsfile is very large, specify chunksize to read it in a number of lines at a time. "
+        "Also used for reading clustfiles in streaming mode",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        help="Number of chunks to read ahead from the countsfile in a background "
+        "thread (default 0, no prefetching)",
     )
     parser.add_argument("--nrows", type=int, help=argparse.SUPPRESS)
-    args = parser.parse_args()
+    return parser
+
+
+def main_cli():
+    args = build_parser().parse_args()
     main(args)
@@ -5,11 +5,22 @@ from argparse import ArgumentParser
 import pandas as pd
 import tqdm
 from clean_asv_data.__main__ import (
+    AsvDictionary,
+    UnsortedInputError,
+    file_fingerprint,
     generate_reader,
+    merge_join,
+    multiple_countsfiles,
+    read_sorted_column,
     read_clustfile,
     read_config,
     read_metadata,
 )
+from clean_asv_data.checkpoint import Checkpoint, digest
+from clean_asv_data.partials import write_partial, load_partials, scan_countsfiles
+from clean_asv_data.presence import PresenceIndexBuilder
+from clean_asv_data.libsize import LibrarySizeBuilder
+from clean_asv_data.sparse import SPARSE_FORMATS, read_taxonomy, write_sparse
 
 
 def sum_clusters(
@@ -20,6 +31,15 @@ def sum_clusters(
     subset=None,
     chunksize=None,
     nrows=None,
+    shard=None,
+    partial=None,
+    presence_index=None,
+    clustfile=None,
+    prefetch=0,
+    library_index=None,
+    checkpoint=None,
+    resume=False,
+    checkpoint_interval=600,
 ):
     """
     Calculates sums of clusters in each sample
@@ -29,34 +49,161 @@ def sum_clusters(
     :param clust_column: column name of cluster designation
     :param chunksize: Number of rows to read at a time from the countsfile
     :param nrows: Number of total rows to read (development)
+    :param shard: Only read this row shard ('<k>/<n>') of the countsfile
+    :param partial: Also write the sums to this partial aggregate file
+    :param presence_index: Also write a presence index of ASVs to this file
+    :param prefetch: Number of chunks to read ahead in a background thread
+    :param library_index: Also write read depth and richness of samples to this file
+    :param clustfile: If given, read cluster membership from this clustfile
+    in lockstep with the countsfile instead of using <clustdf>. Both files must
+    be sorted by ASV id, otherwise UnsortedInputError is raised
+    :param checkpoint: Save the sums to this file every <checkpoint_interval>
+    seconds
+    :param resume: Continue reading from the last checkpoint in <checkpoint>
     :return: Dataframe with summed counts per cluster
     """
     if blanks is None:
         blanks = []
     if subset is None:
         subset = []
-    reader = generate_reader(f=countsfile, chunksize=chunksize, nrows=nrows)
+    builder = None
+    if presence_index is not None:
+        builder = PresenceIndexBuilder(countsfile, shard=shard, nrows=nrows)
+    lib_builder = None
+    if library_index is not None:
+        lib_builder = LibrarySizeBuilder(countsfile, shard=shard, nrows=nrows)
     cluster_sum = pd.DataFrame()
-    for df in tqdm.tqdm(reader, desc="reading counts", unit=" chunks"):
-        if len(subset) > 0:
-            subset_intersection = list(set(subset).intersection(set(df.columns)))
-            df = df.loc[:, subset_intersection]
-        merged = pd.merge(
-            clustdf.loc[:, clust_column],
-            df.drop(blanks, axis=1, errors="ignore"),
-            left_index=True,
-            right_index=True,
+    if clustfile is None:
+        # Intern ASV ids and cluster names so that chunks are joined to clusters
+        # by integer codes
+        clustdf = clustdf.loc[~clustdf.index.duplicated(), clust_column]
+        asvs = AsvDictionary(clustdf.index)
+        clusters = pd.Categorical(clustdf)
+    ckpt = None
+    if checkpoint is not None:
+        ckpt = Checkpoint(
+            checkpoint,
+            countsfile,
+            params={
+                "clust_column": clust_column,
+                "clusters": file_fingerprint(clustfile)
+                if clustfile is not None
+                else digest(clustdf.index.astype(str) + "\t" + clustdf.astype(str)),
+                "blanks": sorted(blanks),
+                "subset": sorted(subset),
+                "nrows": nrows,
+                "shard": shard,
+                "presence_index": presence_index,
+                "library_index": library_index,
+            },
+            interval=checkpoint_interval,
+        )
+        state = ckpt.load() if resume else None
+        if state is not None:
+            cluster_sum = state["cluster_sum"]
+            builder, lib_builder = state["builder"], state["lib_builder"]
+    reader = generate_reader(
+        f=countsfile,
+        chunksize=chunksize,
+        nrows=nrows,
+        shard=shard,
+        prefetch=prefetch,
+        skip_rows=0 if ckpt is None else ckpt.rows,
+    )
+    if builder is not None:
+        reader = builder.track(reader)
+    if lib_builder is not None:
+        reader = lib_builder.track(reader)
+
+    def update_checkpoint(n_rows):
+        if ckpt is not None:
+            ckpt.update(
+                n_rows,
+                lambda: {
+                    "cluster_sum": cluster_sum,
+                    "builder": builder,
+                    "lib_builder": lib_builder,
+                },
+            )
+
+    if clustfile is not None:
+        # Walk the sorted countsfile and clustfile in lockstep
+        joined = merge_join(
+            reader, read_sorted_column(clustfile, clust_column, chunksize=chunksize)
+        )
+        for df, clusters in tqdm.tqdm(joined, desc="reading counts", unit=" chunks"):
+            n_rows = df.shape[0]
+            if len(subset) > 0:
+                subset_intersection = list(set(subset).intersection(set(df.columns)))
+                df = df.loc[:, subset_intersection]
+            df = df.drop(blanks, axis=1, errors="ignore")
+            _cluster_sum = df.groupby(clusters).sum(numeric_only=True)
+            cluster_sum = cluster_sum.add(_cluster_sum, fill_value=0)
+            update_checkpoint(n_rows)
+    else:
+        for df in tqdm.tqdm(reader, desc="reading counts", unit=" chunks"):
+            n_rows = df.shape[0]
+            if len(subset) > 0:
+                subset_intersection = list(set(subset).intersection(set(df.columns)))
+                df = df.loc[:, subset_intersection]
+            df = asvs.intern(df.drop(blanks, axis=1, errors="ignore"))
+            cluster_codes = clusters.codes[df.index]
+            df = df.loc[cluster_codes >= 0]
+            _cluster_sum = df.groupby(cluster_codes[cluster_codes >= 0]).sum(
+                numeric_only=True
+            )
+            cluster_sum = cluster_sum.add(_cluster_sum, fill_value=0)
+            update_checkpoint(n_rows)
+        if cluster_sum.shape[0] > 0:
+            cluster_sum.index = clusters.categories[cluster_sum.index]
+    cluster_sum.index.name = clust_column
+    if ckpt is not None:
+        ckpt.finish()
+    if builder is not None:
+        builder.save(presence_index)
+    if lib_builder is not None:
+        lib_builder.save(library_index)
+    if partial is not None:
+        sys.stderr.write(f"Writing partial aggregates to {partial}\n")
+        write_partial(
+            partial,
+            "cluster_sum",
+            {"cluster_sum": cluster_sum},
+            params={
+                "clust_column": clust_column,
+                "blanks": sorted(blanks),
+                "subset": sorted(subset),
+            },
+            source={"countsfile": countsfile, "shard": shard, "nrows": nrows},
         )
-        _cluster_sum = merged.groupby(clust_column).sum(numeric_only=True)
-        cluster_sum = cluster_sum.add(_cluster_sum, fill_value=0)
     return cluster_sum
 
 
+def top_clusters(cluster_sum, top, top_by="reads"):
+    """
+    Selects the <top> clusters with most reads, or highest occurrence (number
+    of samples with reads), in descending order without sorting all clusters
+    """
+    if top_by == "occurrence":
+        stat = cluster_sum.gt(0).sum(axis=1)
+    else:
+        stat = cluster_sum.sum(axis=1)
+    return cluster_sum.loc[stat.nlargest(top).index]
+
+
 def main(args):
     # Read config
     args = read_config(args.configfile, args)
-    sys.stderr.write(f"Reading {args.clustfile}\n")
-    clustdf = read_clustfile(args.clustfile)
+    if args.output_format in SPARSE_FORMATS and not args.output:
+        sys.exit(f"ERROR: --output_format {args.output_format} requires --output")
+    clustdf = None
+    if not args.from_partials and not args.merge_join:
+        sys.stderr.write(f"Reading {args.clustfile}\n")
+        clustdf = read_clustfile(
+            args.clustfile,
+            columns=[args.clust_column],
+            categorical=[args.clust_column],
+        )
     # Read metadata
     metadata = None
     subset = None
@@ -77,25 +224,114 @@ def main(args):
                 "####\n"
                 f"Found {len(subset)} samples for {args.subset_col}:{args.subset_val}\n"
             )
-    cluster_sum = sum_clusters(
-        clustdf,
-        args.countsfile,
-        args.clust_column,
-        blanks,
-        subset,
-        chunksize=args.chunksize,
-        nrows=args.nrows,
-    )
-    with sys.stdout as fhout:
+    countsfiles = multiple_countsfiles(
+        args,
+        unsupported=[
+            "shard",
+            "write_partial",
+            "presence_index",
+            "library_index",
+            "checkpoint",
+            "merge_join",
+        ],
+        # Only read the partitions with samples of the subset
+        samples=subset,
+    )
+    if args.from_partials:
+        cluster_sum = load_partials(args.from_partials, kind="cluster_sum")
+    elif countsfiles:
+        cluster_sum = scan_countsfiles(
+            countsfiles,
+            lambda countsfile, partial: sum_clusters(
+                clustdf,
+                countsfile=countsfile,
+                clust_column=args.clust_column,
+                blanks=blanks,
+                subset=subset,
+                chunksize=args.chunksize,
+                nrows=args.nrows,
+                partial=partial,
+                prefetch=args.prefetch,
+            ),
+            kind="cluster_sum",
+            threads=args.threads,
+        )
+    else:
+        kwargs = dict(
+            countsfile=args.countsfile,
+            clust_column=args.clust_column,
+            blanks=blanks,
+            subset=subset,
+            chunksize=args.chunksize,
+            nrows=args.nrows,
+            shard=args.shard,
+            partial=args.write_partial,
+            presence_index=args.presence_index,
+            prefetch=args.prefetch,
+            library_index=args.library_index,
+            checkpoint=args.checkpoint,
+            resume=args.resume,
+            checkpoint_interval=args.checkpoint_interval,
+        )
+        cluster_sum = None
+        if args.merge_join:
+            try:
+                cluster_sum = sum_clusters(None, clustfile=args.clustfile, **kwargs)
+            except UnsortedInputError as e:
+                if args.merge_join == "assert":
+                    sys.exit(f"ERROR: {e}")
+                sys.stderr.write(
+                    "####\n" f"WARNING: {e}, falling back to hash join\n"
+                )
+                sys.stderr.write(f"Reading {args.clustfile}\n")
+                clustdf = read_clustfile(
+                    args.clustfile,
+                    columns=[args.clust_column],
+                    categorical=[args.clust_column],
+                )
+        if cluster_sum is None:
+            cluster_sum = sum_clusters(clustdf, **kwargs)
+        if args.write_partial:
+            return
+    if args.top:
+        cluster_sum = top_clusters(cluster_sum, args.top, args.top_by)
+    if args.output_format in SPARSE_FORMATS:
+        taxonomy = None
+        if args.taxonomy:
+            taxonomy = read_taxonomy(args.taxonomy)
+        write_sparse(
+            cluster_sum,
+            args.output,
+            args.output_format,
+            chunksize=args.chunksize,
+            taxonomy=taxonomy,
+            row_name=args.clust_column,
+        )
+        return
+    with open(args.output, "w") if args.output else sys.stdout as fhout:
         cluster_sum.to_csv(fhout, sep="\t")
 
 
-def main_cli():
+def build_parser():
     parser = ArgumentParser()
     parser.add_argument(
         "--countsfile",
         type=str,
-        help="Tab-separated file with counts of ASVs (rows) in samples (columns)",
+        nargs="+",
+        help="Tab-separated file with counts of ASVs (rows) in samples (columns). "
+        "Several files (or glob patterns) with different samples are read in "
+        "parallel as one counts matrix joined on ASV ids",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="Number of countsfiles to read at the same time when several are "
+        "given (default: all)",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Write counts of clusters to this file instead of stdout",
     )
     parser.add_argument(
         "--clustfile",
@@ -103,6 +339,63 @@ def main_cli():
         help="Tab-separated file with ASV ids in first column and a column specifying "
         "the cluster it belongs to",
     )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        choices=["tsv"] + SPARSE_FORMATS,
+        help="Format of --output: a dense table ('tsv', default) or the non-zero "
+        "counts as a BIOM 2.1 (HDF5) table ('biom', requires h5py), a Matrix "
+        "Market file ('mtx') or (cluster, sample, value) triplets in a Parquet "
+        "file ('parquet', requires pyarrow)",
+    )
+    parser.add_argument(
+        "--taxonomy",
+        type=str,
+        help="Consensus taxonomy of clusters (output of consensus-taxonomy) to "
+        "store as observation metadata in BIOM output",
+    )
+    parser.add_argument(
+        "--presence_index",
+        type=str,
+        help="Write a presence/absence index of ASVs in samples to this file "
+        "while reading the countsfile. Can be queried with query-presence",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        help="Only output the <top> clusters with most reads (or occurrence, "
+        "see --top_by)",
+    )
+    parser.add_argument(
+        "--top_by",
+        type=str,
+        choices=["reads", "occurrence"],
+        default="reads",
+        help="Stat to rank clusters by with --top (default: 'reads')",
+    )
+    parser.add_argument(
+        "--library_index",
+        type=str,
+        help="Write total reads and richness of each sample to this file while reading the countsfile",
+    )
+    parser.add_argument(
+        "--write_partial",
+        type=str,
+        help="Only sum cluster counts and write them to this partial aggregate "
+        "file. Partials from several shards can be combined with merge-partials",
+    )
+    parser.add_argument(
+        "--from_partials",
+        type=str,
+        nargs="+",
+        help="Use (merged) partial aggregate files instead of reading the countsfile",
+    )
+    parser.add_argument(
+        "--shard",
+        type=str,
+        help="Only read row shard <k> of <n> from the countsfile, e.g. '2/4'. "
+        "Use together with --write_partial",
+    )
     parser.add_argument(
         "--metadata", type=str, help="Tab-separated file with metadata for each sample"
     )
@@ -153,11 +446,45 @@ def main_cli():
         default="cluster",
         help="Name of cluster column (default: 'cluster')",
     )
+    parser.add_argument(
+        "--merge_join",
+        type=str,
+        choices=["assert", "detect"],
+        help="Walk the countsfile and clustfile in lockstep instead of loading "
+        "the whole clustfile. Both files must be sorted by ASV id (e.g. with "
+        "LC_ALL=C sort). With 'assert' unsorted input is an error, with 'detect' "
+        "count-clusters falls back to loading the clustfile",
+    )
     parser.add_argument(
         "--chunksize",
         type=int,
         help="If countsfile is very large, specify chunksize to read it in a number of lines at a time",
     )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        help="Number of chunks to read ahead from the countsfile in a background "
+        "thread (default 0, no prefetching)",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        help="Periodically save aggregates of the countsfile scan to this file",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume the countsfile scan from the file given by --checkpoint",
+    )
+    parser.add_argument(
+        "--checkpoint_interval",
+        type=int,
+        help="Minimum number of seconds between checkpoints (default 600)",
+    )
     parser.add_argument("--nrows", type=int, help=argparse.SUPPRESS)
-    args = parser.parse_args()
+    return parser
+
+
+def main_cli():
+    args = build_parser().parse_args()
     main(args)
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+import argparse
+import os
+import sys
+from argparse import ArgumentParser
+import numpy as np
+import pandas as pd
+import tqdm
+from clean_asv_data.__main__ import (
+    AsvDictionary,
+    generate_reader,
+    multiple_countsfiles,
+    read_clustfile,
+    read_config,
+    read_metadata,
+)
+from clean_asv_data.partials import write_partial, load_partials, scan_countsfiles
+from clean_asv_data.sparse import read_taxonomy
+
+
+class LineageTree:
+    """
+    Distinct lineages (leaves) of ASVs over <ranks>, with the leaf of each
+    ASV stored as an integer code. Chunks of the countsfile are reduced to
+    sums per leaf, and the leaf sums are rolled up the hierarchy, one rank at
+    a time, once the scan is done.
+    """
+
+    def __init__(self, lineages, ranks):
+        """
+        :param lineages: Dataframe with ASV ids as index and labels of <ranks>
+        in columns. Missing labels are set to 'unclassified'
+        :param ranks: Ranks from highest to lowest
+        """
+        self.ranks = list(ranks)
+        lineages = lineages.loc[~lineages.index.duplicated(), self.ranks]
+        lineages = lineages.astype(object).fillna("unclassified").astype(str)
+        self.asvs = AsvDictionary(lineages.index)
+        codes, leaves = pd.MultiIndex.from_frame(lineages).factorize()
+        self.leaf_of = codes.astype(np.int32)
+        self.leaves = pd.MultiIndex.from_tuples(leaves, names=self.ranks)
+
+    @classmethod
+    def from_clusters(cls, clustdf, taxonomy, clust_column, ranks):
+        """
+        Builds a tree in which each ASV has the lineage of its cluster in
+        <taxonomy> (output of consensus-taxonomy)
+        """
+        clustdf = clustdf.loc[~clustdf.index.duplicated(), [clust_column]]
+        # Clusters in the taxonomy are read as strings, also numeric ones
+        clustdf[clust_column] = clustdf[clust_column].astype(str)
+        lineages = clustdf.join(taxonomy.loc[:, ranks], on=clust_column)
+        return cls(lineages.loc[:, ranks], ranks)
+
+    def __len__(self):
+        return len(self.leaves)
+
+    def reduce(self, df):
+        """
+        Sums the counts of ASVs in <df> by leaf, dropping ASVs not in the tree
+
+        :return: array of leaf codes and dataframe with sums of those leaves
+        """
+        df = self.asvs.intern(df)
+        leaf_sum = df.groupby(self.leaf_of[df.index]).sum(numeric_only=True)
+        return leaf_sum.index.to_numpy(), leaf_sum
+
+
+def rollup(leaf_sum, ranks):
+    """
+    Aggregates sums of leaves at every rank, each rank from the one below
+
+    :param leaf_sum: Dataframe with sums of leaves, indexed by lineage
+    :param ranks: Ranks from highest to lowest
+    :return: dictionary of dataframes indexed by lineage down to each rank
+    """
+    tables = {ranks[-1]: leaf_sum.sort_index()}
+    for i in range(len(ranks) - 2, -1, -1):
+        tables[ranks[i]] = tables[ranks[i + 1]].groupby(level=list(range(i + 1))).sum()
+    return {rank: tables[rank] for rank in ranks}
+
+
+def lineage_keys(index):
+    """
+    Joins the levels of a lineage index into one string per lineage, so that
+    leaf sums can be stored in a partial aggregate file
+    """
+    keys = pd.Index(["\t".join(x) for x in index])
+    keys.name = "\t".join(index.names)
+    return keys
+
+
+def split_lineage_keys(index):
+    return pd.MultiIndex.from_tuples(
+        [tuple(x.split("\t")) for x in index], names=index.name.split("\t")
+    )
+
+
+def sum_taxa(
+    tree,
+    countsfile,
+    blanks=None,
+    subset=None,
+    chunksize=None,
+    nrows=None,
+    shard=None,
+    partial=None,
+    prefetch=0,
+):
+    """
+    Calculates read sums of taxa at each rank in each sample in one pass over
+    the countsfile
+
+    :param tree: LineageTree of ASVs
+    :param countsfile: Counts of ASVs in each sample
+    :param blanks: Blank samples to exclude
+    :param subset: Only sum counts in these samples
+    :param chunksize: Number of rows to read at a time from the countsfile
+    :param nrows: Number of total rows to read (development)
+    :param shard: Only read this row shard ('<k>/<n>') of the countsfile
+    :param partial: Write the sums of leaves to this partial aggregate file
+    :param prefetch: Number of chunks to read ahead in a background thread
+    :return: Dictionary with a dataframe of summed counts for each rank
+    """
+    if blanks is None:
+        blanks = []
+    if subset is None:
+        subset = []
+    reader = generate_reader(
+        f=countsfile,
+        chunksize=chunksize,
+        nrows=nrows,
+        shard=shard,
+        prefetch=prefetch,
+    )
+    leaf_sum = None
+    seen = np.zeros(len(tree), dtype=bool)
+    columns = None
+    for df in tqdm.tqdm(reader, desc="reading counts", unit=" chunks"):
+        if len(subset) > 0:
+            df = df.loc[:, df.columns.isin(subset)]
+        df = df.drop(blanks, axis=1, errors="ignore")
+        leaves, _leaf_sum = tree.reduce(df)
+        if leaf_sum is None:
+            columns = _leaf_sum.columns
+            leaf_sum = np.zeros((len(tree), len(columns)), dtype=np.int64)
+        values = _leaf_sum.to_numpy()
+        if not np.issubdtype(values.dtype, np.integer):
+            leaf_sum = leaf_sum.astype(np.result_type(leaf_sum, values))
+        leaf_sum[leaves] += values
+        seen[leaves] = True
+    if leaf_sum is None:
+        leaf_sum = pd.DataFrame(index=tree.leaves[:0])
+    else:
+        leaf_sum = pd.DataFrame(leaf_sum[seen], index=tree.leaves[seen], columns=columns)
+    sys.stderr.write(
+        "####\n"
+        f"Summed counts of {leaf_sum.shape[0]} lineages in {leaf_sum.shape[1]} samples\n"
+    )
+    if partial is not None:
+        sys.stderr.write(f"Writing partial aggregates to {partial}\n")
+        write_partial(
+            partial,
+            "taxa_sum",
+            {"taxa_sum": leaf_sum.set_axis(lineage_keys(leaf_sum.index), axis=0)},
+            params={
+                "ranks": tree.ranks,
+                "blanks": sorted(blanks),
+                "subset": sorted(subset),
+            },
+            source={"countsfile": countsfile, "shard": shard, "nrows": nrows},
+        )
+    return rollup(leaf_sum, tree.ranks)
+
+
+def main(args):
+    args = read_config(args.configfile, args)
+    if not args.write_partial and not args.outdir:
+        sys.exit("ERROR: count-taxa requires --outdir")
+    ranks = args.ranks
+    tree = None
+    if not args.from_partials:
+        if args.taxonomy:
+            taxonomy = read_taxonomy(args.taxonomy)
+            missing = set(ranks).difference(taxonomy.columns)
+            if len(missing) > 0:
+                sys.exit(f"ERROR: Ranks {', '.join(missing)} not in {args.taxonomy}")
+            sys.stderr.write(f"Reading {args.clustfile}\n")
+            clustdf = read_clustfile(args.clustfile, columns=[args.clust_column])
+            tree = LineageTree.from_clusters(
+                clustdf, taxonomy, args.clust_column, ranks
+            )
+        else:
+            sys.stderr.write(f"Reading {args.clustfile}\n")
+            lineages = read_clustfile(args.clustfile, columns=ranks, categorical=ranks)
+            tree = LineageTree(lineages, ranks)
+        sys.stderr.write(
+            "####\n" f"Found {len(tree)} distinct lineages over {len(ranks)} ranks\n"
+        )
+    subset = None
+    blanks = None
+    if args.metadata:
+        metadata = read_metadata(args.metadata, index_name=args.metadata_index_name)
+        if not args.noblanks:
+            blanks = list(
+                metadata.loc[metadata[args.sample_type_col].isin(args.blank_val)].index
+            )
+            sys.stderr.write("####\n" f"Found {len(blanks)} blanks in metadata\n")
+        if args.subset_val:
+            subset = metadata.loc[metadata[args.subset_col] == args.subset_val].index
+            sys.stderr.write(
+                "####\n"
+                f"Found {len(subset)} samples for {args.subset_col}:{args.subset_val}\n"
+            )
+    countsfiles = multiple_countsfiles(
+        args,
+        unsupported=["shard", "write_partial"],
+        # Only read the partitions with samples of the subset
+        samples=subset,
+    )
+    kwargs = dict(
+        blanks=blanks,
+        subset=subset,
+        chunksize=args.chunksize,
+        nrows=args.nrows,
+        prefetch=args.prefetch,
+    )
+    if args.from_partials or countsfiles:
+        if args.from_partials:
+            leaf_sum = load_partials(args.from_partials, kind="taxa_sum")
+        else:
+            leaf_sum = scan_countsfiles(
+                countsfiles,
+                lambda countsfile, partial: sum_taxa(
+                    tree, countsfile=countsfile, partial=partial, **kwargs
+                ),
+                kind="taxa_sum",
+                threads=args.threads,
+            )
+        leaf_sum.index = split_lineage_keys(leaf_sum.index)
+        tables = rollup(leaf_sum, list(leaf_sum.index.names))
+    else:
+        tables = sum_taxa(
+            tree,
+            countsfile=args.countsfile,
+            shard=args.shard,
+            partial=args.write_partial,
+            **kwargs,
+        )
+        if args.write_partial:
+            return
+    os.makedirs(args.outdir, exist_ok=True)
+    for rank, df in tables.items():
+        f = os.path.join(args.outdir, f"{rank}.tsv")
+        sys.stderr.write(f"Writing {df.shape[0]} taxa at rank {rank} to {f}\n")
+        df.to_csv(f, sep="\t")
+
+
+def build_parser():
+    parser = ArgumentParser(
+        description="Sums counts of taxa at each taxonomic rank in each sample, "
+        "in one pass over the countsfile. Writes one table per rank to <outdir>"
+    )
+    parser.add_argument(
+        "--countsfile",
+        type=str,
+        nargs="+",
+        help="Tab-separated file with counts of ASVs (rows) in samples (columns). "
+        "Several files (or glob patterns) with different samples are read in "
+        "parallel as one counts matrix joined on ASV ids",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="Number of countsfiles to read at the same time when several are "
+        "given (default: all)",
+    )
+    parser.add_argument(
+        "--clustfile",
+        type=str,
+        help="Tab-separated file with ASV ids in first column and columns with "
+        "cluster designation and taxonomic ranks",
+    )
+    parser.add_argument(
+        "--taxonomy",
+        type=str,
+        help="Consensus taxonomy of clusters (output of consensus-taxonomy). If "
+        "given, ASVs are counted under the taxonomy of their cluster instead "
+        "of their own taxonomy in the clustfile",
+    )
+    parser.add_argument(
+        "--ranks",
+        nargs="+",
+        help="Ranks to sum counts for, from highest to lowest",
+    )
+    parser.add_argument(
+        "--outdir",
+        type=str,
+        help="Write counts of taxa to <outdir>/<rank>.tsv",
+    )
+    parser.add_argument(
+        "--write_partial",
+        type=str,
+        help="Only sum counts of lineages and write them to this partial "
+        "aggregate file. Partials from several shards can be combined with "
+        "merge-partials",
+    )
+    parser.add_argument(
+        "--from_partials",
+        type=str,
+        nargs="+",
+        help="Use (merged) partial aggregate files instead of reading the countsfile",
+    )
+    parser.add_argument(
+        "--shard",
+        type=str,
+        help="Only read row shard <k> of <n> from the countsfile, e.g. '2/4'. "
+        "Use together with --write_partial",
+    )
+    parser.add_argument(
+        "--metadata", type=str, help="Tab-separated file with metadata for each sample"
+    )
+    parser.add_argument(
+        "--metadata_index_name",
+        type=str,
+        help="Name of column in metadata file that contains sample ids (default: 'sampleID_NGI'))",
+        default="sampleID_NGI",
+    )
+    parser.add_argument(
+        "--sample_type_col",
+        type=str,
+        default="lab_sample_type",
+        help="Use this column in metadata to identify sample type (default 'lab_sample_type')",
+    )
+    parser.add_argument(
+        "--blank_val",
+        type=str,
+        nargs="+",
+        default=["buffer_blank", "extraction_neg", "pcr_neg"],
+        help="Values in <sample_type_col> that identify blanks (default 'buffer_blank', 'extraction_neg', 'pcr_neg')",
+    )
+    parser.add_argument(
+        "--noblanks",
+        action="store_true",
+        help="Ignore blanks",
+    )
+    parser.add_argument(
+        "--subset_col",
+        type=str,
+        default="dataset",
+        help="Column in metadata to use for subsetting the counts on (default: 'dataset')",
+    )
+    parser.add_argument(
+        "--subset_val",
+        type=str,
+        help="Value in subset_col to use for subsetting the counts on",
+    )
+    parser.add_argument(
+        "--configfile",
+        type=str,
+        default="config.yml",
+        help="Path to a yaml-format configuration file. Can be used to set arguments.",
+    )
+    parser.add_argument(
+        "--clust_column",
+        type=str,
+        default="cluster",
+        help="Name of cluster column (default: 'cluster')",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        help="If countsfile is very large, specify chunksize to read it in a number of lines at a time",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        help="Number of chunks to read ahead from the countsfile in a background "
+        "thread (default 0, no prefetching)",
+    )
+    parser.add_argument("--nrows", type=int, help=argparse.SUPPRESS)
+    return parser
+
+
+def main_cli():
+    args = build_parser().parse_args()
+    main(args)
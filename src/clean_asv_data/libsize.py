@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+import json
+import os
+import sys
+import pandas as pd
+import tqdm
+from clean_asv_data.__main__ import file_fingerprint, generate_reader
+
+LIBSIZE_FORMAT = "clean_asv_data.library_sizes"
+LIBSIZE_VERSION = 1
+
+
+class LibrarySizeBuilder:
+    """
+    Accumulates per-sample read depth (library size) and richness (number of
+    ASVs present) from chunks of a counts file while it is being scanned. The
+    <shard> and <nrows> of the scan are saved with the sizes, as sizes of part
+    of the rows are not those of the counts file.
+    """
+
+    def __init__(self, countsfile, shard=None, nrows=None):
+        self.countsfile = countsfile
+        self.shard = shard
+        self.nrows = nrows or None
+        self.reads = None
+        self.richness = None
+
+    def add(self, df):
+        if self.reads is None:
+            self.reads = df.sum(axis=0)
+            self.richness = df.gt(0).sum(axis=0)
+        else:
+            self.reads += df.sum(axis=0)
+            self.richness += df.gt(0).sum(axis=0)
+
+    def track(self, reader):
+        """
+        Wraps a reader, adding each chunk to the index before passing it on
+        """
+        for df in reader:
+            self.add(df)
+            yield df
+
+    def build(self):
+        df = pd.DataFrame({"reads": self.reads, "richness": self.richness})
+        df.index.name = "sample"
+        return df
+
+    def save(self, f):
+        sys.stderr.write("####\n" f"Writing library sizes to {f}\n")
+        write_library_sizes(
+            f,
+            self.build(),
+            file_fingerprint(self.countsfile),
+            shard=self.shard,
+            nrows=self.nrows,
+        )
+
+
+def write_library_sizes(f, df, fingerprint=None, shard=None, nrows=None):
+    """
+    Writes per-sample stats as a tab-separated file, with the format, the
+    fingerprint of the counts file and the rows scanned (<shard>, <nrows>) on
+    a commented first line
+    """
+    meta = {
+        "format": LIBSIZE_FORMAT,
+        "version": LIBSIZE_VERSION,
+        "fingerprint": fingerprint,
+        "shard": shard,
+        "nrows": nrows,
+    }
+    with open(f, "w") as fhout:
+        fhout.write(f"# {json.dumps(meta)}\n")
+        df.to_csv(fhout, sep="\t")
+
+
+def read_library_sizes(f, countsfile=None):
+    """
+    Reads per-sample stats written by write_library_sizes. If <countsfile> is
+    given, returns None if the index was not built from all rows of its
+    current version.
+    """
+    with open(f, "r") as fhin:
+        meta = json.loads(fhin.readline().lstrip("# "))
+        if meta.get("format") != LIBSIZE_FORMAT:
+            raise ValueError(f"{f} is not a library size index")
+        if countsfile is not None:
+            current = file_fingerprint(countsfile)
+            stored = meta["fingerprint"] or {}
+            if any(stored.get(k) != current[k] for k in ["size", "mtime"]):
+                sys.stderr.write(
+                    "####\n" f"WARNING: {f} is out of date with {countsfile}\n"
+                )
+                return None
+            if meta.get("shard") or meta.get("nrows"):
+                sys.stderr.write(
+                    "####\n"
+                    f"WARNING: {f} only covers part of the rows of {countsfile} "
+                    f"(shard: {meta.get('shard')}, nrows: {meta.get('nrows')})\n"
+                )
+                return None
+        return pd.read_csv(fhin, sep="\t", index_col=0)
+
+
+def get_library_sizes(countsfile, index=None, chunksize=None, nrows=None, prefetch=0):
+    """
+    Returns per-sample stats from <index> if it is up to date with the counts
+    file, otherwise scans the counts file (and saves the result to <index>)
+    """
+    if index is not None and os.path.exists(index):
+        df = read_library_sizes(index, countsfile=countsfile)
+        if df is not None:
+            sys.stderr.write("####\n" f"Read library sizes from {index}\n")
+            return df
+    sys.stderr.write("####\n" f"Calculating library sizes from {countsfile}\n")
+    builder = LibrarySizeBuilder(countsfile, nrows=nrows)
+    reader = generate_reader(countsfile, chunksize, nrows, prefetch=prefetch)
+    for df in tqdm.tqdm(reader, unit=" chunks"):
+        builder.add(df)
+    if index is not None:
+        builder.save(index)
+    return builder.build()
+
+
+def filter_rel_abundance(df, library_sizes, min_rel_abundance):
+    """
+    Sets counts to zero where they are below <min_rel_abundance> percent of
+    the library size of the sample
+
+    :param df: Counts dataframe, ASVs in rows and samples in columns
+    :param library_sizes: Series of total reads per sample
+    :param min_rel_abundance: Threshold in percent
+    :return: filtered dataframe
+    """
+    rel = df.div(library_sizes.reindex(df.columns), axis=1) * 100
+    return df.where(rel >= min_rel_abundance, 0)
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+from clean_asv_data.__main__ import countsfile_columns
+
+PARTIAL_FORMAT = "clean_asv_data.partial"
+PARTIAL_VERSION = 1
+
+# How columns of each kind of partial are combined when merging. Columns not
+# listed are summed.
+MERGE_FUNCS = {
+    "clean": {"ASV_sum": "sum", "ASV_max": "max", "in_n_blanks": "sum"},
+    "stats": {"reads": "sum", "occurrence": "sum"},
+    "asv_sum": {"ASV_sum": "sum"},
+    "cluster_sum": {},
+    "taxa_sum": {},
+}
+
+
+def write_partial(f, kind, tables, params=None, plan=None, source=None):
+    """
+    Writes partial aggregates to a compressed numpy archive
+
+    :param f: Output file
+    :param kind: Type of aggregate ('clean', 'stats', 'asv_sum', 'cluster_sum',
+    'taxa_sum')
+    :param tables: Dictionary of dataframes with ASVs/clusters as index
+    :param params: Parameters that must be identical for partials to be merged
+    :param plan: Dictionary of datasets with their samples and blanks
+    :param source: Description of the input, e.g. countsfile and shard
+    :return:
+    """
+    if kind not in MERGE_FUNCS:
+        raise ValueError(f"Unknown partial kind '{kind}'")
+    manifest = {
+        "format": PARTIAL_FORMAT,
+        "version": PARTIAL_VERSION,
+        "kind": kind,
+        "params": params or {},
+        "plan": plan or {},
+        "sources": [source] if isinstance(source, dict) else (source or []),
+        "tables": {},
+    }
+    arrays = {}
+    for i, (name, df) in enumerate(tables.items()):
+        manifest["tables"][name] = {
+            "key": f"t{i}",
+            "index_name": df.index.name,
+            "columns": [str(c) for c in df.columns],
+            "dtypes": [str(d) for d in df.dtypes],
+        }
+        arrays[f"t{i}_index"] = np.array(df.index.astype(str), dtype=str)
+        arrays[f"t{i}_values"] = df.to_numpy()
+    arrays["manifest"] = np.array(json.dumps(manifest))
+    with open(f, "wb") as fhout:
+        np.savez_compressed(fhout, **arrays)
+
+
+def read_partial(f):
+    """
+    Reads a partial aggregate file
+
+    :param f: Partial aggregate file written by write_partial
+    :return: manifest dictionary and dictionary of dataframes
+    """
+    with np.load(f, allow_pickle=False) as archive:
+        try:
+            manifest = json.loads(str(archive["manifest"]))
+        except KeyError:
+            raise ValueError(f"{f} is not a partial aggregate file")
+        if manifest.get("format") != PARTIAL_FORMAT:
+            raise ValueError(f"{f} is not a partial aggregate file")
+        if manifest["version"] > PARTIAL_VERSION:
+            raise ValueError(
+                f"{f} has partial format version {manifest['version']}, "
+                f"only versions <= {PARTIAL_VERSION} are supported"
+            )
+        tables = {}
+        for name, info in manifest["tables"].items():
+            values = archive[f"{info['key']}_values"]
+            index = pd.Index(archive[f"{info['key']}_index"], name=info["index_name"])
+            tables[name] = pd.DataFrame(
+                values.reshape(len(index), len(info["columns"])),
+                index=index,
+                columns=info["columns"],
+            ).astype(dict(zip(info["columns"], info["dtypes"])))
+    return manifest, tables
+
+
+def merge_tables(kind, frames):
+    """
+    Combines dataframes of the same kind, aggregating rows present in several
+    frames (column shards) and keeping rows only present in one (row shards)
+
+    :param kind: Type of aggregate
+    :param frames: List of dataframes
+    :return: merged dataframe
+    """
+    funcs = MERGE_FUNCS[kind]
+    # Empty frames, e.g. of datasets without samples in a shard, would turn
+    # integer columns into floats
+    frames = [df for df in frames if df.shape[0] > 0] or frames[:1]
+    dtypes = {}
+    for frame in frames:
+        for c, dtype in frame.dtypes.items():
+            dtypes.setdefault(c, dtype)
+    df = pd.concat(frames)
+    sum_cols = [c for c in df.columns if funcs.get(c, "sum") == "sum"]
+    # Columns missing from some frames (column shards) are filled with zeros
+    # and cast back to their original type
+    df[sum_cols] = df[sum_cols].fillna(0).astype(
+        {c: dtypes[c] for c in sum_cols}
+    )
+    if df.index.has_duplicates:
+        df = df.groupby(level=0, sort=False).agg(
+            {c: funcs.get(c, "sum") for c in df.columns}
+        )
+    return df
+
+
+def merge_plans(plans):
+    """
+    Takes the union of samples and blanks for each dataset
+    """
+    merged = {}
+    for plan in plans:
+        for dataset, items in plan.items():
+            if dataset not in merged:
+                merged[dataset] = {"samples": set(), "blanks": set()}
+            merged[dataset]["samples"].update(items["samples"])
+            merged[dataset]["blanks"].update(items["blanks"])
+    return {
+        dataset: {key: sorted(val) for key, val in items.items()}
+        for dataset, items in merged.items()
+    }
+
+
+def merge_partials(files, kind=None):
+    """
+    Reads and merges any number of partial aggregate files. Merging is
+    associative so merged partials can be merged again.
+
+    :param files: List of partial aggregate files
+    :param kind: If given, require partials to be of this kind
+    :return: merged manifest and dictionary of dataframes
+    """
+    manifests = []
+    tables = {}
+    for f in files:
+        sys.stderr.write(f"Reading partial aggregates from {f}\n")
+        manifest, _tables = read_partial(f)
+        if kind is not None and manifest["kind"] != kind:
+            raise ValueError(
+                f"{f} contains '{manifest['kind']}' aggregates, expected '{kind}'"
+            )
+        if len(manifests) > 0:
+            if manifest["kind"] != manifests[0]["kind"]:
+                raise ValueError(f"Can not merge partials of different kinds ({f})")
+            if manifest["params"] != manifests[0]["params"]:
+                raise ValueError(f"Parameters in {f} differ from {files[0]}")
+        manifests.append(manifest)
+        for name, df in _tables.items():
+            tables.setdefault(name, []).append(df)
+    if len(manifests) == 0:
+        raise ValueError("No partial aggregate files given")
+    sources = [s for m in manifests for s in m["sources"]]
+    seen = set()
+    for s in sources:
+        key = json.dumps(s, sort_keys=True)
+        if key in seen:
+            raise ValueError(f"Source {s} is present in more than one partial")
+        seen.add(key)
+    kind = manifests[0]["kind"]
+    merged = {
+        "kind": kind,
+        "params": manifests[0]["params"],
+        "plan": merge_plans([m["plan"] for m in manifests]),
+        "sources": sources,
+    }
+    return merged, {
+        name: merge_tables(kind, frames) for name, frames in tables.items()
+    }
+
+
+def finalize(manifest, tables):
+    """
+    Turns merged aggregates into the output of the corresponding read function:
+    a dictionary of dataframes for 'clean', a single dataframe otherwise
+
+    :param manifest: Manifest of (merged) partial
+    :param tables: Dictionary of dataframes
+    :return:
+    """
+    kind = manifest["kind"]
+    if kind == "clean":
+        data = {}
+        # ASVs missing from the shards of a dataset (e.g. column shards with
+        # different rows) have zero counts in its samples
+        asvs = pd.Index([]).append([df.index for df in tables.values()]).unique()
+        for dataset, df in tables.items():
+            dtypes = df.dtypes.to_dict()
+            df = df.reindex(asvs, fill_value=0).astype(dtypes)
+            n_blanks = len(manifest["plan"].get(dataset, {}).get("blanks", []))
+            if n_blanks > 0:
+                df["in_n_blanks"] = df["in_n_blanks"].astype("int64")
+                df["in_percent_blanks"] = df["in_n_blanks"].div(n_blanks) * 100
+            else:
+                df = df.drop("in_n_blanks", axis=1, errors="ignore")
+            data[dataset] = df
+        return data
+    df = tables[kind]
+    if kind in ["cluster_sum", "taxa_sum"]:
+        return df.fillna(0).sort_index()
+    if kind == "asv_sum":
+        return df.sort_values(by="ASV_sum", ascending=False)
+    return df
+
+
+def load_partials(files, kind):
+    """
+    Merges partial aggregate files and returns final aggregates of <kind>
+    """
+    manifest, tables = merge_partials(files, kind=kind)
+    sys.stderr.write(
+        "####\n"
+        f"Merged {len(files)} partials covering {len(manifest['sources'])} sources\n"
+    )
+    return finalize(manifest, tables)
+
+
+def check_disjoint_samples(countsfiles):
+    """
+    Raises ValueError if any sample occurs in more than one countsfile
+    """
+    seen = {}
+    for f in countsfiles:
+        for sample in countsfile_columns(f):
+            if sample in seen:
+                raise ValueError(
+                    f"Sample {sample} is present in both {seen[sample]} and {f}"
+                )
+            seen[sample] = f
+
+
+def scan_countsfiles(countsfiles, scan, kind, threads=None):
+    """
+    Aggregates several countsfiles with different samples as one counts
+    matrix, joined on ASV ids. Each file is scanned in its own thread by
+    <scan>, which writes the aggregates of the file to a temporary partial,
+    and the partials are merged like row and column shards.
+
+    :param countsfiles: List of countsfiles
+    :param scan: Function taking a countsfile and a partial file to write
+    :param kind: Type of aggregate written by <scan>
+    :param threads: Number of files to read at the same time (default: all)
+    :return: final aggregates of <kind>, as returned by load_partials
+    """
+    check_disjoint_samples(countsfiles)
+    sys.stderr.write(
+        "####\n" f"Reading {len(countsfiles)} countsfiles as one counts matrix\n"
+    )
+    tmpdir = tempfile.mkdtemp(prefix="clean_asv_data.")
+    try:
+        partials = [os.path.join(tmpdir, f"{i}.npz") for i in range(len(countsfiles))]
+        with ThreadPoolExecutor(max_workers=threads or len(countsfiles)) as pool:
+            futures = [
+                pool.submit(scan, f, partial) for f, partial in zip(countsfiles, partials)
+            ]
+            for future in futures:
+                future.result()
+        return load_partials(partials, kind=kind)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def main(args):
+    manifest, tables = merge_partials(args.partials)
+    write_partial(
+        args.output,
+        manifest["kind"],
+        tables,
+        params=manifest["params"],
+        plan=manifest["plan"],
+        source=manifest["sources"],
+    )
+    sys.stderr.write(
+        "####\n"
+        f"Wrote merged '{manifest['kind']}' aggregates from {len(args.partials)} "
+        f"partials to {args.output}\n"
+    )
+
+
+def main_cli():
+    parser = ArgumentParser(
+        description="Merges partial aggregate files written with --write_partial "
+        "by clean-asv-data, generate-statsfile, consensus-taxonomy or "
+        "count-clusters. The merged file can be merged again or passed to the "
+        "same tool with --from_partials"
+    )
+    parser.add_argument(
+        "partials", nargs="+", help="Partial aggregate files to merge"
+    )
+    parser.add_argument(
+        "-o", "--output", type=str, required=True, help="Merged partial output file"
+    )
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+import argparse
+from argparse import ArgumentParser
+import json
+import os
+import re
+import sys
+import zipfile
+import numpy as np
+import tqdm
+from clean_asv_data.__main__ import (
+    PARTITION_ASVS_FORMAT,
+    PARTITION_FORMAT,
+    PARTITION_MANIFEST_FORMAT,
+    PARTITION_ASVS_FILE,
+    PARTITION_VERSION,
+    countsfile_columns,
+    file_fingerprint,
+    generate_reader,
+    read_config,
+    read_metadata,
+)
+
+
+def write_array(archive, name, array):
+    """
+    Writes <array> as <name>.npy to an open zip archive, as read by numpy.load
+    """
+    with archive.open(f"{name}.npy", "w", force_zip64=True) as fhout:
+        np.lib.format.write_array(fhout, array, allow_pickle=False)
+
+
+class AsvListWriter:
+    """
+    Writes the ASV ids of each chunk of the countsfile to one archive shared
+    by all partitions, so that partitions only need to store the rows with
+    counts in their samples
+    """
+
+    def __init__(self, f, source=None):
+        self.f = f
+        self.source = source
+        self.n_rows = self.n_chunks = 0
+        self._zip = zipfile.ZipFile(f, "w", compression=zipfile.ZIP_DEFLATED)
+
+    def add(self, df):
+        write_array(
+            self._zip, f"asvs_{self.n_chunks}", np.array(df.index.astype(str), dtype=str)
+        )
+        self.n_rows += df.shape[0]
+        self.n_chunks += 1
+
+    def close(self):
+        meta = {
+            "format": PARTITION_ASVS_FORMAT,
+            "version": PARTITION_VERSION,
+            "source": self.source,
+            "n_rows": self.n_rows,
+            "n_chunks": self.n_chunks,
+        }
+        write_array(self._zip, "meta", np.array(json.dumps(meta)))
+        self._zip.close()
+
+
+class PartitionWriter:
+    """
+    Writes the counts of one dataset to a partition: a zip archive of numpy
+    arrays (readable with numpy.load) holding, for each chunk of the
+    countsfile, the counts of the rows with counts in the samples of the
+    dataset and their positions in the chunk. The ASV ids of all rows are
+    stored once for all partitions in <asvs> (see AsvListWriter), so that
+    the partition is read as all rows of the countsfile.
+    """
+
+    def __init__(self, f, samples, asvs, dataset=None, source=None):
+        self.f = f
+        self.samples = [str(s) for s in samples]
+        self.asvs = asvs
+        self.dataset = dataset
+        self.index_name = None
+        self.source = source
+        self.dtype = None
+        self.n_rows = self.n_stored = self.n_chunks = 0
+        self._zip = zipfile.ZipFile(f, "w", compression=zipfile.ZIP_DEFLATED)
+
+    def add(self, df):
+        """
+        Adds a chunk of counts of the samples of the dataset. Chunks must be
+        added as they were added to the ASV list.
+        """
+        self.index_name = df.index.name
+        values = df.to_numpy()
+        if self.dtype is None:
+            self.dtype = str(values.dtype)
+        rows = np.flatnonzero((values != 0).any(axis=1))
+        if len(rows) > 0:
+            write_array(self._zip, f"rows_{self.n_chunks}", rows.astype(np.int32))
+            write_array(self._zip, f"counts_{self.n_chunks}", values[rows])
+        self.n_rows += values.shape[0]
+        self.n_stored += len(rows)
+        self.n_chunks += 1
+
+    def close(self):
+        meta = {
+            "format": PARTITION_FORMAT,
+            "version": PARTITION_VERSION,
+            "dataset": self.dataset,
+            "source": self.source,
+            "index_name": self.index_name,
+            "samples": self.samples,
+            "dtype": self.dtype or "int64",
+            "asvs": os.path.basename(self.asvs),
+            "n_rows": self.n_rows,
+            "n_stored_rows": self.n_stored,
+            "n_chunks": self.n_chunks,
+        }
+        write_array(self._zip, "meta", np.array(json.dumps(meta)))
+        self._zip.close()
+
+
+def partition_file(dataset):
+    """
+    Returns a file name for the partition of <dataset>
+    """
+    return re.sub(r"[^\w.-]", "_", str(dataset)) + ".npz"
+
+
+def partition_counts(
+    countsfile,
+    metadata,
+    split_col="dataset",
+    outdir=".",
+    chunksize=None,
+    nrows=None,
+    prefetch=0,
+):
+    """
+    Rewrites a countsfile into one partition per dataset in one pass
+
+    :param countsfile: Counts of ASVs in each sample
+    :param metadata: Metadata dataframe with samples as index. If None, all
+    samples are written to one partition named 'dataset'
+    :param split_col: Column in metadata that assigns samples to datasets
+    :param outdir: Directory to write partitions and manifest.json to
+    :param chunksize: Number of rows to read (and write) at a time
+    :param nrows: Number of total rows to read (development)
+    :param prefetch: Number of chunks to read ahead in a background thread
+    :return: manifest dictionary
+    """
+    columns = countsfile_columns(countsfile)
+    datasets = {}
+    if metadata is None:
+        datasets["dataset"] = list(columns)
+    else:
+        for val in metadata[split_col].dropna().unique():
+            val_samples = set(metadata.index[metadata[split_col] == val])
+            samples = [c for c in columns if c in val_samples]
+            if len(samples) == 0:
+                sys.stderr.write(
+                    "####\n"
+                    f"No samples found in counts data for {val}, skipping...\n"
+                )
+                continue
+            datasets[val] = samples
+    unassigned = set(columns).difference(*datasets.values())
+    if len(unassigned) > 0:
+        sys.stderr.write(
+            "####\n"
+            f"WARNING: {len(unassigned)} samples in the countsfile have no "
+            "dataset in metadata and are not written to any partition\n"
+        )
+    if len(set(map(partition_file, datasets))) < len(datasets):
+        raise ValueError("Dataset names map to the same partition file names")
+    os.makedirs(outdir, exist_ok=True)
+    source = file_fingerprint(countsfile)
+    asvs = AsvListWriter(os.path.join(outdir, PARTITION_ASVS_FILE), source=source)
+    writers = {
+        val: PartitionWriter(
+            os.path.join(outdir, partition_file(val)),
+            samples,
+            asvs.f,
+            dataset=str(val),
+            source=source,
+        )
+        for val, samples in datasets.items()
+    }
+    reader = generate_reader(countsfile, chunksize, nrows, prefetch=prefetch)
+    for df in tqdm.tqdm(reader, desc="partitioning counts", unit=" chunks"):
+        if df.shape[0] == 0:
+            continue
+        asvs.add(df)
+        for val, writer in writers.items():
+            writer.add(df.loc[:, datasets[val]])
+    asvs.close()
+    manifest = {
+        "format": PARTITION_MANIFEST_FORMAT,
+        "version": PARTITION_VERSION,
+        "source": source,
+        "split_col": split_col,
+        "asvs": os.path.basename(asvs.f),
+        "n_rows": asvs.n_rows,
+        "datasets": {},
+    }
+    for val, writer in writers.items():
+        writer.close()
+        manifest["datasets"][str(val)] = {
+            "file": os.path.basename(writer.f),
+            "samples": writer.samples,
+            "n_rows": writer.n_rows,
+            "n_stored_rows": writer.n_stored,
+            "bytes": os.path.getsize(writer.f),
+        }
+        sys.stderr.write(
+            f"Wrote {writer.n_stored} of {writer.n_rows} rows (rows with counts) "
+            f"in {len(writer.samples)} samples of {val} to {writer.f}\n"
+        )
+    with open(os.path.join(outdir, "manifest.json"), "w") as fhout:
+        json.dump(manifest, fhout, indent=2)
+    return manifest
+
+
+def main(args):
+    args = read_config(args.configfile, args)
+    if not args.metadata:
+        sys.exit("ERROR: partition-counts requires --metadata")
+    metadata = read_metadata(args.metadata, index_name=args.metadata_index_name)
+    partition_counts(
+        args.countsfile,
+        metadata,
+        split_col=args.split_col,
+        outdir=args.outdir,
+        chunksize=args.chunksize,
+        nrows=args.nrows,
+        prefetch=args.prefetch,
+    )
+
+
+def main_cli():
+    parser = ArgumentParser(
+        description="Rewrites a countsfile into one compressed binary partition "
+        "per dataset, holding only the samples of the dataset and the rows with "
+        "counts in them, plus the ASV ids of all rows and a manifest.json. "
+        "Partitions (or the manifest) can be given as --countsfile to the other "
+        "tools."
+    )
+    parser.add_argument(
+        "--countsfile",
+        type=str,
+        required=True,
+        help="Tab-separated file with counts of ASVs (rows) in samples (columns)",
+    )
+    parser.add_argument(
+        "--outdir",
+        type=str,
+        required=True,
+        help="Directory to write partitions and manifest to",
+    )
+    parser.add_argument(
+        "--metadata", type=str, help="Tab-separated file with metadata for each sample"
+    )
+    parser.add_argument(
+        "--metadata_index_name",
+        type=str,
+        help="Name of column in metadata file that contains sample ids (default: 'sampleID_NGI'))",
+        default="sampleID_NGI",
+    )
+    parser.add_argument(
+        "--split_col",
+        type=str,
+        default="dataset",
+        help="Column in metadata by which to partition samples (default: 'dataset')",
+    )
+    parser.add_argument(
+        "--configfile",
+        type=str,
+        default="config.yml",
+        help="Path to a yaml-format configuration file. Can be used to set arguments.",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        help="If countsfile is very large, specify chunksize to read it in a number of lines at a time",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        help="Number of chunks to read ahead from the countsfile in a background "
+        "thread (default 0, no prefetching)",
+    )
+    parser.add_argument("--nrows", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    main(args)
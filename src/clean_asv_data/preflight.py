@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+from argparse import ArgumentParser
+import json
+import sys
+import time
+import pandas as pd
+from clean_asv_data.__main__ import (
+    countsfile_columns,
+    expand_countsfiles,
+    generate_reader,
+    is_partition,
+    read_config,
+    sample_rows,
+)
+
+
+class PreflightReport:
+    """
+    Collects the outcome of preflight checks as a machine-readable report.
+    Problems that would make a run fail or give meaningless results are errors,
+    problems that a run would only warn about are warnings.
+    """
+
+    def __init__(self):
+        self.errors = []
+        self.warnings = []
+        self.info = {}
+
+    def error(self, code, message, **details):
+        self.errors.append({"code": code, "message": message, **details})
+
+    def warning(self, code, message, **details):
+        self.warnings.append({"code": code, "message": message, **details})
+
+    @property
+    def ok(self):
+        return len(self.errors) == 0
+
+    def to_dict(self):
+        return {
+            "ok": self.ok,
+            "errors": self.errors,
+            "warnings": self.warnings,
+            **self.info,
+        }
+
+    def write(self, fhout):
+        json.dump(self.to_dict(), fhout, indent=2, default=str)
+        fhout.write("\n")
+
+
+def read_header(f, sep="\t"):
+    """
+    Reads the column names of a tab-separated file, without the index column.
+    The header is read as a row so that duplicated names are kept as they are.
+    """
+    if is_partition(f):
+        return list(countsfile_columns(f))
+    header = pd.read_csv(f, sep=sep, header=None, nrows=1, dtype=str)
+    return list(header.iloc[0, 1:])
+
+
+def sample_counts_index(countsfile, n_rows=1000, seed=0):
+    """
+    Returns the ASV ids of up to <n_rows> randomly sampled rows of the counts
+    file. Compressed files and partitions can not be seeked by row so the
+    first rows are used.
+    """
+    if is_partition(countsfile):
+        return generate_reader(countsfile, None, n_rows)[0].index
+    if str(countsfile).endswith(".gz"):
+        df = pd.read_csv(countsfile, sep="\t", usecols=[0], nrows=n_rows)
+    else:
+        sample, _, _ = sample_rows(countsfile, n_rows=n_rows, method="seek", seed=seed)
+        df = pd.read_csv(sample, sep="\t", usecols=[0])
+    return pd.Index(df.iloc[:, 0])
+
+
+def check_plan(report, samples, metadata, split_col, blanks=None):
+    """
+    Builds the dataset/blank plan that read_counts would use from the sample
+    names in the counts header, and checks it for mismatches with the metadata
+    """
+    plan = {}
+    if metadata is None:
+        plan["dataset"] = {"n_samples": len(samples), "n_blanks": 0}
+        return plan
+    in_metadata = pd.Index(samples).isin(metadata.index)
+    not_in_metadata = [s for s, found in zip(samples, in_metadata) if not found]
+    if len(not_in_metadata) == len(samples):
+        report.error(
+            "no_samples_in_metadata",
+            "None of the samples in the countsfile are present in the metadata",
+        )
+    elif len(not_in_metadata) > 0:
+        report.warning(
+            "samples_missing_from_metadata",
+            f"{len(not_in_metadata)} samples in the countsfile are missing from "
+            "the metadata and will be ignored",
+            samples=not_in_metadata,
+        )
+    no_split_val = metadata.loc[metadata[split_col].isna()].index
+    no_split_val = [s for s in no_split_val if s in set(samples)]
+    if len(no_split_val) > 0:
+        report.warning(
+            "missing_split_col_values",
+            f"{len(no_split_val)} samples in the countsfile have no value in "
+            f"'{split_col}' and will be ignored",
+            samples=no_split_val,
+        )
+    for val in metadata[split_col].dropna().unique():
+        val_samples = metadata.loc[metadata[split_col] == val].index
+        val_samples_intersect = [s for s in val_samples if s in set(samples)]
+        if len(val_samples_intersect) == 0:
+            report.warning(
+                "no_samples_in_dataset",
+                f"No samples found in counts data for {val}, it will be skipped",
+                dataset=val,
+            )
+            continue
+        missing_samples = [s for s in val_samples if s not in set(samples)]
+        if len(missing_samples) > 0:
+            report.warning(
+                "samples_missing_from_counts",
+                f"{len(missing_samples)} samples in metadata file are missing "
+                f"from counts file for {val}",
+                dataset=val,
+                samples=missing_samples,
+            )
+        val_blanks = [] if blanks is None else sorted(
+            set(blanks).intersection(val_samples_intersect)
+        )
+        if blanks is not None and len(val_blanks) == 0:
+            report.warning(
+                "no_blanks_in_dataset",
+                f"No blanks found for {val}, it will not be cleaned by blanks",
+                dataset=val,
+            )
+        plan[val] = {
+            "n_samples": len(val_samples_intersect),
+            "n_blanks": len(val_blanks),
+            "blanks": val_blanks,
+        }
+    return plan
+
+
+def check_asv_overlap(report, countsfile, clustfile, n_rows=1000, seed=0):
+    """
+    Checks that ASVs in a random sample of counts rows are present in the
+    clustfile index. If <countsfile> is a list of files, rows are sampled
+    from each of them.
+    """
+    clust_asvs = pd.Index(
+        pd.read_csv(clustfile, sep="\t", usecols=[0]).iloc[:, 0]
+    )
+    if clust_asvs.has_duplicates:
+        report.error(
+            "duplicate_asvs_in_clustfile",
+            f"{clust_asvs.duplicated().sum()} ASV ids occur more than once in "
+            "the clustfile",
+        )
+    countsfiles = countsfile if isinstance(countsfile, list) else [countsfile]
+    sampled = pd.Index([]).append(
+        [
+            sample_counts_index(f, n_rows=max(n_rows // len(countsfiles), 1), seed=seed)
+            for f in countsfiles
+        ]
+    )
+    found = int(sampled.isin(clust_asvs).sum())
+    overlap = {
+        "n_clustfile_asvs": len(clust_asvs),
+        "n_sampled": len(sampled),
+        "n_found": found,
+        "fraction_found": found / len(sampled) if len(sampled) > 0 else None,
+    }
+    if len(sampled) > 0 and found == 0:
+        report.error(
+            "no_asv_overlap",
+            f"None of {len(sampled)} sampled ASVs in the countsfile are "
+            "present in the clustfile",
+            examples=list(sampled[:5]),
+        )
+    elif found < len(sampled):
+        report.warning(
+            "partial_asv_overlap",
+            f"{len(sampled) - found} of {len(sampled)} sampled ASVs in the "
+            "countsfile are missing from the clustfile and will be dropped",
+            examples=list(sampled[~sampled.isin(clust_asvs)][:5]),
+        )
+    return overlap
+
+
+def preflight(args, n_rows=1000):
+    """
+    Validates the inputs of a clean-asv-data run using only the countsfile
+    header, a small random sample of counts rows, the clustfile index and the
+    metadata
+
+    :param args: Arguments/config of the run
+    :param n_rows: Number of counts rows to sample for the ASV overlap check
+    :return: PreflightReport
+    """
+    start = time.time()
+    report = PreflightReport()
+    # Several countsfiles are checked as one matrix with the samples of all files
+    countsfiles = expand_countsfiles(args.countsfile)
+    samples = []
+    for f in countsfiles:
+        try:
+            samples += read_header(f)
+        except (OSError, ValueError, pd.errors.ParserError) as e:
+            report.error("unreadable_countsfile", f"Could not read {f}: {e}")
+            return report
+    duplicated = pd.Index(samples)[pd.Index(samples).duplicated()]
+    if len(duplicated) > 0:
+        report.error(
+            "duplicate_samples_in_counts",
+            f"{len(duplicated)} sample names occur more than once in the countsfile",
+            samples=list(duplicated),
+        )
+    report.info["counts"] = {
+        "file": countsfiles[0] if len(countsfiles) == 1 else countsfiles,
+        "n_samples": len(samples),
+    }
+    metadata = None
+    blanks = None
+    if args.metadata:
+        metadata = pd.read_csv(args.metadata, sep="\t", header=0, comment="#")
+        required = [args.metadata_index_name, args.split_col]
+        if not args.noblanks:
+            required.append(args.sample_type_col)
+        missing = [c for c in required if c not in metadata.columns]
+        if len(missing) > 0:
+            report.error(
+                "missing_metadata_columns",
+                f"Column(s) {', '.join(missing)} not found in {args.metadata}",
+                columns=missing,
+            )
+            return report
+        metadata = metadata.set_index(args.metadata_index_name)
+        if metadata.index.has_duplicates:
+            report.error(
+                "duplicate_samples_in_metadata",
+                f"{metadata.index.duplicated().sum()} sample ids occur more than "
+                "once in the metadata",
+            )
+        if not args.noblanks:
+            blanks = list(
+                metadata.loc[metadata[args.sample_type_col].isin(args.blank_val)].index
+            )
+            if len(blanks) == 0:
+                report.warning(
+                    "no_blanks_in_metadata",
+                    f"No samples with {', '.join(args.blank_val)} in "
+                    f"'{args.sample_type_col}' found in metadata",
+                )
+    report.info["plan"] = check_plan(report, samples, metadata, args.split_col, blanks)
+    if args.clustfile:
+        columns = read_header(args.clustfile)
+        # clean-asv-data always reads clusters from the 'cluster' column
+        missing = [c for c in ["cluster", args.clean_rank] if c not in columns]
+        if len(missing) > 0:
+            report.error(
+                "missing_clustfile_columns",
+                f"Column(s) {', '.join(missing)} not found in {args.clustfile}",
+                columns=missing,
+            )
+        report.info["asv_overlap"] = check_asv_overlap(
+            report, countsfiles, args.clustfile, n_rows=n_rows
+        )
+    report.info["seconds"] = round(time.time() - start, 3)
+    return report
+
+
+def main(args):
+    args = read_config(args.configfile, args)
+    report = preflight(args, n_rows=args.sample_rows)
+    if args.output:
+        with open(args.output, "w") as fhout:
+            report.write(fhout)
+    else:
+        report.write(sys.stdout)
+    sys.stderr.write(
+        "####\n"
+        f"Preflight found {len(report.errors)} errors and "
+        f"{len(report.warnings)} warnings\n"
+    )
+    if not report.ok:
+        sys.exit(1)
+
+
+def main_cli():
+    parser = ArgumentParser(
+        description="Checks inputs to clean-asv-data for mismatches between "
+        "samples in the countsfile and metadata, missing blanks and ASVs missing "
+        "from the clustfile, without scanning the countsfile. Writes a JSON "
+        "report and exits with status 1 if any errors are found"
+    )
+    parser.add_argument(
+        "--countsfile",
+        type=str,
+        nargs="+",
+        required=True,
+        help="Counts file of ASVs. Several files (or glob patterns) are checked "
+        "as one counts matrix",
+    )
+    parser.add_argument(
+        "--clustfile",
+        type=str,
+        help="Taxonomy file for ASVs with cluster designation in a 'cluster' column",
+    )
+    parser.add_argument(
+        "--metadata", type=str, help="Metadata file for splitting samples by datasets"
+    )
+    parser.add_argument(
+        "--metadata_index_name",
+        type=str,
+        help="Name of column in metadata file that contains sample ids",
+        default="sampleID_NGI",
+    )
+    parser.add_argument(
+        "--split_col",
+        type=str,
+        help="Name of column in metadata file by which to split samples",
+        default="dataset",
+    )
+    parser.add_argument(
+        "--sample_type_col",
+        type=str,
+        default="lab_sample_type",
+        help="Use this column in metadata to identify sample type (default 'lab_sample_type')",
+    )
+    parser.add_argument(
+        "--blank_val",
+        type=str,
+        nargs="+",
+        default=["buffer_blank", "extraction_neg", "pcr_neg"],
+        help="Values in <sample_type_col> that identify blanks (default 'buffer_blank', 'extraction_neg', 'pcr_neg')",
+    )
+    parser.add_argument(
+        "--noblanks",
+        action="store_true",
+        help="Ignore blanks",
+    )
+    parser.add_argument(
+        "--clean_rank",
+        type=str,
+        help="Taxonomic rank used for cleaning, checked to be present in the clustfile",
+    )
+    parser.add_argument(
+        "--sample_rows",
+        type=int,
+        default=1000,
+        help="Number of randomly sampled counts rows used to check ASV overlap "
+        "with the clustfile (default 1000)",
+    )
+    parser.add_argument(
+        "--configfile",
+        type=str,
+        default="config.yml",
+        help="Path to a yaml-format configuration file. Can be used to set arguments.",
+    )
+    parser.add_argument(
+        "-o", "--output", type=str, help="Write report to this file instead of stdout"
+    )
+    args = parser.parse_args()
+    main(args)
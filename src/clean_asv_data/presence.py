@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+from argparse import ArgumentParser
+import json
+import sys
+import numpy as np
+import pandas as pd
+from clean_asv_data.__main__ import file_fingerprint, read_config, read_metadata
+
+PRESENCE_FORMAT = "clean_asv_data.presence"
+PRESENCE_VERSION = 1
+
+# Number of set bits in each possible byte
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+class PresenceIndex:
+    """
+    Packed presence/absence bitsets of ASVs (rows) over samples (columns).
+    Occurrence within any set of samples is the popcount of each ASV bitset
+    AND-ed with the bitset of the sample set. An index built from part of the
+    rows of the counts file has the <shard> or <nrows> of that scan.
+    """
+
+    def __init__(self, asvs, samples, bits, fingerprint=None, shard=None, nrows=None):
+        self.asvs = pd.Index(asvs, name="ASV")
+        self.samples = pd.Index(samples)
+        self.bits = bits
+        self.fingerprint = fingerprint
+        self.shard = shard
+        self.nrows = nrows or None
+
+    @property
+    def partial(self):
+        return self.shard is not None or self.nrows is not None
+
+    def mask(self, samples):
+        """
+        Returns the packed bitset of <samples>, ignoring samples not in the index
+        """
+        return np.packbits(self.samples.isin(samples))
+
+    def occurrence(self, samples=None):
+        """
+        Counts the number of <samples> (default all) in which each ASV is present
+
+        :param samples: List of sample names
+        :return: Series with occurrence of ASVs
+        """
+        if samples is None:
+            bits = self.bits
+        else:
+            bits = self.bits & self.mask(samples)
+        return pd.Series(
+            POPCOUNT[bits].sum(axis=1, dtype=np.int64), index=self.asvs
+        )
+
+    def save(self, f):
+        meta = {
+            "format": PRESENCE_FORMAT,
+            "version": PRESENCE_VERSION,
+            "fingerprint": self.fingerprint,
+            "shard": self.shard,
+            "nrows": self.nrows,
+        }
+        with open(f, "wb") as fhout:
+            np.savez_compressed(
+                fhout,
+                meta=np.array(json.dumps(meta)),
+                asvs=np.array(self.asvs.astype(str), dtype=str),
+                samples=np.array(self.samples.astype(str), dtype=str),
+                bits=self.bits,
+            )
+
+    @classmethod
+    def load(cls, f, countsfile=None):
+        """
+        Loads a presence index from file. If <countsfile> is given, check that
+        the index was built from all rows of the current version of it.
+        """
+        with np.load(f, allow_pickle=False) as archive:
+            meta = json.loads(str(archive["meta"]))
+            if meta.get("format") != PRESENCE_FORMAT:
+                raise ValueError(f"{f} is not a presence index")
+            if meta["version"] > PRESENCE_VERSION:
+                raise ValueError(
+                    f"{f} has presence index version {meta['version']}, "
+                    f"only versions <= {PRESENCE_VERSION} are supported"
+                )
+            if countsfile is not None:
+                current = file_fingerprint(countsfile)
+                stored = meta["fingerprint"] or {}
+                if any(stored.get(k) != current[k] for k in ["size", "mtime"]):
+                    raise ValueError(f"{f} is out of date with {countsfile}")
+                if meta.get("shard") or meta.get("nrows"):
+                    raise ValueError(
+                        f"{f} only covers part of the rows of {countsfile} "
+                        f"(shard: {meta.get('shard')}, nrows: {meta.get('nrows')})"
+                    )
+            return cls(
+                archive["asvs"],
+                archive["samples"],
+                archive["bits"],
+                fingerprint=meta["fingerprint"],
+                shard=meta.get("shard"),
+                nrows=meta.get("nrows"),
+            )
+
+
+class PresenceIndexBuilder:
+    """
+    Collects packed presence bitsets from chunks of a counts file while it is
+    being scanned for other purposes, limited to the <shard> and <nrows> of
+    the scan
+    """
+
+    def __init__(self, countsfile, shard=None, nrows=None):
+        self.countsfile = countsfile
+        self.shard = shard
+        self.nrows = nrows
+        self.samples = None
+        self.asvs = []
+        self.bits = []
+
+    def add(self, df):
+        if self.samples is None:
+            self.samples = list(df.columns)
+        self.asvs.append(df.index)
+        self.bits.append(np.packbits(df.to_numpy() > 0, axis=1))
+
+    def track(self, reader):
+        """
+        Wraps a reader, adding each chunk to the index before passing it on
+        """
+        for df in reader:
+            self.add(df)
+            yield df
+
+    def build(self):
+        n_bytes = (len(self.samples or []) + 7) // 8
+        return PresenceIndex(
+            pd.Index([]).append(self.asvs) if self.asvs else [],
+            self.samples or [],
+            np.vstack(self.bits) if self.bits else np.zeros((0, n_bytes), np.uint8),
+            fingerprint=file_fingerprint(self.countsfile),
+            shard=self.shard,
+            nrows=self.nrows,
+        )
+
+    def save(self, f):
+        sys.stderr.write("####\n" f"Writing presence index to {f}\n")
+        self.build().save(f)
+
+
+def blank_occurrence(index, blanks, samples=None):
+    """
+    Calculates occurrence of ASVs in blanks, as <in_n_blanks> and
+    <in_percent_blanks> columns, from a presence index
+
+    :param index: PresenceIndex
+    :param blanks: List of blank samples
+    :param samples: Samples of dataset, if None all samples in the index are used
+    :return: dataframe with blank occurrence of ASVs
+    """
+    if samples is None:
+        samples = index.samples
+    blanks = index.samples[index.samples.isin(blanks) & index.samples.isin(samples)]
+    df = pd.DataFrame(index.occurrence(blanks), columns=["in_n_blanks"])
+    df["in_percent_blanks"] = df["in_n_blanks"].div(len(blanks)) * 100
+    return df
+
+
+def main(args):
+    # Only check the index against a countsfile given on the command line, not
+    # one set in the configfile
+    countsfile = args.countsfile
+    args = read_config(args.configfile, args)
+    if args.subset_val and not args.metadata:
+        sys.exit("ERROR: --subset_val requires --metadata")
+    try:
+        index = PresenceIndex.load(args.index, countsfile=countsfile)
+    except ValueError as e:
+        sys.exit(f"ERROR: {e}")
+    if countsfile is not None:
+        sys.stderr.write("####\n" f"Index is up to date with {countsfile}\n")
+    elif index.partial:
+        sys.stderr.write(
+            "####\n"
+            f"WARNING: {args.index} only covers part of the countsfile rows "
+            f"(shard: {index.shard}, nrows: {index.nrows})\n"
+        )
+    sys.stderr.write(
+        "####\n"
+        f"Loaded presence of {len(index.asvs)} ASVs in {len(index.samples)} "
+        f"samples from {args.index}\n"
+    )
+    blanks = []
+    metadata = None
+    if args.metadata:
+        metadata = read_metadata(args.metadata, index_name=args.metadata_index_name)
+        if not args.noblanks:
+            blanks = list(
+                metadata.loc[metadata[args.sample_type_col].isin(args.blank_val)].index
+            )
+            sys.stderr.write("####\n" f"Found {len(blanks)} blanks in metadata\n")
+    if args.subset_val:
+        # Occurrence in non-blank samples of a subset, as in generate-statsfile
+        subset = metadata.loc[metadata[args.subset_col] == args.subset_val].index
+        samples = [s for s in subset if s not in blanks]
+        dataframe = pd.DataFrame(index.occurrence(samples), columns=["occurrence"])
+    else:
+        # Occurrence in blanks for each dataset, as in clean-asv-data
+        if metadata is None:
+            datasets = {"dataset": index.samples}
+        else:
+            datasets = {
+                val: metadata.loc[metadata[args.split_col] == val].index
+                for val in metadata[args.split_col].unique()
+            }
+        frames = []
+        for dataset, samples in datasets.items():
+            df = blank_occurrence(index, blanks, samples)
+            df.insert(0, "dataset", dataset)
+            frames.append(df)
+        dataframe = pd.concat(frames)
+    with sys.stdout as fhout:
+        dataframe.to_csv(fhout, sep="\t")
+
+
+def main_cli():
+    parser = ArgumentParser(
+        description="Answers occurrence queries from a presence index written "
+        "with --presence_index, without reading the countsfile"
+    )
+    parser.add_argument("index", type=str, help="Presence index file")
+    parser.add_argument(
+        "--countsfile",
+        type=str,
+        help="If given, check that the index is up to date with this countsfile. "
+        "A countsfile set in the configfile is not used for the check",
+    )
+    parser.add_argument(
+        "--configfile",
+        type=str,
+        default="config.yml",
+        help="Path to a yaml-format configuration file. Can be used to set arguments.",
+    )
+    parser.add_argument(
+        "--metadata", type=str, help="Tab-separated file with metadata for each sample"
+    )
+    parser.add_argument(
+        "--metadata_index_name",
+        type=str,
+        help="Name of column in metadata file that contains sample ids (default: 'sampleID_NGI'))",
+        default="sampleID_NGI",
+    )
+    parser.add_argument(
+        "--split_col",
+        type=str,
+        default="dataset",
+        help="Column in metadata by which to split samples when calculating "
+        "occurrence in blanks (default: 'dataset')",
+    )
+    parser.add_argument(
+        "--sample_type_col",
+        type=str,
+        default="lab_sample_type",
+        help="Use this column in metadata to identify sample type (default 'lab_sample_type')",
+    )
+    parser.add_argument(
+        "--blank_val",
+        type=str,
+        nargs="+",
+        default=["buffer_blank", "extraction_neg", "pcr_neg"],
+        help="Values in <sample_type_col> that identify blanks (default 'buffer_blank', 'extraction_neg', 'pcr_neg')",
+    )
+    parser.add_argument(
+        "--noblanks",
+        action="store_true",
+        help="Ignore blanks",
+    )
+    parser.add_argument(
+        "--subset_col",
+        type=str,
+        default="dataset",
+        help="Column in metadata to use for subsetting samples on (default: 'dataset')",
+    )
+    parser.add_argument(
+        "--subset_val",
+        type=str,
+        help="Report occurrence of ASVs in the non-blank samples with this value "
+        "in <subset_col> instead of occurrence in blanks",
+    )
+    args = parser.parse_args()
+    main(args)
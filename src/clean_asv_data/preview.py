@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+import math
+import sys
+import pandas as pd
+from clean_asv_data.__main__ import sample_rows
+
+# z-score for 95% confidence intervals
+Z = 1.96
+
+
+def sample_counts(countsfile, n_rows=None, fraction=None, method="seek", seed=None):
+    """
+    Samples rows from the counts file for a preview run
+
+    :return: tuple of (file-like object with sampled rows, number of sampled
+    rows, estimated number of rows in the counts file)
+    """
+    sample, n, n_total = sample_rows(
+        countsfile, n_rows=n_rows, fraction=fraction, method=method, seed=seed
+    )
+    sys.stderr.write(
+        "####\n"
+        f"Sampled {n} of {'~' if method == 'seek' else ''}{n_total} rows "
+        f"from {countsfile} ({method})\n"
+    )
+    return sample, n, n_total
+
+
+def proportion_estimate(statistic, k, n, n_total, dataset=None):
+    """
+    Estimates the number of rows in the file with some property from <k> of
+    <n> sampled rows having it, with a Wilson score interval
+    """
+    if n == 0:
+        return _row(dataset, statistic, float("nan"), float("nan"), float("nan"), n)
+    p = k / n
+    denom = 1 + Z**2 / n
+    centre = (p + Z**2 / (2 * n)) / denom
+    half = Z * math.sqrt(p * (1 - p) / n + Z**2 / (4 * n**2)) / denom
+    return _row(
+        dataset,
+        statistic,
+        p * n_total,
+        max(centre - half, 0) * n_total,
+        min(centre + half, 1) * n_total,
+        n,
+    )
+
+
+def total_estimate(statistic, values, n_total, dataset=None):
+    """
+    Estimates the sum of a per-row value over all rows in the file from the
+    sampled <values>, with a normal interval and finite population correction
+    """
+    n = len(values)
+    if n == 0:
+        return _row(dataset, statistic, float("nan"), float("nan"), float("nan"), n)
+    estimate = n_total * values.mean()
+    sd = values.std(ddof=1) if n > 1 else 0.0
+    se = n_total * sd / math.sqrt(n) * math.sqrt(max(1 - n / n_total, 0))
+    return _row(dataset, statistic, estimate, estimate - Z * se, estimate + Z * se, n)
+
+
+def mean_estimate(statistic, values, dataset=None):
+    """
+    Estimates the mean of a per-row value from the sampled <values>
+    """
+    n = len(values)
+    if n == 0:
+        return _row(dataset, statistic, float("nan"), float("nan"), float("nan"), n)
+    sd = values.std(ddof=1) if n > 1 else 0.0
+    se = sd / math.sqrt(n)
+    mean = values.mean()
+    return _row(dataset, statistic, mean, mean - Z * se, mean + Z * se, n)
+
+
+def depth_estimates(df, n_total, dataset=None):
+    """
+    Estimates total reads of each sample (column) in <df> and summarises the
+    read depth distribution across samples
+    """
+    rows = [
+        total_estimate(f"reads:{sample}", df[sample], n_total, dataset)
+        for sample in df.columns
+    ]
+    depths = pd.Series([row["estimate"] for row in rows], dtype=float)
+    for q in [0, 0.25, 0.5, 0.75, 1]:
+        rows.append(
+            _row(
+                dataset,
+                f"sample_reads_quantile_{q}",
+                depths.quantile(q) if len(depths) > 0 else float("nan"),
+                float("nan"),
+                float("nan"),
+                df.shape[0],
+            )
+        )
+    return rows
+
+
+def write_report(rows, fhout=sys.stdout):
+    """
+    Writes preview estimates as a tab-separated table
+    """
+    report = pd.DataFrame(
+        rows,
+        columns=["dataset", "statistic", "estimate", "ci_low", "ci_high", "n_sampled"],
+    )
+    report.to_csv(fhout, sep="\t", index=False)
+
+
+def _row(dataset, statistic, estimate, ci_low, ci_high, n):
+    return {
+        "dataset": dataset,
+        "statistic": statistic,
+        "estimate": estimate,
+        "ci_low": ci_low,
+        "ci_high": ci_high,
+        "n_sampled": n,
+    }
@@ -18,7 +18,7 @@ def generate_subs(regex, regex_split):
     return subs
 
 
-def read_and_rename(f, regex, regex_split, chunksize=None, nrows=None):
+def read_and_rename(f, regex, regex_split, chunksize=None, nrows=None, prefetch=0):
     """
     Reads a file and renames the sample names in columns
 
@@ -27,10 +27,11 @@ def read_and_rename(f, regex, regex_split, chunksize=None, nrows=None):
     :param regex_split: character used to split the regex into pattern and replace
     :param chunksize: number of rows to read from the input file at a time
     :param nrows: number of total rows to read from the file
+    :param prefetch: number of chunks to read ahead in a background thread
     :return:
     """
     subs = generate_subs(regex, regex_split)
-    reader = generate_reader(f, chunksize, nrows)
+    reader = generate_reader(f, chunksize, nrows, prefetch=prefetch)
     sys.stderr.write(f"#Renaming samples in {f}\n")
     with sys.stdout as fhout:
         for i, df in enumerate(tqdm.tqdm(reader, unit=" chunks")):
@@ -46,7 +47,12 @@ def read_and_rename(f, regex, regex_split, chunksize=None, nrows=None):
 def main(args):
     args = read_config(args.configfile, args)
     read_and_rename(
-        args.input, args.regex, args.regex_split, args.chunksize, args.nrows
+        args.input,
+        args.regex,
+        args.regex_split,
+        args.chunksize,
+        args.nrows,
+        prefetch=args.prefetch,
     )
 
 
@@ -84,6 +90,12 @@ def main_cli():
         help="If input file is very large, specify chunksize "
         "to read it in a number of lines at a time",
     )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        help="Number of chunks to read ahead from the input file in a background "
+        "thread (default 0, no prefetching)",
+    )
     parser.add_argument("--nrows", type=int, help=argparse.SUPPRESS)
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+from argparse import ArgumentParser
+import io
+import json
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+from clean_asv_data.__main__ import (
+    file_fingerprint,
+    is_partition,
+    read_clustfile,
+    read_config,
+)
+
+ROWINDEX_FORMAT = "clean_asv_data.rowindex"
+ROWINDEX_VERSION = 1
+
+
+class RowIndex:
+    """
+    Byte offsets of the rows of an uncompressed countsfile, keyed by ASV id.
+    Ids are stored sorted so that any set of ASVs is located with a binary
+    search, after which only the matching lines are read and parsed.
+    """
+
+    def __init__(self, countsfile, asvs, offsets, lengths, header, fingerprint=None):
+        self.countsfile = countsfile
+        self.asvs = asvs
+        self.offsets = offsets
+        self.lengths = lengths
+        self.header = header
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def build(cls, countsfile):
+        """
+        Scans <countsfile> once and records the offset and length of each row
+        """
+        if str(countsfile).endswith(".gz"):
+            raise ValueError("Row indexes can not be built for compressed files")
+        sys.stderr.write("####\n" f"Indexing rows of {countsfile}\n")
+        start = time.time()
+        fingerprint = file_fingerprint(countsfile)
+        asvs = []
+        offsets = []
+        lengths = []
+        with open(countsfile, "rb") as fhin:
+            header = fhin.readline()
+            pos = len(header)
+            for line in fhin:
+                n = len(line)
+                if line.strip():
+                    asvs.append(line[: line.find(b"\t")].decode())
+                    offsets.append(pos)
+                    lengths.append(n)
+                pos += n
+        asvs = np.array(asvs, dtype=str)
+        order = np.argsort(asvs, kind="stable")
+        index = cls(
+            countsfile,
+            asvs[order],
+            np.array(offsets, dtype=np.int64)[order],
+            np.array(lengths, dtype=np.int64)[order],
+            header.decode(),
+            fingerprint=fingerprint,
+        )
+        sys.stderr.write(
+            "####\n"
+            f"Indexed {len(asvs)} rows in {time.time() - start:.1f} seconds\n"
+        )
+        return index
+
+    def save(self, f):
+        meta = {
+            "format": ROWINDEX_FORMAT,
+            "version": ROWINDEX_VERSION,
+            "fingerprint": self.fingerprint,
+            "header": self.header,
+        }
+        # Written uncompressed so that the arrays load without decompression
+        with open(f, "wb") as fhout:
+            np.savez(
+                fhout,
+                meta=np.array(json.dumps(meta)),
+                asvs=self.asvs,
+                offsets=self.offsets,
+                lengths=self.lengths,
+            )
+
+    @classmethod
+    def load(cls, f, countsfile):
+        """
+        Loads a row index from file, checking that it was built from the
+        current version of <countsfile>
+        """
+        with np.load(f, allow_pickle=False) as archive:
+            meta = json.loads(str(archive["meta"]))
+            if meta.get("format") != ROWINDEX_FORMAT:
+                raise ValueError(f"{f} is not a row index")
+            if meta["version"] > ROWINDEX_VERSION:
+                raise ValueError(
+                    f"{f} has row index version {meta['version']}, "
+                    f"only versions <= {ROWINDEX_VERSION} are supported"
+                )
+            current = file_fingerprint(countsfile)
+            stored = meta["fingerprint"] or {}
+            if any(stored.get(k) != current[k] for k in ["size", "mtime"]):
+                raise ValueError(f"{f} is out of date with {countsfile}")
+            return cls(
+                countsfile,
+                archive["asvs"],
+                archive["offsets"],
+                archive["lengths"],
+                meta["header"],
+                fingerprint=meta["fingerprint"],
+            )
+
+    def locate(self, asvs):
+        """
+        Returns positions in the index of <asvs>, and the ids not found
+        """
+        asvs = np.array(list(dict.fromkeys(asvs)), dtype=str)
+        pos = np.searchsorted(self.asvs, asvs)
+        pos[pos == len(self.asvs)] = 0
+        found = (
+            self.asvs[pos] == asvs
+            if len(self.asvs) > 0
+            else np.zeros(len(asvs), dtype=bool)
+        )
+        return pos[found], list(asvs[~found])
+
+    def lookup(self, asvs):
+        """
+        Reads the rows of <asvs> from the countsfile
+
+        :param asvs: List of ASV ids
+        :return: dataframe with counts of the ASVs found, in the order of the
+        countsfile, and a list of ASVs not in the countsfile
+        """
+        pos, missing = self.locate(asvs)
+        # Read in file order to keep seeks short and forward
+        pos = pos[np.argsort(self.offsets[pos])]
+        lines = [self.header.encode()]
+        with open(self.countsfile, "rb") as fhin:
+            for offset, length in zip(self.offsets[pos], self.lengths[pos]):
+                fhin.seek(offset)
+                line = fhin.read(length)
+                lines.append(line if line.endswith(b"\n") else line + b"\n")
+        df = pd.read_csv(io.BytesIO(b"".join(lines)), sep="\t", index_col=0, header=0)
+        return df, missing
+
+
+def default_index_file(countsfile):
+    return f"{countsfile}.rowidx.npz"
+
+
+def load_or_build(countsfile, f=None, rebuild=False):
+    """
+    Loads the row index of <countsfile> from <f> (default <countsfile>.rowidx.npz),
+    building and saving it first if it is missing or out of date
+    """
+    f = f or default_index_file(countsfile)
+    if os.path.exists(f) and not rebuild:
+        try:
+            return RowIndex.load(f, countsfile)
+        except ValueError as e:
+            sys.stderr.write("####\n" f"WARNING: {e}, rebuilding\n")
+    index = RowIndex.build(countsfile)
+    sys.stderr.write("####\n" f"Writing row index to {f}\n")
+    index.save(f)
+    return index
+
+
+def cluster_members(clustfile, clusters, clust_column="cluster"):
+    """
+    Returns ids of ASVs in <clusters> according to <clustfile>
+    """
+    clustdf = read_clustfile(clustfile, columns=[clust_column])
+    # Clusters are given as strings, also numeric ones
+    clustdf[clust_column] = clustdf[clust_column].astype(str)
+    members = clustdf.loc[clustdf[clust_column].isin(clusters)]
+    missing = set(clusters).difference(members[clust_column])
+    if len(missing) > 0:
+        sys.stderr.write(
+            "####\n"
+            f"WARNING: {len(missing)} clusters not found in {clustfile}: "
+            f"{', '.join(sorted(missing))}\n"
+        )
+    return list(members.index)
+
+
+def main(args):
+    args = read_config(args.configfile, args)
+    if str(args.countsfile).endswith(".gz") or is_partition(args.countsfile):
+        sys.exit("ERROR: Row lookups require an uncompressed tab-separated countsfile")
+    index = load_or_build(args.countsfile, args.index, rebuild=args.rebuild)
+    asvs = list(args.asv or [])
+    if args.asvfile:
+        with open(args.asvfile, "r") as fhin:
+            asvs += [line.rstrip().split("\t")[0] for line in fhin if line.strip()]
+    if args.cluster:
+        if not args.clustfile:
+            sys.exit("ERROR: --cluster requires --clustfile")
+        asvs += cluster_members(args.clustfile, args.cluster, args.clust_column)
+    if len(asvs) == 0:
+        return
+    start = time.time()
+    dataframe, missing = index.lookup(asvs)
+    sys.stderr.write(
+        "####\n"
+        f"Read {dataframe.shape[0]} rows in {(time.time() - start) * 1000:.1f} ms\n"
+    )
+    if len(missing) > 0:
+        sys.stderr.write(
+            "####\n" f"WARNING: {len(missing)} ASVs not found in {args.countsfile}\n"
+        )
+    with open(args.output, "w") if args.output else sys.stdout as fhout:
+        dataframe.to_csv(fhout, sep="\t")
+
+
+def main_cli():
+    parser = ArgumentParser(
+        description="Reads the rows of selected ASVs, or of the members of "
+        "selected clusters, from a countsfile without scanning it. A byte "
+        "offset index of the countsfile rows is built on first use and rebuilt "
+        "when the countsfile changes."
+    )
+    parser.add_argument(
+        "--countsfile", type=str, required=True, help="Uncompressed counts file"
+    )
+    parser.add_argument(
+        "--index",
+        type=str,
+        help="Row index file (default: <countsfile>.rowidx.npz)",
+    )
+    parser.add_argument(
+        "--rebuild", action="store_true", help="Rebuild the row index"
+    )
+    parser.add_argument("--asv", type=str, nargs="+", help="ASV ids to look up")
+    parser.add_argument(
+        "--asvfile",
+        type=str,
+        help="File with ASV ids to look up in the first column, e.g. a list "
+        "of ASVs removed by clean-asv-data",
+    )
+    parser.add_argument(
+        "--cluster",
+        type=str,
+        nargs="+",
+        help="Look up the member ASVs of these clusters (requires --clustfile)",
+    )
+    parser.add_argument(
+        "--clustfile",
+        type=str,
+        help="Tab-separated file with ASV ids in first column and a column specifying "
+        "the cluster it belongs to",
+    )
+    parser.add_argument(
+        "--clust_column",
+        type=str,
+        default="cluster",
+        help="Name of cluster column (default: 'cluster')",
+    )
+    parser.add_argument(
+        "-o", "--output", type=str, help="Write rows to this file instead of stdout"
+    )
+    parser.add_argument(
+        "--configfile",
+        type=str,
+        default="config.yml",
+        help="Path to a yaml-format configuration file. Can be used to set arguments.",
+    )
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,687 @@
+#!/usr/bin/env python
+import argparse
+from argparse import ArgumentParser
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import os
+import pickle
+import socketserver
+import stat
+import sys
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+import pandas as pd
+import tqdm
+from clean_asv_data.__main__ import (
+    file_fingerprint,
+    generate_reader,
+    read_clustfile,
+    read_config,
+    read_metadata,
+)
+from clean_asv_data.clean_asv_data import (
+    CleaningPlan,
+    clean_by_taxonomy,
+)
+from clean_asv_data.consensus_taxonomy import resolve_cluster_thresholds
+
+COUNTS_CACHE_FORMAT = "clean_asv_data.counts_cache"
+COUNTS_CACHE_VERSION = 1
+
+
+def load_counts(countsfile, chunksize=None, nrows=None, cache=None):
+    """
+    Reads the whole counts file into memory. If <cache> is given the counts
+    are read from this file if it is up to date with the counts file,
+    otherwise they are saved to it after reading.
+    """
+    if cache is not None and os.path.exists(cache):
+        with open(cache, "rb") as fhin:
+            cached = pickle.load(fhin)
+        if not isinstance(cached, dict) or cached.get("format") != COUNTS_CACHE_FORMAT:
+            raise ValueError(f"{cache} is not a counts cache")
+        current = file_fingerprint(countsfile)
+        if all(cached["fingerprint"][k] == current[k] for k in ["size", "mtime"]):
+            sys.stderr.write("####\n" f"Read counts from cache {cache}\n")
+            return cached["counts"]
+        sys.stderr.write("####\n" f"WARNING: {cache} is out of date with {countsfile}\n")
+    sys.stderr.write("####\n" f"Reading counts from {countsfile}\n")
+    reader = generate_reader(countsfile, chunksize, nrows)
+    counts = pd.concat([df for df in tqdm.tqdm(reader, unit=" chunks")])
+    if cache is not None:
+        sys.stderr.write("####\n" f"Writing counts cache to {cache}\n")
+        with open(cache, "wb") as fhout:
+            pickle.dump(
+                {
+                    "format": COUNTS_CACHE_FORMAT,
+                    "version": COUNTS_CACHE_VERSION,
+                    "fingerprint": file_fingerprint(countsfile),
+                    "counts": counts,
+                },
+                fhout,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+    return counts
+
+
+class AsvDataStore:
+    """
+    Counts matrix, clustfile and metadata held in memory to answer stats,
+    cluster count, consensus and cleaning queries without reading the input
+    files again. Aggregates that do not depend on query parameters (ASV sums
+    and per-dataset aggregates) are calculated once when the store is made.
+    The store is only read after that, so it can be queried from several
+    threads at the same time.
+    """
+
+    def __init__(
+        self,
+        counts,
+        clustdf,
+        metadata=None,
+        split_col="dataset",
+        blanks=None,
+        clust_column="cluster",
+        ranks=None,
+    ):
+        self.counts = counts
+        self.clustdf = clustdf
+        self.clust_column = clust_column
+        self.ranks = ranks or []
+        self.blanks = [b for b in (blanks or []) if b in set(counts.columns)]
+        if metadata is None:
+            metadata = pd.DataFrame(
+                data={"dataset": ["dataset"] * counts.shape[1]}, index=counts.columns
+            )
+            split_col = "dataset"
+        self.metadata = metadata
+        self.split_col = split_col
+        # ASV sums across all non-blank samples, ordered as in consensus-taxonomy
+        asv_sum = pd.DataFrame(
+            counts.drop(self.blanks, axis=1).sum(axis=1), columns=["ASV_sum"]
+        ).sort_values(by="ASV_sum", ascending=False)
+        self.consensus_df = pd.merge(
+            asv_sum,
+            clustdf.loc[:, [clust_column] + self.ranks],
+            left_index=True,
+            right_index=True,
+        )
+        self.consensus_groups = self.consensus_df.groupby(
+            clust_column, observed=True
+        ).indices
+        self.cluster_asvs = clustdf.groupby(clust_column, observed=True).indices
+        # Cluster of each row in the counts matrix
+        self.asv_clusters = (
+            clustdf.loc[~clustdf.index.duplicated(), clust_column]
+            .reindex(counts.index)
+        )
+        self.datasets = {}
+        for val in metadata[split_col].dropna().unique():
+            samples = [
+                s
+                for s in counts.columns
+                if s in set(metadata.loc[metadata[split_col] == val].index)
+            ]
+            if len(samples) > 0:
+                self.datasets[val] = self.dataset_aggregates(samples)
+
+    def dataset_aggregates(self, samples):
+        """
+        Calculates the same aggregates as clean-asv-data for one dataset
+        """
+        blanks = [s for s in samples if s in set(self.blanks)]
+        df = self.counts.loc[:, samples].drop(blanks, axis=1)
+        aggregates = pd.DataFrame({"ASV_sum": df.sum(axis=1), "ASV_max": df.max(axis=1)})
+        if len(blanks) > 0:
+            aggregates["in_n_blanks"] = self.counts.loc[:, blanks].gt(0).sum(axis=1)
+            aggregates["in_percent_blanks"] = (
+                aggregates["in_n_blanks"].div(len(blanks)) * 100
+            )
+        return {"samples": samples, "blanks": blanks, "aggregates": aggregates}
+
+    def samples(self, subset_col=None, subset_val=None):
+        """
+        Returns non-blank samples, optionally only those with <subset_val> in
+        <subset_col> of the metadata
+        """
+        samples = [s for s in self.counts.columns if s not in set(self.blanks)]
+        if subset_col and subset_val is not None:
+            if subset_col not in self.metadata.columns:
+                raise ValueError(f"Unknown metadata column '{subset_col}'")
+            subset = set(
+                self.metadata.loc[
+                    self.metadata[subset_col].astype(str) == str(subset_val)
+                ].index
+            )
+            samples = [s for s in samples if s in subset]
+        return samples
+
+    def stats(self, asvs=None, subset_col=None, subset_val=None, top=None, top_by="reads"):
+        """
+        Reads and occurrence of ASVs, as written by generate-statsfile
+        """
+        df = self.counts.loc[:, self.samples(subset_col, subset_val)]
+        if asvs:
+            df = df.loc[df.index.isin(asvs)]
+        stats = pd.DataFrame({"reads": df.sum(axis=1), "occurrence": df.gt(0).sum(axis=1)})
+        if top:
+            stats = stats.nlargest(top, top_by)
+        stats.index.name = "ASV"
+        return stats
+
+    def cluster_counts(self, clusters=None, subset_col=None, subset_val=None):
+        """
+        Reads of clusters in each sample, as written by count-clusters
+        """
+        if not clusters:
+            clusters = list(self.cluster_asvs.keys())
+        unknown = [c for c in clusters if c not in self.cluster_asvs]
+        if len(unknown) > 0:
+            raise KeyError(f"Unknown cluster(s): {', '.join(map(str, unknown))}")
+        samples = self.samples(subset_col, subset_val)
+        rows = self.asv_clusters.isin(clusters).to_numpy()
+        df = (
+            self.counts.loc[rows, samples]
+            .groupby(self.asv_clusters[rows], observed=True)
+            .sum()
+            .reindex(clusters, fill_value=0)
+        )
+        df.index.name = self.clust_column
+        return df
+
+    def consensus(self, clusters=None, thresholds=None, consensus_ranks=None):
+        """
+        Consensus taxonomy of clusters at one or more thresholds
+        """
+        thresholds = thresholds or [80]
+        consensus_ranks = consensus_ranks or ["Family", "Genus", "Species", "BOLD_bin"]
+        missing = [r for r in consensus_ranks if r not in self.ranks]
+        if len(missing) > 0:
+            raise ValueError(f"Rank(s) not loaded: {', '.join(missing)}")
+        if not clusters:
+            clusters = list(self.consensus_groups.keys())
+        unknown = [c for c in clusters if c not in self.consensus_groups]
+        if len(unknown) > 0:
+            raise KeyError(f"Unknown cluster(s): {', '.join(map(str, unknown))}")
+        cons_ranks_reversed = list(reversed(consensus_ranks))
+        records = []
+        for cluster in clusters:
+            rows = self.consensus_df.iloc[self.consensus_groups[cluster]]
+            resolved = resolve_cluster_thresholds(
+                rows, self.ranks, cons_ranks_reversed, thresholds
+            )
+            for t in thresholds:
+                records.append({"cluster": cluster, "threshold": t, **resolved[t]})
+        return pd.DataFrame(records).set_index("cluster")
+
+    def add_cluster_blanks(self, df, blanks):
+        """
+        Adds the occurrence in <blanks> of the cluster of each ASV in <df>,
+        i.e. the number of blanks in which any ASV of the cluster in <df> is
+        present, as in clean-asv-data --blank_removal_mode cluster_occurrence
+        """
+        present = self.counts.loc[df.index, blanks].gt(0)
+        n_blanks = present.groupby(df["cluster"], observed=True).any().sum(axis=1)
+        df["cluster_in_n_blanks"] = (
+            n_blanks.reindex(df["cluster"]).fillna(0).astype("int64").to_numpy()
+        )
+        df["cluster_in_percent_blanks"] = (
+            df["cluster_in_n_blanks"].div(len(blanks)) * 100
+        )
+
+    def clean(
+        self,
+        clean_rank="Family",
+        skip_ambig=False,
+        skip_unclass=False,
+        blank_removal_mode="asv",
+        max_blank_occurrence=5,
+        min_clust_count=3,
+        list_asvs=False,
+    ):
+        """
+        Summarizes what is retained by clean-asv-data with the given parameters
+        """
+        if clean_rank not in self.clustdf.columns:
+            raise ValueError(f"Rank '{clean_rank}' not loaded")
+        asv_taxa = clean_by_taxonomy(
+            self.clustdf.loc[:, [self.clust_column, clean_rank]].rename(
+                columns={self.clust_column: "cluster"}
+            ),
+            skip_ambig=skip_ambig,
+            skip_unclass=skip_unclass,
+            rank=clean_rank,
+        )
+        result = {}
+        for dataset, data in self.datasets.items():
+            df = pd.merge(asv_taxa, data["aggregates"], left_index=True, right_index=True)
+            if blank_removal_mode == "cluster_occurrence" and len(data["blanks"]) > 0:
+                self.add_cluster_blanks(df, data["blanks"])
+            df = (
+                CleaningPlan(df)
+                .by_blanks(
+                    blanks=data["blanks"],
+                    mode=blank_removal_mode,
+                    max_blank_occurrence=max_blank_occurrence,
+                )
+                .by_reads(min_clust_count=min_clust_count)
+                .materialize()
+            )
+            result[dataset] = {
+                "n_samples": len(data["samples"]) - len(data["blanks"]),
+                "n_blanks": len(data["blanks"]),
+                "n_asvs": int(df.shape[0]),
+                "n_clusters": int(df["cluster"].nunique()),
+                "reads": float(df["ASV_sum"].sum()),
+            }
+            if list_asvs:
+                result[dataset]["asvs"] = list(df.index)
+        return result
+
+
+class LatencyMetrics:
+    """
+    Keeps the latency of the last <window> requests to each endpoint and
+    counts of requests and errors
+    """
+
+    def __init__(self, window=10000):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.latencies = defaultdict(lambda: deque(maxlen=window))
+        self.requests = defaultdict(int)
+        self.errors = defaultdict(int)
+
+    def record(self, endpoint, seconds, status):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            self.requests[endpoint] += 1
+            if status >= 400:
+                self.errors[endpoint] += 1
+
+    def to_dict(self):
+        with self._lock:
+            latencies = {k: np.array(v) * 1000 for k, v in self.latencies.items()}
+            endpoints = {}
+            for endpoint, ms in latencies.items():
+                endpoints[endpoint] = {
+                    "requests": self.requests[endpoint],
+                    "errors": self.errors[endpoint],
+                    "mean_ms": round(float(ms.mean()), 3),
+                    "p50_ms": round(float(np.percentile(ms, 50)), 3),
+                    "p95_ms": round(float(np.percentile(ms, 95)), 3),
+                    "p99_ms": round(float(np.percentile(ms, 99)), 3),
+                    "max_ms": round(float(ms.max()), 3),
+                }
+        return {"uptime_s": round(time.time() - self.started, 1), "endpoints": endpoints}
+
+
+def _list(params, key):
+    """
+    Returns values of a query parameter given several times or comma-separated
+    """
+    return [x for value in params.get(key, []) for x in value.split(",") if x != ""]
+
+
+def _value(params, key, default=None, type=str):
+    values = params.get(key)
+    if not values:
+        return default
+    if type is bool:
+        return values[-1].lower() in ["1", "true", "yes"]
+    try:
+        return type(values[-1])
+    except ValueError:
+        raise ValueError(f"Invalid value for '{key}': {values[-1]}")
+
+
+def query_stats(store, params, defaults):
+    return store.stats(
+        asvs=_list(params, "asv"),
+        subset_col=_value(params, "subset_col", defaults.get("subset_col")),
+        subset_val=_value(params, "subset_val"),
+        top=_value(params, "top", type=int),
+        top_by=_value(params, "top_by", "reads"),
+    )
+
+
+def query_cluster_counts(store, params, defaults):
+    return store.cluster_counts(
+        clusters=_list(params, "cluster"),
+        subset_col=_value(params, "subset_col", defaults.get("subset_col")),
+        subset_val=_value(params, "subset_val"),
+    )
+
+
+def query_consensus(store, params, defaults):
+    thresholds = [int(t) for t in _list(params, "threshold")]
+    if len(thresholds) == 0:
+        thresholds = defaults.get("consensus_threshold") or [80]
+        if not isinstance(thresholds, list):
+            thresholds = [thresholds]
+    return store.consensus(
+        clusters=_list(params, "cluster"),
+        thresholds=thresholds,
+        consensus_ranks=_list(params, "consensus_rank")
+        or defaults.get("consensus_ranks"),
+    )
+
+
+def query_clean(store, params, defaults):
+    return store.clean(
+        clean_rank=_value(params, "clean_rank", defaults.get("clean_rank") or "Family"),
+        skip_ambig=_value(params, "skip_ambig", bool(defaults.get("skip_ambig")), bool),
+        skip_unclass=_value(
+            params, "skip_unclass", bool(defaults.get("skip_unclass")), bool
+        ),
+        blank_removal_mode=_value(
+            params, "blank_removal_mode", defaults.get("blank_removal_mode") or "asv"
+        ),
+        max_blank_occurrence=_value(
+            params,
+            "max_blank_occurrence",
+            defaults.get("max_blank_occurrence", 5),
+            float,
+        ),
+        min_clust_count=_value(
+            params, "min_clust_count", defaults.get("min_clust_count", 3), float
+        ),
+        list_asvs=_value(params, "asvs", False, bool),
+    )
+
+
+ENDPOINTS = {
+    "stats": query_stats,
+    "cluster_counts": query_cluster_counts,
+    "consensus": query_consensus,
+    "clean": query_clean,
+}
+
+
+def to_arrow(df):
+    """
+    Serializes a dataframe as an Arrow IPC stream
+    """
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise ValueError("Arrow responses require pyarrow")
+    table = pa.Table.from_pandas(df.reset_index())
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """
+    Answers GET requests to /<endpoint>?<params> with JSON, or an Arrow IPC
+    stream for tables with format=arrow. /metrics reports request latencies.
+    """
+
+    server_version = "clean_asv_data"
+
+    def do_GET(self):
+        start = time.perf_counter()
+        url = urlparse(self.path)
+        endpoint = url.path.strip("/")
+        params = parse_qs(url.query)
+        status = 200
+        try:
+            if endpoint == "metrics":
+                result = self.server.metrics.to_dict()
+            elif endpoint == "health":
+                result = {"status": "ok"}
+            elif endpoint in ENDPOINTS:
+                result = ENDPOINTS[endpoint](
+                    self.server.store, params, self.server.defaults
+                )
+            else:
+                status = 404
+                result = {"error": f"Unknown endpoint '/{endpoint}'"}
+        except KeyError as e:
+            status = 404
+            result = {"error": str(e.args[0]) if e.args else str(e)}
+        except ValueError as e:
+            status = 400
+            result = {"error": str(e)}
+        except Exception as e:
+            status = 500
+            result = {"error": f"{type(e).__name__}: {e}"}
+        if isinstance(result, pd.DataFrame) and _value(params, "format") == "arrow":
+            try:
+                self.respond(status, to_arrow(result), "application/vnd.apache.arrow.stream")
+            except ValueError as e:
+                status = 400
+                self.respond_json(status, {"error": str(e)})
+        elif isinstance(result, pd.DataFrame):
+            body = result.reset_index().to_json(orient="records")
+            self.respond(status, body.encode(), "application/json")
+        else:
+            self.respond_json(status, result)
+        if endpoint != "metrics":
+            if endpoint not in ENDPOINTS and endpoint != "health":
+                endpoint = "unknown"
+            self.server.metrics.record(endpoint, time.perf_counter() - start, status)
+
+    def respond_json(self, status, obj):
+        self.respond(status, json.dumps(obj, default=str).encode(), "application/json")
+
+    def respond(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Clients connecting over a unix socket have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(store, host="127.0.0.1", port=8000, socket=None, defaults=None, quiet=False):
+    """
+    Sets up a server answering queries to <store> in one thread per request,
+    on a unix <socket> if given, otherwise on <host>:<port>
+    """
+    if socket is not None:
+        # Only replace a socket left behind by an earlier server
+        if os.path.exists(socket):
+            if not stat.S_ISSOCK(os.stat(socket).st_mode):
+                sys.exit(f"ERROR: {socket} exists and is not a socket")
+            os.remove(socket)
+        server = ThreadingUnixHTTPServer(socket, QueryHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), QueryHandler)
+    server.store = store
+    server.defaults = defaults or {}
+    server.metrics = LatencyMetrics()
+    server.quiet = quiet
+    return server
+
+
+def main(args):
+    args = read_config(args.configfile, args)
+    metadata = None
+    blanks = None
+    if args.metadata:
+        metadata = read_metadata(args.metadata, index_name=args.metadata_index_name)
+        if not args.noblanks:
+            blanks = list(
+                metadata.loc[metadata[args.sample_type_col].isin(args.blank_val)].index
+            )
+            sys.stderr.write("####\n" f"Found {len(blanks)} blanks in metadata\n")
+    ranks = list(dict.fromkeys(args.ranks + args.consensus_ranks))
+    labels = list(dict.fromkeys([args.clust_column] + ranks + [args.clean_rank]))
+    sys.stderr.write("####\n" f"Reading clustfile {args.clustfile}\n")
+    clustdf = read_clustfile(args.clustfile, columns=labels, categorical=labels)
+    counts = load_counts(
+        args.countsfile, chunksize=args.chunksize, nrows=args.nrows, cache=args.counts_cache
+    )
+    store = AsvDataStore(
+        counts,
+        clustdf,
+        metadata=metadata,
+        split_col=args.split_col,
+        blanks=blanks,
+        clust_column=args.clust_column,
+        ranks=ranks,
+    )
+    defaults = {
+        key: getattr(args, key, None)
+        for key in [
+            "subset_col",
+            "consensus_threshold",
+            "consensus_ranks",
+            "clean_rank",
+            "skip_ambig",
+            "skip_unclass",
+            "blank_removal_mode",
+            "max_blank_occurrence",
+            "min_clust_count",
+        ]
+    }
+    server = make_server(
+        store,
+        host=args.host,
+        port=args.port,
+        socket=args.socket,
+        defaults=defaults,
+        quiet=args.quiet,
+    )
+    where = args.socket or f"http://{args.host}:{args.port}"
+    sys.stderr.write(
+        "####\n"
+        f"Serving {counts.shape[0]} ASVs in {counts.shape[1]} samples and "
+        f"{len(store.cluster_asvs)} clusters on {where}\n"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+def build_parser():
+    parser = ArgumentParser(
+        description="Loads the countsfile, clustfile and metadata once and "
+        "answers stats, cluster count, consensus and cleaning queries over a "
+        "local HTTP or unix socket. Endpoints: /stats, /cluster_counts, "
+        "/consensus, /clean, /metrics and /health"
+    )
+    parser.add_argument("--countsfile", type=str, help="Counts file of ASVs")
+    parser.add_argument(
+        "--counts_cache",
+        type=str,
+        help="Cache the parsed counts in this file so that the server starts "
+        "faster the next time (as long as the countsfile is unchanged)",
+    )
+    parser.add_argument(
+        "--clustfile",
+        type=str,
+        help="Taxonomy file for ASVs with cluster designation",
+    )
+    parser.add_argument(
+        "--metadata", type=str, help="Metadata file for splitting samples by datasets"
+    )
+    parser.add_argument(
+        "--metadata_index_name",
+        type=str,
+        help="Name of column in metadata file that contains sample ids",
+        default="sampleID_NGI",
+    )
+    parser.add_argument(
+        "--split_col",
+        type=str,
+        help="Name of column in metadata file by which to split samples",
+        default="dataset",
+    )
+    parser.add_argument(
+        "--sample_type_col",
+        type=str,
+        default="lab_sample_type",
+        help="Use this column in metadata to identify sample type (default 'lab_sample_type')",
+    )
+    parser.add_argument(
+        "--blank_val",
+        type=str,
+        nargs="+",
+        default=["buffer_blank", "extraction_neg", "pcr_neg"],
+        help="Values in <sample_type_col> that identify blanks (default 'buffer_blank', 'extraction_neg', 'pcr_neg')",
+    )
+    parser.add_argument(
+        "--noblanks",
+        action="store_true",
+        help="Ignore blanks",
+    )
+    parser.add_argument(
+        "--clust_column",
+        type=str,
+        help="Name of cluster column (default: 'cluster')",
+    )
+    parser.add_argument(
+        "--ranks",
+        nargs="+",
+        help="Ranks to load from the clustfile and include in consensus taxonomies",
+    )
+    parser.add_argument(
+        "--consensus_ranks",
+        nargs="+",
+        help="Default ranks used for calculating consensus",
+    )
+    parser.add_argument(
+        "--clean_rank",
+        type=str,
+        help="Default taxonomic rank used for cleaning",
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="Address to listen on (default: 127.0.0.1)",
+    )
+    parser.add_argument(
+        "--port", type=int, default=8000, help="Port to listen on (default: 8000)"
+    )
+    parser.add_argument(
+        "--socket",
+        type=str,
+        help="Listen on this unix socket instead of a TCP port",
+    )
+    parser.add_argument(
+        "--quiet", action="store_true", help="Do not log each request to stderr"
+    )
+    parser.add_argument(
+        "--configfile",
+        type=str,
+        default="config.yml",
+        help="Path to a yaml-format configuration file. Can be used to set arguments.",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=10000,
+        help="Number of lines to read at a time from the countsfile",
+    )
+    parser.add_argument("--nrows", type=int, help=argparse.SUPPRESS)
+    return parser
+
+
+def main_cli():
+    args = build_parser().parse_args()
+    main(args)
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+import datetime
+import os
+import shutil
+import sys
+import numpy as np
+import pandas as pd
+
+SPARSE_FORMATS = ["biom", "mtx", "parquet"]
+
+
+class SparseWriter:
+    """
+    Writes a table of counts with observations (clusters or ASVs) in rows and
+    samples in columns in a sparse format. Rows are added in chunks and only
+    the non-zero values of each chunk are written, so file size and write time
+    scale with the number of non-zeros.
+    """
+
+    def __init__(self, f, samples):
+        self.f = f
+        self.samples = pd.Index(samples)
+        self.n_rows = self.nnz = 0
+
+    def nonzero(self, df):
+        """
+        Returns row and column positions and values of non-zeros in <df>
+        """
+        values = df.reindex(columns=self.samples, fill_value=0).to_numpy()
+        rows, cols = np.nonzero(values)
+        return rows, cols, values[rows, cols]
+
+    def add(self, df):
+        raise NotImplementedError
+
+    def close(self):
+        sys.stderr.write(
+            "####\n"
+            f"Wrote {self.nnz} non-zero counts of {self.n_rows} rows in "
+            f"{len(self.samples)} samples to {self.f}\n"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MatrixMarketWriter(SparseWriter):
+    """
+    Writes a Matrix Market coordinate file. Since the header holds the number
+    of non-zeros, entries are written to a temporary file first. Row and
+    column ids are written to <f>.rows.txt and <f>.cols.txt.
+    """
+
+    def __init__(self, f, samples):
+        super().__init__(f, samples)
+        self.field = "integer"
+        self._entries = open(f"{f}.tmp", "w")
+        self._rows = open(f"{f}.rows.txt", "w")
+
+    def add(self, df):
+        rows, cols, values = self.nonzero(df)
+        if np.issubdtype(values.dtype, np.floating):
+            if np.all(np.mod(values, 1) == 0):
+                values = values.astype(np.int64)
+            else:
+                self.field = "real"
+        # Matrix Market indices are 1-based
+        pd.DataFrame(
+            {"row": rows + self.n_rows + 1, "col": cols + 1, "value": values}
+        ).to_csv(self._entries, sep=" ", header=False, index=False)
+        self._rows.writelines(f"{x}\n" for x in df.index)
+        self.n_rows += df.shape[0]
+        self.nnz += len(values)
+
+    def close(self):
+        self._entries.close()
+        self._rows.close()
+        with open(f"{self.f}.cols.txt", "w") as fhout:
+            fhout.writelines(f"{x}\n" for x in self.samples)
+        with open(self.f, "w") as fhout:
+            fhout.write(f"%%MatrixMarket matrix coordinate {self.field} general\n")
+            fhout.write(f"{self.n_rows} {len(self.samples)} {self.nnz}\n")
+            with open(f"{self.f}.tmp", "r") as fhin:
+                shutil.copyfileobj(fhin, fhout)
+        os.remove(f"{self.f}.tmp")
+        super().close()
+
+
+class ParquetCooWriter(SparseWriter):
+    """
+    Writes non-zero counts as (observation, sample, value) triplets to a
+    Parquet file, one row group per chunk. Requires pyarrow.
+    """
+
+    def __init__(self, f, samples, row_name="observation"):
+        super().__init__(f, samples)
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            sys.exit("ERROR: Parquet output requires pyarrow (pip install pyarrow)")
+        self.pa = pa
+        self.row_name = row_name
+        self.schema = pa.schema(
+            [
+                (row_name, pa.string()),
+                ("sample", pa.dictionary(pa.int32(), pa.string())),
+                ("value", pa.float64()),
+            ]
+        )
+        self._writer = pq.ParquetWriter(f, self.schema)
+        self._samples = pa.array(self.samples.astype(str))
+
+    def add(self, df):
+        pa = self.pa
+        rows, cols, values = self.nonzero(df)
+        table = pa.table(
+            {
+                self.row_name: pa.array(df.index.astype(str).to_numpy()[rows]),
+                "sample": pa.DictionaryArray.from_arrays(
+                    pa.array(cols.astype(np.int32)), self._samples
+                ),
+                "value": pa.array(values.astype(np.float64)),
+            },
+            schema=self.schema,
+        )
+        self._writer.write_table(table)
+        self.n_rows += df.shape[0]
+        self.nnz += len(values)
+
+    def close(self):
+        self._writer.close()
+        super().close()
+
+
+class BiomWriter(SparseWriter):
+    """
+    Writes a BIOM 2.1 (HDF5) table. The observation-major (CSR) matrix is
+    appended chunk by chunk; the sample-major (CSC) matrix is made from it
+    when the file is closed, using memory proportional to the number of
+    non-zeros. If <taxonomy> (a dataframe of rank labels indexed by
+    observation id) is given, it is stored as observation metadata.
+    Requires h5py.
+    """
+
+    def __init__(self, f, samples, taxonomy=None, table_type="OTU table"):
+        super().__init__(f, samples)
+        try:
+            import h5py
+        except ImportError:
+            sys.exit("ERROR: BIOM output requires h5py (pip install h5py)")
+        self.taxonomy = taxonomy
+        self.h5 = h5py.File(f, "w")
+        self.h5.attrs["id"] = os.path.basename(f)
+        self.h5.attrs["type"] = table_type
+        self.h5.attrs["format-url"] = "http://biom-format.org"
+        self.h5.attrs["format-version"] = [2, 1]
+        self.h5.attrs["generated-by"] = "clean_asv_data"
+        self.h5.attrs["creation-date"] = datetime.datetime.now().isoformat()
+        string = h5py.string_dtype()
+        obs = self.h5.create_group("observation")
+        obs.create_group("group-metadata")
+        self._ids = obs.create_dataset(
+            "ids", shape=(0,), maxshape=(None,), dtype=string, chunks=True
+        )
+        self._data = obs.create_dataset(
+            "matrix/data", shape=(0,), maxshape=(None,), dtype="f8", chunks=True
+        )
+        self._indices = obs.create_dataset(
+            "matrix/indices", shape=(0,), maxshape=(None,), dtype="i4", chunks=True
+        )
+        self._indptr = obs.create_dataset(
+            "matrix/indptr", data=[0], maxshape=(None,), dtype="i4", chunks=True
+        )
+        metadata = obs.create_group("metadata")
+        self._taxonomy = None
+        if taxonomy is not None:
+            self._taxonomy = metadata.create_dataset(
+                "taxonomy",
+                shape=(0, taxonomy.shape[1]),
+                maxshape=(None, taxonomy.shape[1]),
+                dtype=string,
+                chunks=True,
+            )
+
+    @staticmethod
+    def _append(dataset, values):
+        n = dataset.shape[0]
+        dataset.resize(n + len(values), axis=0)
+        dataset[n:] = values
+
+    def add(self, df):
+        rows, cols, values = self.nonzero(df)
+        row_nnz = np.bincount(rows, minlength=df.shape[0])
+        self._append(self._ids, df.index.astype(str).to_numpy(dtype=object))
+        self._append(self._data, values.astype(np.float64))
+        self._append(self._indices, cols.astype(np.int32))
+        self._append(self._indptr, (self.nnz + np.cumsum(row_nnz)).astype(np.int32))
+        if self._taxonomy is not None:
+            labels = self.taxonomy.reindex(df.index).fillna("unresolved")
+            self._append(self._taxonomy, labels.astype(str).to_numpy(dtype=object))
+        self.n_rows += df.shape[0]
+        self.nnz += len(values)
+
+    def close(self):
+        self.h5.attrs["shape"] = [self.n_rows, len(self.samples)]
+        self.h5.attrs["nnz"] = self.nnz
+        # Transpose the observation-major matrix into the sample-major one
+        indptr = self._indptr[:]
+        cols = self._indices[:]
+        rows = np.repeat(np.arange(self.n_rows, dtype=np.int32), np.diff(indptr))
+        order = np.argsort(cols, kind="stable")
+        del indptr
+        sample = self.h5.create_group("sample")
+        sample.create_group("metadata")
+        sample.create_group("group-metadata")
+        sample.create_dataset(
+            "ids",
+            data=self.samples.astype(str).to_numpy(dtype=object),
+            dtype=self._ids.dtype,
+        )
+        sample.create_dataset("matrix/data", data=self._data[:][order], dtype="f8")
+        sample.create_dataset("matrix/indices", data=rows[order], dtype="i4")
+        sample.create_dataset(
+            "matrix/indptr",
+            data=np.concatenate(
+                [[0], np.cumsum(np.bincount(cols, minlength=len(self.samples)))]
+            ),
+            dtype="i4",
+        )
+        self.h5.close()
+        super().close()
+
+
+def sparse_writer(f, fmt, samples, taxonomy=None, row_name="observation"):
+    """
+    Opens a writer for sparse format <fmt> ('biom', 'mtx' or 'parquet')
+
+    :param f: Output file
+    :param fmt: Output format
+    :param samples: Samples (columns) of the table
+    :param taxonomy: Dataframe with taxonomy of observations, only used for BIOM
+    :param row_name: Name of the observation column in Parquet output
+    :return: SparseWriter
+    """
+    if fmt == "biom":
+        return BiomWriter(f, samples, taxonomy=taxonomy)
+    if fmt == "mtx":
+        return MatrixMarketWriter(f, samples)
+    if fmt == "parquet":
+        return ParquetCooWriter(f, samples, row_name=row_name)
+    raise ValueError(f"Unknown sparse format '{fmt}'")
+
+
+def write_sparse(df, f, fmt, chunksize=None, taxonomy=None, row_name="observation"):
+    """
+    Writes <df> in sparse format <fmt>, <chunksize> rows at a time
+    """
+    chunksize = chunksize or df.shape[0] or 1
+    with sparse_writer(
+        f, fmt, df.columns, taxonomy=taxonomy, row_name=row_name
+    ) as writer:
+        for start in range(0, df.shape[0], chunksize):
+            writer.add(df.iloc[start : start + chunksize])
+
+
+def read_taxonomy(f):
+    """
+    Reads a consensus taxonomy file written by consensus-taxonomy, with
+    clusters as index and rank labels in columns
+    """
+    sys.stderr.write("####\n" f"Reading taxonomy from {f}\n")
+    return pd.read_csv(f, sep="\t", index_col=0, dtype=str)
@@ -5,14 +5,61 @@ import pandas as pd
 import tqdm
 from argparse import ArgumentParser
 import sys
-from clean_asv_data.__main__ import read_config, generate_reader, read_metadata
+from clean_asv_data.__main__ import (
+    generate_reader,
+    multiple_countsfiles,
+    read_config,
+    read_metadata,
+)
+from clean_asv_data.checkpoint import Checkpoint, digest
+from clean_asv_data.partials import write_partial, load_partials, scan_countsfiles
+from clean_asv_data.presence import PresenceIndexBuilder
+from clean_asv_data.libsize import LibrarySizeBuilder
+from clean_asv_data.preview import (
+    depth_estimates,
+    mean_estimate,
+    proportion_estimate,
+    sample_counts,
+    total_estimate,
+    write_report,
+)
 
 
 def read_counts(
-    countsfile, asvs=None, blanks=None, subset=None, chunksize=None, nrows=None
+    countsfile,
+    asvs=None,
+    blanks=None,
+    subset=None,
+    chunksize=None,
+    nrows=None,
+    shard=None,
+    partial=None,
+    presence_index=None,
+    prefetch=0,
+    top=None,
+    top_by="reads",
+    library_index=None,
+    checkpoint=None,
+    resume=False,
+    checkpoint_interval=600,
 ):
     """
     Read counts file in chunks and calculate ASV sum and ASV occurrence
+
+    If <top> is given, only the <top> ASVs with most <top_by> ('reads' or
+    'occurrence') are kept while reading, sorted in descending order.
+
+    If <partial> is given the unfiltered aggregates are also written to this
+    file so that they can be merged with aggregates from other shards. The
+    <top> ASVs are then selected after reading, as ASVs ranked in one shard
+    can be outranked once merged. If
+    <presence_index> is given, a presence index is built during the scan.
+    If <library_index> is given, per-sample read depth and richness are
+    written to this file.
+
+    If <checkpoint> is given, the aggregates are saved to this file every
+    <checkpoint_interval> seconds. With <resume>, reading continues from the
+    last saved checkpoint.
     """
     if blanks is None:
         blanks = []
@@ -20,30 +67,138 @@ def read_counts(
         subset = []
     if asvs is None:
         asvs = []
-    reader = generate_reader(countsfile, chunksize, nrows)
+    builder = None
+    if presence_index is not None:
+        builder = PresenceIndexBuilder(countsfile, shard=shard, nrows=nrows)
+    lib_builder = None
+    if library_index is not None:
+        lib_builder = LibrarySizeBuilder(countsfile, shard=shard, nrows=nrows)
     dataframe = pd.DataFrame()
+    ckpt = None
+    if checkpoint is not None:
+        ckpt = Checkpoint(
+            checkpoint,
+            countsfile,
+            params={
+                "blanks": sorted(blanks),
+                "subset": sorted(subset),
+                "asvs": digest(asvs) if top else None,
+                "nrows": nrows,
+                "shard": shard,
+                "top": top,
+                "top_by": top_by,
+                "presence_index": presence_index,
+                "library_index": library_index,
+            },
+            interval=checkpoint_interval,
+        )
+        state = ckpt.load() if resume else None
+        if state is not None:
+            dataframe = state["dataframe"]
+            builder, lib_builder = state["builder"], state["lib_builder"]
+    reader = generate_reader(
+        countsfile,
+        chunksize,
+        nrows,
+        shard=shard,
+        prefetch=prefetch,
+        skip_rows=0 if ckpt is None else ckpt.rows,
+    )
+    if builder is not None:
+        reader = builder.track(reader)
+    if lib_builder is not None:
+        reader = lib_builder.track(reader)
     sys.stderr.write(f"Reading {countsfile} in chunks of {chunksize} lines\n")
     for df in tqdm.tqdm(reader, unit=" chunks"):
+        n_rows = df.shape[0]
         if len(subset) > 0:
             subset_intersection = list(set(subset).intersection(set(df.columns)))
             df = df.loc[:, subset_intersection]
+        counts = df.drop(blanks, axis=1, errors="ignore")
         # Count number of samples where each ASV occurs
-        asv_occ = pd.DataFrame(
-            df.drop(blanks, axis=1, errors="ignore").gt(0).sum(axis=1),
-            columns=["occurrence"],
-        )
+        asv_occ = pd.DataFrame(counts.gt(0).sum(axis=1), columns=["occurrence"])
         # Sum counts for each ASV
-        asv_sum = pd.DataFrame(
-            df.drop(blanks, axis=1, errors="ignore").sum(axis=1), columns=["reads"]
-        )
+        asv_sum = pd.DataFrame(counts.sum(axis=1), columns=["reads"])
         _dataframe = pd.merge(asv_sum, asv_occ, left_index=True, right_index=True)
-        dataframe = pd.concat([dataframe, _dataframe])
-    if len(asvs) > 0:
+        if counts.shape[1] == 0:
+            # Sums over no samples, e.g. in a countsfile without samples of
+            # the subset, are floats
+            _dataframe = _dataframe.astype("int64")
+        if top and partial is None:
+            if len(asvs) > 0:
+                _dataframe = _dataframe.loc[_dataframe.index.isin(asvs)]
+            # Only keep the current top ASVs
+            dataframe = pd.concat([dataframe, _dataframe]).nlargest(top, top_by)
+        else:
+            dataframe = pd.concat([dataframe, _dataframe])
+        if ckpt is not None:
+            ckpt.update(
+                n_rows,
+                lambda: {
+                    "dataframe": dataframe,
+                    "builder": builder,
+                    "lib_builder": lib_builder,
+                },
+            )
+    if ckpt is not None:
+        ckpt.finish()
+    if builder is not None:
+        builder.save(presence_index)
+    if lib_builder is not None:
+        lib_builder.save(library_index)
+    if partial is not None:
+        sys.stderr.write(f"Writing partial aggregates to {partial}\n")
+        write_partial(
+            partial,
+            "stats",
+            {"stats": dataframe},
+            params={"blanks": sorted(blanks), "subset": sorted(subset)},
+            source={"countsfile": countsfile, "shard": shard, "nrows": nrows},
+        )
+    if top and partial is not None:
+        if len(asvs) > 0:
+            dataframe = dataframe.loc[dataframe.index.isin(asvs)]
+        dataframe = dataframe.nlargest(top, top_by)
+    elif len(asvs) > 0 and not top:
         asv_intersection = list(set(asvs).intersection(set(dataframe.index)))
         dataframe = dataframe.loc[asvs, :]
     return dataframe
 
 
+def preview(args, blanks=None, subset=None):
+    """
+    Estimates ASV stats from a random sample of rows in the counts file and
+    writes the estimates with confidence intervals to stdout
+    """
+    if blanks is None:
+        blanks = []
+    sample, n, n_total = sample_counts(
+        args.countsfile,
+        n_rows=args.sample_rows,
+        fraction=args.sample_fraction,
+        method=args.sample_method,
+        seed=args.seed,
+    )
+    dataframe = read_counts(sample, blanks=blanks, subset=subset)
+    sample.seek(0)
+    sample_df = pd.read_csv(sample, sep="\t", index_col=0)
+    if subset is not None and len(subset) > 0:
+        sample_df = sample_df.loc[:, sample_df.columns.isin(subset)]
+    sample_df = sample_df.drop(blanks, axis=1, errors="ignore")
+    rows = [
+        proportion_estimate("ASVs", n, n, n_total),
+        proportion_estimate("ASVs_with_reads", (dataframe["reads"] > 0).sum(), n, n_total),
+        proportion_estimate(
+            "ASVs_in_one_sample", (dataframe["occurrence"] == 1).sum(), n, n_total
+        ),
+        total_estimate("reads", dataframe["reads"], n_total),
+        mean_estimate("mean_reads", dataframe["reads"]),
+        mean_estimate("mean_occurrence", dataframe["occurrence"]),
+    ]
+    rows += depth_estimates(sample_df, n_total)
+    write_report(rows)
+
+
 def main(args):
     args = read_config(args.configfile, args)
     metadata = None
@@ -65,31 +220,143 @@ def main(args):
                 "####\n"
                 f"Found {len(subset)} samples for {args.subset_col}:{args.subset_val}\n"
             )
+    countsfiles = multiple_countsfiles(
+        args,
+        unsupported=[
+            "shard",
+            "write_partial",
+            "presence_index",
+            "sample_stats",
+            "checkpoint",
+            "sample_rows",
+            "sample_fraction",
+        ],
+        # Only read the partitions with samples of the subset
+        samples=subset,
+    )
     asvs = None
     if args.asvfile:
         sys.stderr.write(f"Reading ASVs from {args.asvfile}\n")
         asvs = pd.read_csv(args.asvfile, sep="\t", index_col=0).index
         sys.stderr.write(f"Found {len(asvs)} ASVs\n")
-    dataframe = read_counts(
-        args.countsfile,
-        asvs,
-        blanks,
-        subset,
-        chunksize=args.chunksize,
-        nrows=args.nrows,
+    if args.sample_rows or args.sample_fraction:
+        preview(args, blanks=blanks, subset=subset)
+        return
+    if args.from_partials or countsfiles:
+        if args.from_partials:
+            dataframe = load_partials(args.from_partials, kind="stats")
+        else:
+            dataframe = scan_countsfiles(
+                countsfiles,
+                lambda countsfile, partial: read_counts(
+                    countsfile,
+                    blanks=blanks,
+                    subset=subset,
+                    chunksize=args.chunksize,
+                    nrows=args.nrows,
+                    partial=partial,
+                    prefetch=args.prefetch,
+                ),
+                kind="stats",
+                threads=args.threads,
+            )
+        if asvs is not None:
+            dataframe = dataframe.loc[asvs, :]
+        if args.top:
+            dataframe = dataframe.nlargest(args.top, args.top_by)
+    else:
+        dataframe = read_counts(
+            args.countsfile,
+            asvs,
+            blanks,
+            subset,
+            chunksize=args.chunksize,
+            nrows=args.nrows,
+            shard=args.shard,
+            partial=args.write_partial,
+            presence_index=args.presence_index,
+            prefetch=args.prefetch,
+            top=args.top,
+            top_by=args.top_by,
+            library_index=args.sample_stats,
+            checkpoint=args.checkpoint,
+            resume=args.resume,
+            checkpoint_interval=args.checkpoint_interval,
+        )
+        if args.write_partial:
+            return
+    sys.stderr.write(
+        f"Writing stats for {dataframe.shape[0]} ASVs to {args.output or 'stdout'}\n"
     )
-    sys.stderr.write(f"Writing stats for {dataframe.shape[0]} ASVs to stdout\n")
     dataframe.index.name = "ASV"
-    with sys.stdout as fhout:
+    with open(args.output, "w") if args.output else sys.stdout as fhout:
         dataframe.to_csv(fhout, sep="\t")
 
 
-def main_cli():
+def build_parser():
     parser = ArgumentParser()
     parser.add_argument(
         "--countsfile",
         type=str,
-        help="ASV counts file. Tab-separated, samples in columns, ASVs in rows",
+        nargs="+",
+        help="ASV counts file. Tab-separated, samples in columns, ASVs in rows. "
+        "Several files (or glob patterns) with different samples are read in "
+        "parallel as one counts matrix joined on ASV ids",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="Number of countsfiles to read at the same time when several are "
+        "given (default: all)",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Write stats of ASVs to this file instead of stdout",
+    )
+    parser.add_argument(
+        "--presence_index",
+        type=str,
+        help="Write a presence/absence index of ASVs in samples to this file "
+        "while reading the countsfile. Can be queried with query-presence",
+    )
+    parser.add_argument(
+        "--sample_stats",
+        type=str,
+        help="Also write total reads and richness of each sample to this file. "
+        "The file can be used as --library_index for clean-asv-data",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        help="Only output the <top> ASVs with most reads (or occurrence, see "
+        "--top_by). Only the current top ASVs are kept in memory while reading, "
+        "except with --write_partial where all ASVs are kept for merging",
+    )
+    parser.add_argument(
+        "--top_by",
+        type=str,
+        choices=["reads", "occurrence"],
+        default="reads",
+        help="Stat to rank ASVs by with --top (default: 'reads')",
+    )
+    parser.add_argument(
+        "--write_partial",
+        type=str,
+        help="Only aggregate counts and write them to this partial aggregate "
+        "file. Partials from several shards can be combined with merge-partials",
+    )
+    parser.add_argument(
+        "--from_partials",
+        type=str,
+        nargs="+",
+        help="Use (merged) partial aggregate files instead of reading the countsfile",
+    )
+    parser.add_argument(
+        "--shard",
+        type=str,
+        help="Only read row shard <k> of <n> from the countsfile, e.g. '2/4'. "
+        "Use together with --write_partial",
     )
     parser.add_argument(
         "--asvfile",
@@ -145,10 +412,60 @@ def main_cli():
         type=int,
         help="Size of chunks (in lines) to read from " "countsfile",
     )
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        help="Periodically save aggregates of the countsfile scan to this file",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume the countsfile scan from the file given by --checkpoint",
+    )
+    parser.add_argument(
+        "--checkpoint_interval",
+        type=int,
+        help="Minimum number of seconds between checkpoints (default 600)",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        help="Number of chunks to read ahead from the countsfile in a background "
+        "thread (default 0, no prefetching)",
+    )
+    parser.add_argument(
+        "--sample_rows",
+        type=int,
+        help="Preview mode: estimate ASV and read depth stats from this many "
+        "randomly sampled rows of the countsfile and write the estimates to stdout",
+    )
+    parser.add_argument(
+        "--sample_fraction",
+        type=float,
+        help="Preview mode: as --sample_rows but sample this fraction of rows",
+    )
+    parser.add_argument(
+        "--sample_method",
+        type=str,
+        choices=["seek", "reservoir"],
+        default="seek",
+        help="Sample rows by seeking to random byte offsets ('seek', default, "
+        "fast but assumes rows of similar length) or by reading all lines "
+        "('reservoir', exactly uniform)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="Seed for random sampling of rows",
+    )
     parser.add_argument(
         "--nrows",
         type=int,
         help=argparse.SUPPRESS,
     )
-    args = parser.parse_args()
+    return parser
+
+
+def main_cli():
+    args = build_parser().parse_args()
     main(args)
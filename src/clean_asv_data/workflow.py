@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import hashlib
+import json
+import os
+import sys
+import time
+from clean_asv_data import clean_asv_data, consensus_taxonomy, count_clusters, stats
+from clean_asv_data.__main__ import (
+    expand_countsfiles,
+    read_config,
+    read_metadata,
+    shared_inputs,
+    shared_scan,
+)
+from clean_asv_data.libsize import get_library_sizes
+from clean_asv_data.partition import partition_counts
+
+# Parameters that affect the output of all steps
+COMMON_PARAMS = [
+    "countsfile",
+    "metadata",
+    "metadata_index_name",
+    "split_col",
+    "sample_type_col",
+    "blank_val",
+    "noblanks",
+    "nrows",
+]
+
+# Parameters that affect the output of each step, in addition to COMMON_PARAMS
+STEP_PARAMS = {
+    "clean": [
+        "clustfile",
+        "clean_rank",
+        "skip_ambig",
+        "skip_unclass",
+        "max_blank_occurrence",
+        "blank_removal_mode",
+        "min_clust_count",
+        "min_rel_abundance",
+    ],
+    "stats": ["subset_col", "subset_val", "asvfile", "top", "top_by"],
+    "consensus": ["ranks", "consensus_ranks", "consensus_threshold", "clust_column"],
+    "count": ["clust_column", "subset_col", "subset_val", "top", "top_by"],
+    "scan": ["subset_col", "subset_val", "min_rel_abundance", "library_index"],
+}
+
+
+def tool_args(tool, config, options):
+    """
+    Returns arguments for the main function of <tool>: its defaults, updated
+    with the config and then with <options>
+    """
+    args = tool.build_parser().parse_args([])
+    vars(args).update(config)
+    vars(args).update(options)
+    return args
+
+
+class Step:
+    """
+    A step of the workflow: runs the main function of a tool in-process with
+    arguments taken from the config, updated with step-specific <options>
+    """
+
+    def __init__(self, name, tool, kind, config, options, inputs, outputs, deps=()):
+        self.name = name
+        self.tool = tool
+        self.kind = kind
+        self.config = config
+        self.options = options
+        self.inputs = [f for f in inputs if f]
+        self.outputs = outputs
+        self.deps = list(deps)
+
+    def params_hash(self):
+        params = {
+            key: self.config.get(key)
+            for key in COMMON_PARAMS + STEP_PARAMS[self.kind]
+        }
+        params.update(self.options)
+        return hashlib.sha1(
+            json.dumps(params, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    def stamp(self, stampdir):
+        return os.path.join(stampdir, f"{self.name}.json")
+
+    def is_stale(self, stampdir):
+        """
+        Checks whether the step has to be run
+
+        :return: tuple of (True/False, reason)
+        """
+        missing = [f for f in self.outputs if not os.path.exists(f)]
+        if len(missing) > 0:
+            return True, f"missing output {missing[0]}"
+        if not os.path.exists(self.stamp(stampdir)):
+            return True, "no record of previous run"
+        with open(self.stamp(stampdir), "r") as fhin:
+            if json.load(fhin).get("params") != self.params_hash():
+                return True, "parameters changed"
+        oldest_output = min(os.path.getmtime(f) for f in self.outputs)
+        for f in self.inputs:
+            if os.path.getmtime(f) > oldest_output:
+                return True, f"{f} is newer than output"
+        return False, "up to date"
+
+    def execute(self):
+        self.tool.main(tool_args(self.tool, self.config, self.options))
+
+    def run(self, stampdir):
+        start = time.time()
+        self.execute()
+        with open(self.stamp(stampdir), "w") as fhout:
+            json.dump({"params": self.params_hash(), "outputs": self.outputs}, fhout)
+        return time.time() - start
+
+
+class ScanStep(Step):
+    """
+    Reads the countsfile once for the steps that would otherwise each scan it.
+    The aggregates of clean-asv-data, generate-statsfile and
+    consensus-taxonomy are written to partials that the steps read with
+    --from_partials. count-clusters needs the cleaned clustfile, so the counts
+    are instead written to one partition per dataset (see partition-counts)
+    for the count steps to read.
+
+    :param outputs: Dictionary of step kinds and the file written for them
+    """
+
+    def __init__(self, config, outputs, inputs):
+        self.files = outputs
+        super().__init__(
+            "scan",
+            None,
+            "scan",
+            config,
+            {"outputs": outputs},
+            inputs=inputs,
+            outputs=list(outputs.values()),
+        )
+
+    def execute(self):
+        config = self.config
+        countsfile = expand_countsfiles(config["countsfile"])[0]
+        chunksize = config.get("chunksize")
+        nrows = config.get("nrows")
+        consumers = []
+        for kind, f in self.files.items():
+            os.makedirs(os.path.dirname(f), exist_ok=True)
+            if kind == "count":
+                consumers.append(lambda f=f: self.partition(countsfile, f))
+                continue
+            tool, options = {
+                "clean": (clean_asv_data, {}),
+                "stats": (stats, {"presence_index": None, "sample_stats": None}),
+                "consensus": (
+                    consensus_taxonomy,
+                    {"presence_index": None, "library_index": None},
+                ),
+            }[kind]
+            options.update({"countsfile": countsfile, "write_partial": f})
+            if kind == "clean" and config.get("min_rel_abundance"):
+                # Library sizes are needed before the counts are read
+                options["library_index"] = config.get("library_index") or os.path.join(
+                    os.path.dirname(f), "library_sizes.tsv"
+                )
+                get_library_sizes(
+                    countsfile,
+                    index=options["library_index"],
+                    chunksize=chunksize,
+                    nrows=nrows,
+                )
+            args = tool_args(tool, config, options)
+            consumers.append(lambda tool=tool, args=args: tool.main(args))
+        with shared_scan(countsfile, chunksize=chunksize, nrows=nrows) as scan:
+            scan.run(consumers)
+
+    def partition(self, countsfile, manifest):
+        metadata = None
+        if self.config.get("metadata"):
+            metadata = read_metadata(
+                self.config["metadata"],
+                index_name=self.config.get("metadata_index_name", "sampleID_NGI"),
+            )
+        partition_counts(
+            countsfile,
+            metadata,
+            split_col=self.config.get("split_col", "dataset"),
+            outdir=os.path.dirname(manifest),
+            chunksize=self.config.get("chunksize"),
+            nrows=self.config.get("nrows"),
+        )
+
+
+def plan_steps(config, outdir, steps=None):
+    """
+    Sets up the four steps of the typical workflow (clean, stats, consensus,
+    count) with their inputs and outputs under <outdir>. Consensus taxonomy
+    and cluster counts depend on the cleaned clustfile(s), one per dataset if
+    samples are split into several datasets. If more than one step reads a
+    single countsfile, a scan step reads it once for all of them.
+
+    :param config: Config dictionary
+    :param outdir: Output directory
+    :param steps: Only include these steps (and their dependencies)
+    :return: list of Step
+    """
+    datasets = []
+    if config.get("metadata"):
+        metadata = read_metadata(
+            config["metadata"],
+            index_name=config.get("metadata_index_name", "sampleID_NGI"),
+        )
+        datasets = list(metadata[config.get("split_col", "dataset")].unique())
+    countsfiles = expand_countsfiles(config.get("countsfile"))
+    common_inputs = countsfiles + [config.get("metadata")]
+    kinds = set(steps or STEP_PARAMS)
+    if "consensus" in kinds or "count" in kinds:
+        kinds.add("clean")
+    scanned = {}
+    if len(countsfiles) == 1:
+        scandir = os.path.join(outdir, ".workflow", "scan")
+        # Blank occurrence of clusters can not be merged from partials
+        if config.get("blank_removal_mode") != "cluster_occurrence":
+            scanned["clean"] = os.path.join(scandir, "clean.npz")
+        scanned["stats"] = os.path.join(scandir, "stats.npz")
+        scanned["consensus"] = os.path.join(scandir, "asv_sum.npz")
+        scanned["count"] = os.path.join(scandir, "partitions", "manifest.json")
+        scanned = {kind: f for kind, f in scanned.items() if kind in kinds}
+    if len(scanned) < 2:
+        scanned = {}
+    if len(datasets) > 1:
+        cleaned = {ds: os.path.join(outdir, f"{ds}.cleaned.tsv") for ds in datasets}
+    else:
+        cleaned = {None: os.path.join(outdir, "cleaned.tsv")}
+    plan = []
+    if len(scanned) > 0:
+        plan.append(ScanStep(config, scanned, inputs=common_inputs))
+    plan += [
+        Step(
+            "clean",
+            clean_asv_data,
+            "clean",
+            config,
+            {"output": os.path.join(outdir, "cleaned.tsv")},
+            inputs=common_inputs + [config.get("clustfile")],
+            outputs=list(cleaned.values()),
+        ),
+        Step(
+            "stats",
+            stats,
+            "stats",
+            config,
+            {"output": os.path.join(outdir, "asv_stats.tsv")},
+            inputs=common_inputs + [config.get("asvfile")],
+            outputs=[os.path.join(outdir, "asv_stats.tsv")],
+        ),
+        Step(
+            "consensus",
+            consensus_taxonomy,
+            "consensus",
+            config,
+            {
+                "clustfile": list(cleaned.values()),
+                "output": os.path.join(outdir, "cluster_taxonomy.tsv"),
+            },
+            inputs=common_inputs + list(cleaned.values()),
+            outputs=[os.path.join(outdir, "cluster_taxonomy.tsv")],
+            deps=["clean"],
+        ),
+    ]
+    for ds, clustfile in cleaned.items():
+        options = {"clustfile": clustfile}
+        if ds is None:
+            name = "count"
+            options["output"] = os.path.join(outdir, "cluster_counts.tsv")
+        else:
+            # Count clusters of each dataset in the samples of that dataset
+            name = f"count:{ds}"
+            options["output"] = os.path.join(outdir, f"{ds}.cluster_counts.tsv")
+            options["subset_col"] = config.get("split_col", "dataset")
+            options["subset_val"] = ds
+        plan.append(
+            Step(
+                name,
+                count_clusters,
+                "count",
+                config,
+                options,
+                inputs=common_inputs + [clustfile],
+                outputs=[options["output"]],
+                deps=["clean"],
+            )
+        )
+    for step in plan:
+        if step.kind == "scan" or step.kind not in scanned:
+            continue
+        if step.kind == "count":
+            step.options["countsfile"] = scanned["count"]
+        else:
+            step.options["from_partials"] = [scanned[step.kind]]
+        step.deps.append("scan")
+    if steps is not None:
+        wanted = set()
+        for step in plan:
+            if step.kind in steps or step.name in steps:
+                wanted.update([step.name] + step.deps)
+        plan = [step for step in plan if step.name in wanted]
+    return plan
+
+
+def run_workflow(plan, stampdir, threads=1, force=False, dry_run=False):
+    """
+    Runs steps once their dependencies have finished, with up to <threads>
+    independent steps running concurrently. Steps that are up to date are
+    skipped unless <force> is set. Steps depending on a step that is run are
+    always run as well.
+
+    :return: dictionary of step names and their status
+    """
+    pending = {step.name: step for step in plan}
+    status = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while len(pending) > 0 or len(running) > 0:
+            ready = [
+                step
+                for step in pending.values()
+                if all(status.get(dep) in ["done", "skipped"] for dep in step.deps)
+            ]
+            for step in ready:
+                del pending[step.name]
+                stale, reason = step.is_stale(stampdir)
+                if any(status.get(dep) == "done" for dep in step.deps):
+                    stale, reason = True, "dependency was run"
+                if force:
+                    stale, reason = True, "forced"
+                if not stale:
+                    sys.stderr.write("####\n" f"Skipping {step.name}: {reason}\n")
+                    status[step.name] = "skipped"
+                    continue
+                sys.stderr.write("####\n" f"Running {step.name}: {reason}\n")
+                if dry_run:
+                    status[step.name] = "done"
+                    continue
+                running[pool.submit(step.run, stampdir)] = step
+            if len(ready) > 0 and len(running) == 0:
+                # Skipped steps may have made other steps ready
+                continue
+            if len(running) == 0:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                seconds = future.result()
+                sys.stderr.write(
+                    "####\n" f"Finished {step.name} in {seconds:.1f} seconds\n"
+                )
+                status[step.name] = "done"
+    return status
+
+
+def main(args):
+    config = vars(read_config(args.configfile, args))
+    outdir = args.outdir or config.get("outdir") or "results"
+    stampdir = os.path.join(outdir, ".workflow")
+    os.makedirs(stampdir, exist_ok=True)
+    with shared_inputs():
+        plan = plan_steps(config, outdir, steps=args.steps)
+        status = run_workflow(
+            plan,
+            stampdir,
+            threads=args.threads,
+            force=args.force,
+            dry_run=args.dry_run,
+        )
+    for step in plan:
+        sys.stderr.write(f"{step.name}\t{status.get(step.name, 'not run')}\n")
+
+
+def main_cli():
+    parser = ArgumentParser(
+        description="Runs the clean, stats, consensus and count steps of the "
+        "typical workflow in one process, with settings from the config file. "
+        "Steps that do not depend on each other run concurrently and steps "
+        "whose output is up to date with their input and parameters are skipped"
+    )
+    parser.add_argument(
+        "--configfile",
+        type=str,
+        default="config.yml",
+        help="Path to a yaml-format configuration file with inputs and "
+        "parameters for all steps",
+    )
+    parser.add_argument(
+        "--outdir",
+        type=str,
+        help="Directory for output of the steps (default 'results')",
+    )
+    parser.add_argument(
+        "--steps",
+        type=str,
+        nargs="+",
+        choices=["clean", "stats", "consensus", "count"],
+        help="Only run these steps (and the steps they depend on)",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=3,
+        help="Maximum number of steps to run concurrently (default 3)",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Run all steps even if they are up to date",
+    )
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        help="Only report which steps would be run",
+    )
+    args = parser.parse_args()
+    main(args)
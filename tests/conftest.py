@@ -0,0 +1,119 @@
+import hashlib
+import io
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+N_ASVS = 400
+N_SAMPLES = 24
+N_CLUSTERS = 60
+CHUNKSIZE = 70
+
+
+class Stdout(io.StringIO):
+    # Tools close stdout when done writing to it
+    def close(self):
+        pass
+
+
+def run(main_cli, *argv, configfile="none"):
+    """
+    Runs a command line tool with the given arguments and returns what it
+    wrote to stdout. A missing <configfile> means that only the package
+    defaults are used.
+    """
+    argv = [str(a) for a in argv]
+    if configfile is not None:
+        argv += ["--configfile", str(configfile)]
+    old_argv, old_stdout = sys.argv, sys.stdout
+    sys.argv = [main_cli.__module__] + argv
+    sys.stdout = Stdout()
+    try:
+        main_cli()
+        return sys.stdout.getvalue()
+    finally:
+        sys.argv, sys.stdout = old_argv, old_stdout
+
+
+def read_tsv(f):
+    return pd.read_csv(f, sep="\t", index_col=0, header=0)
+
+
+def assert_same_file(a, b):
+    with open(a) as fha, open(b) as fhb:
+        assert fha.read() == fhb.read(), f"{a} differs from {b}"
+
+
+@pytest.fixture(scope="session")
+def data(tmp_path_factory):
+    """
+    Writes a small countsfile, clustfile and metadata with two datasets (d1,
+    d2) of 12 samples each, every sixth sample being a blank.
+    """
+    d = tmp_path_factory.mktemp("data")
+    rng = np.random.default_rng(1)
+    asvs = sorted(hashlib.md5(str(i).encode()).hexdigest() for i in range(N_ASVS))
+    samples = [f"S{i:03d}" for i in range(N_SAMPLES)]
+    counts = rng.poisson(0.4, (N_ASVS, N_SAMPLES)) * rng.integers(
+        1, 50, (N_ASVS, N_SAMPLES)
+    )
+    # Some ASVs without reads in d2, and some without reads at all
+    counts[::7, N_SAMPLES // 2 :] = 0
+    counts[::31] = 0
+    df = pd.DataFrame(counts, index=asvs, columns=samples)
+    df.index.name = "ASV_ID"
+    df.to_csv(d / "counts.tsv", sep="\t")
+    cl = rng.integers(0, N_CLUSTERS, N_ASVS)
+    family = [
+        "unclassified.O1"
+        if rng.random() < 0.1
+        else (f"F{c % 15}_X" if rng.random() < 0.05 else f"F{c % 15}")
+        for c in cl
+    ]
+    clustdf = pd.DataFrame(
+        {
+            "cluster": [f"cl{c}" for c in cl],
+            "Kingdom": "Animalia",
+            "Phylum": [f"P{c % 3}" for c in cl],
+            "Class": [f"C{c % 5}" for c in cl],
+            "Order": [f"O{c % 10}" for c in cl],
+            "Family": family,
+            "Genus": [
+                f"G{c % 30}" if rng.random() < 0.9 else f"G{rng.integers(0, 50)}"
+                for c in cl
+            ],
+            "Species": [
+                f"S{c}" if rng.random() < 0.85 else f"S{rng.integers(0, 90)}"
+                for c in cl
+            ],
+            "BOLD_bin": [f"B{c}" for c in cl],
+        },
+        index=asvs,
+    )
+    clustdf.index.name = "ASV"
+    clustdf.iloc[::-1].to_csv(d / "clust.tsv", sep="\t")
+    # The same clusters with numeric ids
+    clustdf.assign(cluster=cl).iloc[::-1].to_csv(d / "clust_numeric.tsv", sep="\t")
+    pd.DataFrame(
+        {
+            "sampleID_NGI": samples,
+            "dataset": ["d1" if i < N_SAMPLES // 2 else "d2" for i in range(N_SAMPLES)],
+            "lab_sample_type": [
+                "extraction_neg" if i % 6 == 0 else "sample" for i in range(N_SAMPLES)
+            ],
+        }
+    ).to_csv(d / "meta.tsv", sep="\t", index=False)
+    # The samples of each dataset in a countsfile of its own, with the rows
+    # of d2 in a different order and without some of the ASVs
+    df.iloc[:, : N_SAMPLES // 2].to_csv(d / "counts_d1.tsv", sep="\t")
+    df.iloc[::2, N_SAMPLES // 2 :].iloc[::-1].to_csv(d / "counts_d2.tsv", sep="\t")
+    # The same counts as one matrix
+    pd.concat(
+        [
+            df.iloc[:, : N_SAMPLES // 2],
+            df.iloc[::2, N_SAMPLES // 2 :].reindex(df.index, fill_value=0),
+        ],
+        axis=1,
+    ).to_csv(d / "counts_joined.tsv", sep="\t")
+    return d
@@ -0,0 +1,78 @@
+import os
+import pytest
+from clean_asv_data import checkpoint
+from clean_asv_data.clean_asv_data import main_cli as clean_cli
+from clean_asv_data.count_clusters import main_cli as count_clusters_cli
+from clean_asv_data.stats import main_cli as stats_cli
+from conftest import CHUNKSIZE, assert_same_file, run
+
+
+@pytest.fixture
+def interrupt(monkeypatch):
+    """
+    Makes the next scan fail after its third chunk, as if the job was killed
+    """
+    update = checkpoint.Checkpoint.update
+
+    def interrupted_update(self, n_rows, state):
+        update(self, n_rows, state)
+        if self.chunks == 3:
+            raise RuntimeError("interrupted")
+
+    monkeypatch.setattr(checkpoint.Checkpoint, "update", interrupted_update)
+
+
+TOOLS = {
+    "clean": (clean_cli, ["--clustfile", "clust.tsv"], "cleaned.tsv"),
+    "stats": (stats_cli, ["--top", 50], "stats.tsv"),
+    "count_clusters": (count_clusters_cli, ["--clustfile", "clust.tsv"], "counts.tsv"),
+}
+
+
+@pytest.mark.parametrize("tool", TOOLS)
+def test_resume(data, tmp_path, capfd, monkeypatch, interrupt, tool):
+    main_cli, args, output = TOOLS[tool]
+    args = [
+        "--countsfile", data / "counts.tsv",
+        "--metadata", data / "meta.tsv",
+        "--chunksize", CHUNKSIZE,
+        *[data / a if str(a).endswith(".tsv") else a for a in args],
+    ]
+    ckpt = tmp_path / "scan.ckpt"
+    ckpt_args = ["--checkpoint", ckpt, "--checkpoint_interval", 0]
+    (tmp_path / "single").mkdir()
+    (tmp_path / "resumed").mkdir()
+    with pytest.raises(RuntimeError, match="interrupted"):
+        run(main_cli, *args, *ckpt_args, "--output", tmp_path / "resumed" / output)
+    assert os.path.exists(ckpt)
+    monkeypatch.undo()
+    run(main_cli, *args, "--output", tmp_path / "single" / output)
+    capfd.readouterr()
+    run(
+        main_cli,
+        *args,
+        *ckpt_args,
+        "--resume",
+        "--output", tmp_path / "resumed" / output,
+    )
+    assert "Resuming from checkpoint" in capfd.readouterr().err
+    assert not os.path.exists(ckpt)
+    single = sorted(os.listdir(tmp_path / "single"))
+    assert single == sorted(os.listdir(tmp_path / "resumed"))
+    for f in single:
+        assert_same_file(tmp_path / "single" / f, tmp_path / "resumed" / f)
+
+
+def test_resume_with_other_parameters(data, tmp_path, interrupt):
+    args = [
+        "--countsfile", data / "counts.tsv",
+        "--metadata", data / "meta.tsv",
+        "--chunksize", CHUNKSIZE,
+        "--checkpoint", tmp_path / "scan.ckpt",
+        "--checkpoint_interval", 0,
+        "--output", tmp_path / "stats.tsv",
+    ]
+    with pytest.raises(RuntimeError, match="interrupted"):
+        run(stats_cli, *args)
+    with pytest.raises(ValueError, match="different parameters"):
+        run(stats_cli, *args, "--resume", "--subset_val", "d1")
@@ -0,0 +1,66 @@
+import pytest
+from clean_asv_data.clean_asv_data import main_cli as clean_cli
+from conftest import CHUNKSIZE, read_tsv, run
+
+
+@pytest.mark.parametrize("chunksize", [CHUNKSIZE, 10000])
+def test_counts_output(data, tmp_path, chunksize):
+    run(
+        clean_cli,
+        "--countsfile", data / "counts.tsv",
+        "--clustfile", data / "clust.tsv",
+        "--metadata", data / "meta.tsv",
+        "--chunksize", chunksize,
+        "--output", tmp_path / "cleaned.tsv",
+        "--counts_output", "counts.tsv",
+    )
+    counts = read_tsv(data / "counts.tsv")
+    counts.index.name = "ASV"
+    meta = read_tsv(data / "meta.tsv")
+    for dataset in ["d1", "d2"]:
+        cleaned = read_tsv(tmp_path / f"{dataset}.cleaned.tsv")
+        samples = meta.index[meta["dataset"] == dataset]
+        expected = counts.loc[counts.index.isin(cleaned.index), samples]
+        result = read_tsv(tmp_path / f"{dataset}.counts.tsv")
+        assert 0 < result.shape[0] < counts.shape[0]
+        assert result.equals(expected)
+
+
+def test_cluster_occurrence(data, tmp_path):
+    args = [
+        "--countsfile", data / "counts.tsv",
+        "--clustfile", data / "clust.tsv",
+        "--metadata", data / "meta.tsv",
+        "--chunksize", CHUNKSIZE,
+        "--blank_removal_mode", "cluster_occurrence",
+        "--min_clust_count", 0,
+    ]
+    # Keep all ASVs retained by taxonomy cleaning to check their blank counts
+    for max_blank_occurrence, output in [(100, "all.tsv"), (50, "cleaned.tsv")]:
+        run(
+            clean_cli,
+            *args,
+            "--max_blank_occurrence", max_blank_occurrence,
+            "--output", tmp_path / output,
+        )
+    counts = read_tsv(data / "counts.tsv")
+    meta = read_tsv(data / "meta.tsv")
+    for dataset in ["d1", "d2"]:
+        retained = read_tsv(tmp_path / f"{dataset}.all.tsv")
+        blanks = meta.index[
+            (meta["dataset"] == dataset) & (meta["lab_sample_type"] == "extraction_neg")
+        ]
+        # Blanks in which any member of the cluster is present
+        in_n_blanks = (
+            counts.loc[retained.index, blanks]
+            .gt(0)
+            .groupby(retained["cluster"])
+            .any()
+            .sum(axis=1)
+        )
+        expected = retained["cluster"].map(in_n_blanks).rename("cluster_in_n_blanks")
+        assert retained["cluster_in_n_blanks"].equals(expected)
+        cleaned = read_tsv(tmp_path / f"{dataset}.cleaned.tsv")
+        keep = retained.index[retained["cluster_in_percent_blanks"] <= 50]
+        assert 0 < len(keep) < retained.shape[0]
+        assert sorted(cleaned.index) == sorted(keep)
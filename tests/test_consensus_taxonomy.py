@@ -0,0 +1,130 @@
+import os
+import re
+import pandas as pd
+import pytest
+from clean_asv_data.consensus_taxonomy import main_cli as consensus_cli
+from conftest import CHUNKSIZE, N_CLUSTERS, assert_same_file, read_tsv, run
+
+
+def consensus(data, clustfile, output, *args):
+    run(
+        consensus_cli,
+        "--countsfile", data / "counts.tsv",
+        "--clustfile", clustfile,
+        "--metadata", data / "meta.tsv",
+        "--consensus_threshold", 70,
+        "--output", output,
+        *args,
+    )
+
+
+def cache_stats(capfd):
+    err = capfd.readouterr().err
+    hits, misses = re.search(r"(\d+) hits, (\d+) misses", err).groups()
+    return int(hits), int(misses)
+
+
+def test_cache(data, tmp_path, capfd):
+    cache = ["--cache", tmp_path / "cache.sqlite"]
+    consensus(data, data / "clust.tsv", tmp_path / "nocache.tsv")
+    consensus(data, data / "clust.tsv", tmp_path / "cold.tsv", *cache)
+    assert cache_stats(capfd) == (0, N_CLUSTERS)
+    consensus(data, data / "clust.tsv", tmp_path / "warm.tsv", *cache)
+    assert cache_stats(capfd) == (N_CLUSTERS, 0)
+    assert_same_file(tmp_path / "nocache.tsv", tmp_path / "cold.tsv")
+    assert_same_file(tmp_path / "nocache.tsv", tmp_path / "warm.tsv")
+    # A changed label is only resolved again for its cluster
+    clustdf = read_tsv(data / "clust.tsv")
+    clustdf.iloc[0, clustdf.columns.get_loc("Species")] = "S_new"
+    clustdf.to_csv(tmp_path / "clust.tsv", sep="\t")
+    consensus(data, tmp_path / "clust.tsv", tmp_path / "changed_nocache.tsv")
+    consensus(data, tmp_path / "clust.tsv", tmp_path / "changed.tsv", *cache)
+    assert cache_stats(capfd) == (N_CLUSTERS - 1, 1)
+    assert_same_file(tmp_path / "changed_nocache.tsv", tmp_path / "changed.tsv")
+
+
+def test_cache_size(data, tmp_path, capfd):
+    cache = ["--cache", tmp_path / "cache.sqlite", "--cache_size", 10]
+    consensus(data, data / "clust.tsv", tmp_path / "nocache.tsv")
+    consensus(data, data / "clust.tsv", tmp_path / "cold.tsv", *cache)
+    assert "10 clusters cached" in capfd.readouterr().err
+    consensus(data, data / "clust.tsv", tmp_path / "warm.tsv", *cache)
+    assert cache_stats(capfd) == (10, N_CLUSTERS - 10)
+    assert_same_file(tmp_path / "nocache.tsv", tmp_path / "warm.tsv")
+
+
+@pytest.mark.parametrize("partitions", [1, 7])
+@pytest.mark.parametrize(
+    "thresholds", [[], ["--consensus_threshold", 60, 90, "--threshold_output", "files"]]
+)
+def test_spill(data, tmp_path, partitions, thresholds):
+    """
+    Streaming mode gives the same output as resolving all clusters in memory
+    """
+    (tmp_path / "memory").mkdir()
+    (tmp_path / "spill").mkdir()
+    consensus(data, data / "clust.tsv", tmp_path / "memory" / "taxonomy.tsv", *thresholds)
+    consensus(
+        data,
+        data / "clust.tsv",
+        tmp_path / "spill" / "taxonomy.tsv",
+        "--spill_dir", tmp_path / "tmp",
+        "--partitions", partitions,
+        "--chunksize", CHUNKSIZE,
+        *thresholds,
+    )
+    files = sorted(os.listdir(tmp_path / "memory"))
+    assert sorted(os.listdir(tmp_path / "spill")) == files
+    for f in files:
+        assert_same_file(tmp_path / "memory" / f, tmp_path / "spill" / f)
+
+
+def test_numeric_cluster_ids(data, tmp_path):
+    consensus(data, data / "clust.tsv", tmp_path / "taxonomy.tsv")
+    consensus(data, data / "clust_numeric.tsv", tmp_path / "numeric.tsv")
+    taxonomy = read_tsv(tmp_path / "taxonomy.tsv")
+    numeric = read_tsv(tmp_path / "numeric.tsv")
+    assert numeric.index.is_monotonic_increasing
+    taxonomy.index = taxonomy.index.str.removeprefix("cl").astype(int)
+    assert numeric.equals(taxonomy.sort_index())
+
+
+@pytest.mark.parametrize("partitions", [1, 7])
+def test_spill_clustfiles(data, tmp_path, partitions):
+    """
+    ASVs in several clustfiles are taken from the first file they are in,
+    also when the later files put them in other clusters
+    """
+    clustdf = read_tsv(data / "clust.tsv")
+    clustdf.iloc[:250].to_csv(tmp_path / "a.tsv", sep="\t")
+    other = clustdf.iloc[150:].copy()
+    other.iloc[:100, other.columns.get_loc("cluster")] = "cl_other"
+    other.iloc[:100, other.columns.get_loc("Species")] = "S_other"
+    other.iloc[100:, other.columns.get_indexer(["Species", "BOLD_bin"])] = "repeated"
+    # ASVs repeated within the second file are all kept
+    pd.concat([other] + [other.iloc[100:]] * 4).to_csv(tmp_path / "b.tsv", sep="\t")
+    clustfiles = [tmp_path / "a.tsv", tmp_path / "b.tsv"]
+    (tmp_path / "memory").mkdir()
+    (tmp_path / "spill").mkdir()
+    run(
+        consensus_cli,
+        "--countsfile", data / "counts.tsv",
+        "--clustfile", *clustfiles,
+        "--output", tmp_path / "memory" / "taxonomy.tsv",
+    )
+    run(
+        consensus_cli,
+        "--countsfile", data / "counts.tsv",
+        "--clustfile", *clustfiles,
+        "--output", tmp_path / "spill" / "taxonomy.tsv",
+        "--spill_dir", tmp_path / "tmp",
+        "--partitions", partitions,
+        "--chunksize", CHUNKSIZE,
+    )
+    taxonomy = read_tsv(tmp_path / "memory" / "taxonomy.tsv")
+    assert "cl_other" not in taxonomy.index
+    assert "repeated" in set(taxonomy["BOLD_bin"])
+    assert_same_file(
+        tmp_path / "memory" / "taxonomy.tsv", tmp_path / "spill" / "taxonomy.tsv"
+    )
+    assert os.listdir(tmp_path / "tmp") == []
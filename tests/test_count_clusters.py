@@ -0,0 +1,62 @@
+import pytest
+from clean_asv_data.count_clusters import main_cli as count_clusters_cli
+from conftest import CHUNKSIZE, assert_same_file, read_tsv, run
+
+
+def count_clusters(data, clustfile, output, *args):
+    run(
+        count_clusters_cli,
+        "--countsfile", data / "counts.tsv",
+        "--clustfile", clustfile,
+        "--metadata", data / "meta.tsv",
+        "--chunksize", CHUNKSIZE,
+        "--output", output,
+        *args,
+    )
+
+
+@pytest.mark.parametrize("mode", ["assert", "detect"])
+def test_merge_join(data, tmp_path, mode):
+    read_tsv(data / "clust.tsv").sort_index().to_csv(
+        tmp_path / "clust_sorted.tsv", sep="\t"
+    )
+    count_clusters(data, data / "clust.tsv", tmp_path / "hash.tsv")
+    count_clusters(
+        data,
+        tmp_path / "clust_sorted.tsv",
+        tmp_path / "merge.tsv",
+        "--merge_join", mode,
+    )
+    assert_same_file(tmp_path / "hash.tsv", tmp_path / "merge.tsv")
+
+
+def test_merge_join_unsorted(data, tmp_path):
+    count_clusters(data, data / "clust.tsv", tmp_path / "hash.tsv")
+    count_clusters(
+        data, data / "clust.tsv", tmp_path / "detect.tsv", "--merge_join", "detect"
+    )
+    assert_same_file(tmp_path / "hash.tsv", tmp_path / "detect.tsv")
+    with pytest.raises(SystemExit, match="ERROR: .* is not sorted"):
+        count_clusters(
+            data,
+            data / "clust.tsv",
+            tmp_path / "assert.tsv",
+            "--merge_join", "assert",
+        )
+
+
+def test_numeric_cluster_ids(data, tmp_path):
+    """
+    Numeric cluster ids are written in numeric order by both join modes
+    """
+    clustdf = read_tsv(data / "clust_numeric.tsv")
+    clustdf.sort_index().to_csv(tmp_path / "clust_sorted.tsv", sep="\t")
+    count_clusters(data, data / "clust_numeric.tsv", tmp_path / "hash.tsv")
+    count_clusters(
+        data,
+        tmp_path / "clust_sorted.tsv",
+        tmp_path / "merge.tsv",
+        "--merge_join", "assert",
+    )
+    assert read_tsv(tmp_path / "hash.tsv").index.is_monotonic_increasing
+    assert_same_file(tmp_path / "hash.tsv", tmp_path / "merge.tsv")
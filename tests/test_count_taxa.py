@@ -0,0 +1,103 @@
+import pandas as pd
+import pytest
+from clean_asv_data.consensus_taxonomy import main_cli as consensus_cli
+from clean_asv_data.count_taxa import main_cli as count_taxa_cli
+from conftest import CHUNKSIZE, assert_same_file, read_tsv, run
+
+RANKS = ["Kingdom", "Phylum", "Class", "Order", "Family", "Genus", "Species", "BOLD_bin"]
+
+
+def expected_counts(data, lineages):
+    """
+    Sums the counts of non-blank samples by each rank of <lineages> in memory
+    """
+    counts = read_tsv(data / "counts.tsv")
+    meta = read_tsv(data / "meta.tsv")
+    blanks = meta.index[meta["lab_sample_type"] == "extraction_neg"]
+    counts = counts.drop(blanks, axis=1).join(lineages, how="inner")
+    samples = [c for c in counts.columns if c not in RANKS]
+    return {
+        rank: counts.groupby(RANKS[: i + 1])[samples].sum()
+        for i, rank in enumerate(RANKS)
+    }
+
+
+def read_taxa_counts(outdir):
+    return {
+        rank: pd.read_csv(
+            outdir / f"{rank}.tsv", sep="\t", index_col=list(range(i + 1))
+        )
+        for i, rank in enumerate(RANKS)
+    }
+
+
+def count_taxa(data, outdir, *args, clustfile="clust.tsv"):
+    run(
+        count_taxa_cli,
+        "--countsfile", data / "counts.tsv",
+        "--clustfile", data / clustfile,
+        "--metadata", data / "meta.tsv",
+        "--chunksize", CHUNKSIZE,
+        "--outdir", outdir,
+        *args,
+    )
+    return read_taxa_counts(outdir)
+
+
+def test_asv_taxonomy(data, tmp_path):
+    result = count_taxa(data, tmp_path)
+    expected = expected_counts(data, read_tsv(data / "clust.tsv")[RANKS])
+    for rank in RANKS:
+        assert result[rank].equals(expected[rank]), rank
+
+
+@pytest.mark.parametrize("clustfile", ["clust.tsv", "clust_numeric.tsv"])
+def test_cluster_taxonomy(data, tmp_path, clustfile):
+    run(
+        consensus_cli,
+        "--countsfile", data / "counts.tsv",
+        "--clustfile", data / clustfile,
+        "--metadata", data / "meta.tsv",
+        "--consensus_threshold", 70,
+        "--output", tmp_path / "taxonomy.tsv",
+    )
+    result = count_taxa(
+        data,
+        tmp_path / "taxa",
+        "--taxonomy", tmp_path / "taxonomy.tsv",
+        clustfile=clustfile,
+    )
+    clustdf = read_tsv(data / clustfile)
+    taxonomy = read_tsv(tmp_path / "taxonomy.tsv")
+    lineages = clustdf[["cluster"]].join(taxonomy[RANKS], on="cluster")[RANKS]
+    expected = expected_counts(data, lineages.fillna("unclassified"))
+    for rank in RANKS:
+        assert result[rank].equals(expected[rank]), rank
+
+
+@pytest.mark.parametrize("n", [1, 3])
+def test_shards(data, tmp_path, n):
+    count_taxa(data, tmp_path / "single")
+    partials = []
+    for k in range(1, n + 1):
+        partials.append(tmp_path / f"{k}.npz")
+        run(
+            count_taxa_cli,
+            "--countsfile", data / "counts.tsv",
+            "--clustfile", data / "clust.tsv",
+            "--metadata", data / "meta.tsv",
+            "--chunksize", CHUNKSIZE,
+            "--shard", f"{k}/{n}",
+            "--write_partial", partials[-1],
+        )
+    run(
+        count_taxa_cli,
+        "--clustfile", data / "clust.tsv",
+        "--metadata", data / "meta.tsv",
+        "--from_partials", *partials,
+        "--outdir", tmp_path / "partials",
+    )
+    for rank in RANKS:
+        assert_same_file(
+            tmp_path / "single" / f"{rank}.tsv", tmp_path / "partials" / f"{rank}.tsv"
+        )
@@ -0,0 +1,99 @@
+import os
+import pytest
+from clean_asv_data.clean_asv_data import main_cli as clean_cli
+from clean_asv_data.consensus_taxonomy import main_cli as consensus_cli
+from clean_asv_data.count_clusters import main_cli as count_clusters_cli
+from clean_asv_data.count_taxa import main_cli as count_taxa_cli
+from clean_asv_data.stats import main_cli as stats_cli
+from conftest import CHUNKSIZE, assert_same_file, run
+
+
+def compare(data, tmp_path, main_cli, *args, output="--output", name="out.tsv"):
+    """
+    Runs a tool on the countsfiles of d1 and d2 and on the joined countsfile,
+    and checks that all output files are the same
+    """
+    for countsfiles, out in [
+        (["counts_joined.tsv"], "single"),
+        (["counts_d1.tsv", "counts_d2.tsv"], "several"),
+        (["counts_d*.tsv"], "glob"),
+    ]:
+        os.mkdir(tmp_path / out)
+        run(
+            main_cli,
+            "--countsfile", *[data / f for f in countsfiles],
+            "--metadata", data / "meta.tsv",
+            "--chunksize", CHUNKSIZE,
+            output, tmp_path / out / name if name else tmp_path / out,
+            *args,
+        )
+    files = sorted(os.listdir(tmp_path / "single"))
+    assert len(files) > 0
+    for out in ["several", "glob"]:
+        assert sorted(os.listdir(tmp_path / out)) == files
+        for f in files:
+            assert_same_file(tmp_path / "single" / f, tmp_path / out / f)
+    return [tmp_path / "single" / f for f in files]
+
+
+def test_clean(data, tmp_path):
+    outputs = compare(
+        data,
+        tmp_path,
+        clean_cli,
+        "--clustfile", data / "clust.tsv",
+        name="cleaned.tsv",
+    )
+    assert [f.name for f in outputs] == ["d1.cleaned.tsv", "d2.cleaned.tsv"]
+
+
+@pytest.mark.parametrize("args", [[], ["--top", 30], ["--subset_val", "d2"]])
+def test_stats(data, tmp_path, args):
+    compare(data, tmp_path, stats_cli, *args)
+
+
+@pytest.mark.parametrize("subset", [[], ["--subset_val", "d1"]])
+def test_count_clusters(data, tmp_path, subset):
+    compare(
+        data, tmp_path, count_clusters_cli, "--clustfile", data / "clust.tsv", *subset
+    )
+
+
+def test_consensus(data, tmp_path):
+    compare(
+        data,
+        tmp_path,
+        consensus_cli,
+        "--clustfile", data / "clust.tsv",
+        "--consensus_threshold", 70,
+    )
+
+
+def test_count_taxa(data, tmp_path):
+    compare(
+        data,
+        tmp_path,
+        count_taxa_cli,
+        "--clustfile", data / "clust.tsv",
+        output="--outdir",
+        name=None,
+    )
+
+
+def test_unsupported_options(data, tmp_path):
+    with pytest.raises(SystemExit, match="--write_partial can not be used"):
+        run(
+            stats_cli,
+            "--countsfile", data / "counts_d1.tsv", data / "counts_d2.tsv",
+            "--write_partial", tmp_path / "stats.npz",
+        )
+
+
+def test_samples_in_several_countsfiles(data, tmp_path):
+    with pytest.raises(ValueError, match="Sample S000 is present in both"):
+        run(
+            stats_cli,
+            "--countsfile", data / "counts_d1.tsv", data / "counts_joined.tsv",
+            "--output", tmp_path / "stats.tsv",
+        )
+    assert not os.path.exists(tmp_path / "stats.tsv")
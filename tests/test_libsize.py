@@ -0,0 +1,64 @@
+from clean_asv_data.clean_asv_data import main_cli as clean_cli
+from clean_asv_data.libsize import read_library_sizes
+from conftest import CHUNKSIZE, assert_same_file, read_tsv, run
+
+
+def clean(data, output, *args):
+    run(
+        clean_cli,
+        "--countsfile", data / "counts.tsv",
+        "--clustfile", data / "clust.tsv",
+        "--metadata", data / "meta.tsv",
+        "--chunksize", CHUNKSIZE,
+        "--output", output,
+        *args,
+    )
+
+
+def test_min_rel_abundance(data, tmp_path):
+    clean(
+        data,
+        tmp_path / "cleaned.tsv",
+        "--min_rel_abundance", 2,
+        "--library_index", tmp_path / "lib.tsv",
+        "--counts_output", "counts.tsv",
+    )
+    counts = read_tsv(data / "counts.tsv")
+    counts.index.name = "ASV"
+    library_sizes = read_library_sizes(tmp_path / "lib.tsv", data / "counts.tsv")
+    assert library_sizes["reads"].equals(counts.sum().rename("reads"))
+    filtered = counts.where(counts.div(counts.sum(), axis=1) * 100 >= 2, 0)
+    meta = read_tsv(data / "meta.tsv")
+    for dataset in ["d1", "d2"]:
+        cleaned = read_tsv(tmp_path / f"{dataset}.cleaned.tsv")
+        samples = meta.index[meta["dataset"] == dataset]
+        expected = filtered.loc[filtered.index.isin(cleaned.index), samples]
+        assert read_tsv(tmp_path / f"{dataset}.counts.tsv").equals(expected)
+
+
+def test_partial_index_not_used(data, tmp_path, capfd):
+    """
+    Library sizes saved by a scan of part of the rows are recalculated
+    """
+    index = ["--library_index", tmp_path / "lib.tsv"]
+    clean(
+        data,
+        tmp_path / "unused.tsv",
+        "--shard", "1/3",
+        "--write_partial", tmp_path / "1.npz",
+        *index,
+    )
+    assert read_library_sizes(tmp_path / "lib.tsv", data / "counts.tsv") is None
+    assert "only covers part of the rows" in capfd.readouterr().err
+    (tmp_path / "index").mkdir()
+    (tmp_path / "noindex").mkdir()
+    clean(data, tmp_path / "index" / "cleaned.tsv", "--min_rel_abundance", 2, *index)
+    clean(data, tmp_path / "noindex" / "cleaned.tsv", "--min_rel_abundance", 2)
+    for dataset in ["d1", "d2"]:
+        assert_same_file(
+            tmp_path / "index" / f"{dataset}.cleaned.tsv",
+            tmp_path / "noindex" / f"{dataset}.cleaned.tsv",
+        )
+    counts = read_tsv(data / "counts.tsv")
+    library_sizes = read_library_sizes(tmp_path / "lib.tsv", data / "counts.tsv")
+    assert library_sizes["reads"].equals(counts.sum().rename("reads"))
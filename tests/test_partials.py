@@ -0,0 +1,152 @@
+import pytest
+from clean_asv_data.clean_asv_data import main_cli as clean_cli
+from clean_asv_data.consensus_taxonomy import main_cli as consensus_cli
+from clean_asv_data.count_clusters import main_cli as count_clusters_cli
+from clean_asv_data.partials import load_partials
+from clean_asv_data.partials import main_cli as merge_cli
+from clean_asv_data.stats import main_cli as stats_cli
+from conftest import CHUNKSIZE, assert_same_file, read_tsv, run
+
+
+def clean(data, out, *args):
+    out.mkdir(exist_ok=True)
+    run(
+        clean_cli,
+        "--clustfile", data / "clust.tsv",
+        "--metadata", data / "meta.tsv",
+        "--output", out / "cleaned.tsv",
+        *args,
+    )
+
+
+@pytest.mark.parametrize("chunksize", [CHUNKSIZE, 10000])
+def test_clean_column_shards(data, tmp_path, chunksize):
+    """
+    Partials of countsfiles with the samples of one dataset each, and with
+    different rows, give the same result as the joined counts matrix
+    """
+    partials = []
+    for f in ["counts_d1.tsv", "counts_d2.tsv"]:
+        partials.append(tmp_path / f"{f}.npz")
+        run(
+            clean_cli,
+            "--countsfile", data / f,
+            "--clustfile", data / "clust.tsv",
+            "--metadata", data / "meta.tsv",
+            "--chunksize", chunksize,
+            "--write_partial", partials[-1],
+        )
+    clean(data, tmp_path / "joined", "--countsfile", data / "counts_joined.tsv")
+    clean(
+        data,
+        tmp_path / "partials",
+        "--countsfile", data / "counts_joined.tsv",
+        "--from_partials", *partials,
+    )
+    for dataset in ["d1", "d2"]:
+        assert_same_file(
+            tmp_path / "joined" / f"{dataset}.cleaned.tsv",
+            tmp_path / "partials" / f"{dataset}.cleaned.tsv",
+        )
+
+
+def test_clean_column_shard_partials_only_hold_their_datasets(data, tmp_path):
+    run(
+        clean_cli,
+        "--countsfile", data / "counts_d2.tsv",
+        "--clustfile", data / "clust.tsv",
+        "--metadata", data / "meta.tsv",
+        "--chunksize", CHUNKSIZE,
+        "--write_partial", tmp_path / "d2.npz",
+    )
+    counts = load_partials([tmp_path / "d2.npz"], kind="clean")
+    assert list(counts) == ["d2"]
+    assert counts["d2"]["ASV_max"].dtype.kind == "i"
+
+
+def test_clean_row_shards(data, tmp_path):
+    partials = []
+    for k in range(1, 4):
+        partials.append(tmp_path / f"{k}.npz")
+        run(
+            clean_cli,
+            "--countsfile", data / "counts.tsv",
+            "--clustfile", data / "clust.tsv",
+            "--metadata", data / "meta.tsv",
+            "--chunksize", CHUNKSIZE,
+            "--shard", f"{k}/3",
+            "--write_partial", partials[-1],
+        )
+    clean(data, tmp_path / "single", "--countsfile", data / "counts.tsv")
+    clean(
+        data,
+        tmp_path / "partials",
+        "--countsfile", data / "counts.tsv",
+        "--from_partials", *partials,
+    )
+    for dataset in ["d1", "d2"]:
+        single = tmp_path / "single" / f"{dataset}.cleaned.tsv"
+        assert read_tsv(single).shape[0] > 0
+        assert_same_file(single, tmp_path / "partials" / f"{dataset}.cleaned.tsv")
+
+
+def shard_partials(tmp_path, main_cli, args, n=3):
+    partials = []
+    for k in range(1, n + 1):
+        partials.append(tmp_path / f"{k}.npz")
+        run(
+            main_cli,
+            *args,
+            "--chunksize", CHUNKSIZE,
+            "--shard", f"{k}/{n}",
+            "--write_partial", partials[-1],
+        )
+    return partials
+
+
+@pytest.mark.parametrize("subset", [[], ["--subset_val", "d2"]])
+def test_stats_and_count_clusters_row_shards(data, tmp_path, subset):
+    common = ["--countsfile", data / "counts.tsv", "--metadata", data / "meta.tsv"]
+    for name, main_cli, args in [
+        ("stats", stats_cli, common + subset),
+        ("clusters", count_clusters_cli, common + subset + ["--clustfile", data / "clust.tsv"]),
+    ]:
+        d = tmp_path / name
+        d.mkdir()
+        partials = shard_partials(d, main_cli, args)
+        run(main_cli, *args, "--output", d / "single.tsv")
+        run(main_cli, *args, "--from_partials", *partials, "--output", d / "merged.tsv")
+        assert_same_file(d / "single.tsv", d / "merged.tsv")
+
+
+def test_consensus_row_shards(data, tmp_path):
+    args = [
+        "--countsfile", data / "counts.tsv",
+        "--metadata", data / "meta.tsv",
+        "--clustfile", data / "clust.tsv",
+        "--consensus_threshold", 70,
+    ]
+    partials = shard_partials(tmp_path, consensus_cli, args)
+    run(consensus_cli, *args, "--output", tmp_path / "single.tsv")
+    run(
+        consensus_cli,
+        *args,
+        "--from_partials", *partials,
+        "--output", tmp_path / "merged.tsv",
+    )
+    assert_same_file(tmp_path / "single.tsv", tmp_path / "merged.tsv")
+
+
+def test_merge_partials(data, tmp_path):
+    """
+    Merging is associative: partials merged in steps give the same result
+    """
+    args = ["--countsfile", data / "counts.tsv", "--metadata", data / "meta.tsv"]
+    partials = shard_partials(tmp_path, stats_cli, args, n=4)
+    run(merge_cli, *partials[:2], "-o", tmp_path / "a.npz", configfile=None)
+    run(merge_cli, tmp_path / "a.npz", *partials[2:], "-o", tmp_path / "b.npz", configfile=None)
+    run(stats_cli, *args, "--output", tmp_path / "single.tsv")
+    run(stats_cli, "--from_partials", tmp_path / "b.npz", "--output", tmp_path / "merged.tsv")
+    assert_same_file(tmp_path / "single.tsv", tmp_path / "merged.tsv")
+    with pytest.raises(ValueError, match="present in more than one partial"):
+        run(merge_cli, tmp_path / "a.npz", partials[0], "-o", tmp_path / "c.npz", configfile=None)
@@ -0,0 +1,116 @@
+import json
+import shutil
+import pandas as pd
+import pytest
+from clean_asv_data.__main__ import generate_reader
+from clean_asv_data.clean_asv_data import main_cli as clean_cli
+from clean_asv_data.count_clusters import main_cli as count_clusters_cli
+from clean_asv_data.partition import main_cli as partition_cli
+from clean_asv_data.stats import main_cli as stats_cli
+from conftest import CHUNKSIZE, N_ASVS, assert_same_file, read_tsv, run
+
+
+@pytest.fixture(scope="module")
+def partitions(data, tmp_path_factory):
+    outdir = tmp_path_factory.mktemp("partitions")
+    run(
+        partition_cli,
+        "--countsfile", data / "counts.tsv",
+        "--metadata", data / "meta.tsv",
+        "--outdir", outdir,
+        "--chunksize", CHUNKSIZE,
+    )
+    return outdir
+
+
+def test_partitions_store_rows_with_counts(data, partitions):
+    with open(partitions / "manifest.json") as fhin:
+        manifest = json.load(fhin)
+    assert sorted(p.name for p in partitions.iterdir()) == [
+        "asvs.zip",
+        "d1.npz",
+        "d2.npz",
+        "manifest.json",
+    ]
+    assert manifest["n_rows"] == N_ASVS
+    counts = read_tsv(data / "counts.tsv")
+    for dataset, info in manifest["datasets"].items():
+        samples = info["samples"]
+        assert info["n_rows"] == N_ASVS
+        assert info["n_stored_rows"] == counts[samples].gt(0).any(axis=1).sum()
+        # All rows are read, with zeros for the rows that are not stored
+        f = str(partitions / info["file"])
+        df = pd.concat(generate_reader(f, CHUNKSIZE, None))
+        assert df.equals(counts[samples])
+    assert manifest["datasets"]["d2"]["n_stored_rows"] < N_ASVS
+
+
+@pytest.mark.parametrize("countsfile", ["dir", "manifest"])
+def test_clean(data, partitions, tmp_path, countsfile):
+    countsfile = partitions if countsfile == "dir" else partitions / "manifest.json"
+    for out, f in [("single", data / "counts.tsv"), ("partitions", countsfile)]:
+        (tmp_path / out).mkdir()
+        run(
+            clean_cli,
+            "--countsfile", f,
+            "--clustfile", data / "clust.tsv",
+            "--metadata", data / "meta.tsv",
+            "--chunksize", CHUNKSIZE,
+            "--output", tmp_path / out / "cleaned.tsv",
+        )
+    for dataset in ["d1", "d2"]:
+        assert_same_file(
+            tmp_path / "single" / f"{dataset}.cleaned.tsv",
+            tmp_path / "partitions" / f"{dataset}.cleaned.tsv",
+        )
+
+
+@pytest.mark.parametrize("subset", [None, "d1", "d2"])
+def test_stats_and_count_clusters(data, partitions, tmp_path, subset):
+    args = ["--metadata", data / "meta.tsv", "--chunksize", CHUNKSIZE]
+    if subset is not None:
+        args += ["--subset_val", subset]
+    for out, f in [("single", data / "counts.tsv"), ("partitions", partitions)]:
+        run(
+            stats_cli,
+            "--countsfile", f,
+            "--output", tmp_path / f"{out}.stats.tsv",
+            *args,
+        )
+        run(
+            count_clusters_cli,
+            "--countsfile", f,
+            "--clustfile", data / "clust.tsv",
+            "--output", tmp_path / f"{out}.clusters.tsv",
+            *args,
+        )
+    # ASVs without reads in the subset are kept, like in the countsfile
+    assert read_tsv(tmp_path / "partitions.stats.tsv").shape[0] == N_ASVS
+    for name in ["stats", "clusters"]:
+        assert_same_file(
+            tmp_path / f"single.{name}.tsv", tmp_path / f"partitions.{name}.tsv"
+        )
+
+
+def test_subset_selects_partitions_from_manifest(data, partitions, tmp_path):
+    """
+    Partitions without samples of the subset are not opened
+    """
+    outdir = tmp_path / "partitions"
+    shutil.copytree(partitions, outdir)
+    (outdir / "d1.npz").write_text("not a partition")
+    run(
+        stats_cli,
+        "--countsfile", outdir,
+        "--metadata", data / "meta.tsv",
+        "--subset_val", "d2",
+        "--output", tmp_path / "stats.tsv",
+    )
+    run(
+        stats_cli,
+        "--countsfile", data / "counts.tsv",
+        "--metadata", data / "meta.tsv",
+        "--subset_val", "d2",
+        "--output", tmp_path / "single.stats.tsv",
+    )
+    assert_same_file(tmp_path / "single.stats.tsv", tmp_path / "stats.tsv")
@@ -0,0 +1,61 @@
+import pytest
+from clean_asv_data.__main__ import PrefetchReader, generate_reader
+from clean_asv_data.clean_asv_data import main_cli as clean_cli
+from clean_asv_data.stats import main_cli as stats_cli
+from conftest import CHUNKSIZE, assert_same_file, run
+
+
+@pytest.mark.parametrize("shard", [None, "2/3"])
+def test_same_chunks(data, shard):
+    countsfile = str(data / "counts.tsv")
+    expected = list(generate_reader(countsfile, CHUNKSIZE, None, shard=shard))
+    reader = generate_reader(countsfile, CHUNKSIZE, None, shard=shard, prefetch=2)
+    assert isinstance(reader, PrefetchReader)
+    chunks = list(reader)
+    assert len(chunks) == len(expected) == reader.n_chunks
+    for df, expected_df in zip(chunks, expected):
+        assert df.equals(expected_df)
+
+
+def test_error_in_reader():
+    def failing_reader():
+        yield 1
+        raise ValueError("bad chunk")
+
+    reader = PrefetchReader(failing_reader(), depth=2)
+    read = []
+    with pytest.raises(ValueError, match="bad chunk"):
+        for chunk in reader:
+            read.append(chunk)
+    assert read == [1]
+
+
+def test_stop_early():
+    reader = PrefetchReader(iter(range(100)), depth=2)
+    for i in reader:
+        if i == 3:
+            break
+    reader._thread.join(timeout=5)
+    assert not reader._thread.is_alive()
+
+
+@pytest.mark.parametrize(
+    "main_cli, args, output",
+    [
+        (stats_cli, [], "stats.tsv"),
+        (clean_cli, ["--clustfile", "clust.tsv"], "cleaned.tsv"),
+    ],
+)
+def test_same_output(data, tmp_path, main_cli, args, output):
+    args = [
+        "--countsfile", data / "counts.tsv",
+        "--metadata", data / "meta.tsv",
+        "--chunksize", CHUNKSIZE,
+        *[data / a if str(a).endswith(".tsv") else a for a in args],
+    ]
+    (tmp_path / "single").mkdir()
+    (tmp_path / "prefetch").mkdir()
+    run(main_cli, *args, "--output", tmp_path / "single" / output)
+    run(main_cli, *args, "--prefetch", 2, "--output", tmp_path / "prefetch" / output)
+    for f in (tmp_path / "single").iterdir():
+        assert_same_file(f, tmp_path / "prefetch" / f.name)
@@ -0,0 +1,43 @@
+import json
+import pytest
+from clean_asv_data.preflight import main_cli as preflight_cli
+from conftest import read_tsv, run
+
+
+def preflight(data, clustfile, *args, **kwargs):
+    return run(
+        preflight_cli,
+        "--countsfile", data / "counts.tsv",
+        "--clustfile", clustfile,
+        "--metadata", data / "meta.tsv",
+        *args,
+        **kwargs,
+    )
+
+
+def test_ok(data):
+    report = json.loads(preflight(data, data / "clust.tsv"))
+    assert report["errors"] == []
+
+
+def test_clustfile_without_cluster_column(data, tmp_path):
+    """
+    clean-asv-data reads clusters from the 'cluster' column whatever the
+    clust_column setting of other tools
+    """
+    read_tsv(data / "clust.tsv").rename(columns={"cluster": "otu"}).to_csv(
+        tmp_path / "clust.tsv", sep="\t"
+    )
+    config = tmp_path / "config.yml"
+    config.write_text("clust_column: otu\n")
+    with pytest.raises(SystemExit) as e:
+        preflight(
+            data,
+            tmp_path / "clust.tsv",
+            "--output", tmp_path / "report.json",
+            configfile=config,
+        )
+    assert e.value.code == 1
+    with open(tmp_path / "report.json") as fhin:
+        report = json.load(fhin)
+    assert [e["columns"] for e in report["errors"]] == [["cluster"]]
@@ -0,0 +1,97 @@
+import pytest
+from clean_asv_data.clean_asv_data import main_cli as clean_cli
+from clean_asv_data.presence import main_cli as presence_cli
+from clean_asv_data.stats import main_cli as stats_cli
+from conftest import CHUNKSIZE, read_tsv, run
+
+
+@pytest.fixture(scope="module")
+def index(data, tmp_path_factory):
+    d = tmp_path_factory.mktemp("presence")
+    run(
+        stats_cli,
+        "--countsfile", data / "counts.tsv",
+        "--metadata", data / "meta.tsv",
+        "--chunksize", CHUNKSIZE,
+        "--presence_index", d / "presence.npz",
+        "--output", d / "stats.tsv",
+    )
+    return d
+
+
+def test_subset_occurrence(data, index, tmp_path):
+    out = run(
+        presence_cli,
+        index / "presence.npz",
+        "--countsfile", data / "counts.tsv",
+        "--metadata", data / "meta.tsv",
+        "--subset_val", "d1",
+    )
+    (tmp_path / "occurrence.tsv").write_text(out)
+    run(
+        stats_cli,
+        "--countsfile", data / "counts.tsv",
+        "--metadata", data / "meta.tsv",
+        "--subset_val", "d1",
+        "--output", tmp_path / "stats.tsv",
+    )
+    occurrence = read_tsv(tmp_path / "occurrence.tsv")["occurrence"]
+    stats = read_tsv(tmp_path / "stats.tsv")["occurrence"]
+    assert occurrence.sort_index().equals(stats.sort_index())
+
+
+def test_subset_requires_metadata(index):
+    with pytest.raises(SystemExit, match="ERROR: --subset_val requires --metadata"):
+        run(presence_cli, index / "presence.npz", "--subset_val", "d1")
+
+
+def test_countsfile_only_checked_when_given(data, index, tmp_path):
+    counts = tmp_path / "counts.tsv"
+    counts.write_text((data / "counts.tsv").read_text() + "\n")
+    config = tmp_path / "config.yml"
+    config.write_text(f"countsfile: {counts}\n")
+    # A countsfile set in the configfile is not used to check the index
+    run(presence_cli, index / "presence.npz", configfile=config)
+    with pytest.raises(SystemExit, match="ERROR: .* is out of date"):
+        run(presence_cli, index / "presence.npz", "--countsfile", counts)
+
+
+def test_blank_occurrence(data, index, tmp_path):
+    """
+    Occurrence in blanks equals that computed by clean-asv-data
+    """
+    out = run(presence_cli, index / "presence.npz", "--metadata", data / "meta.tsv")
+    (tmp_path / "occurrence.tsv").write_text(out)
+    occurrence = read_tsv(tmp_path / "occurrence.tsv")
+    run(
+        clean_cli,
+        "--countsfile", data / "counts.tsv",
+        "--clustfile", data / "clust.tsv",
+        "--metadata", data / "meta.tsv",
+        "--max_blank_occurrence", 100,
+        "--output", tmp_path / "cleaned.tsv",
+    )
+    for dataset in ["d1", "d2"]:
+        cleaned = read_tsv(tmp_path / f"{dataset}.cleaned.tsv")
+        expected = occurrence.loc[occurrence["dataset"] == dataset, "in_n_blanks"]
+        assert cleaned.shape[0] > 0
+        assert cleaned["in_n_blanks"].equals(expected.loc[cleaned.index])
+
+
+def test_partial_index(data, tmp_path, capfd):
+    """
+    An index built from a row shard is not taken as the index of the countsfile
+    """
+    run(
+        stats_cli,
+        "--countsfile", data / "counts.tsv",
+        "--chunksize", CHUNKSIZE,
+        "--shard", "1/3",
+        "--write_partial", tmp_path / "1.npz",
+        "--presence_index", tmp_path / "presence.npz",
+    )
+    with pytest.raises(SystemExit, match="only covers part of the rows"):
+        run(presence_cli, tmp_path / "presence.npz", "--countsfile", data / "counts.tsv")
+    capfd.readouterr()
+    run(presence_cli, tmp_path / "presence.npz")
+    assert "only covers part of the countsfile rows" in capfd.readouterr().err
@@ -0,0 +1,50 @@
+import io
+import pandas as pd
+import pytest
+from clean_asv_data.rowindex import main_cli as lookup_cli
+from conftest import read_tsv, run
+
+
+def lookup(countsfile, *args):
+    out = run(lookup_cli, "--countsfile", countsfile, *args)
+    return pd.read_csv(io.StringIO(out), sep="\t", index_col=0, header=0)
+
+
+def test_lookup(data, tmp_path):
+    counts = read_tsv(data / "counts.tsv")
+    asvs = list(counts.index[[399, 0, 17, 200]])
+    index = tmp_path / "counts.rowidx.npz"
+    result = lookup(data / "counts.tsv", "--index", index, "--asv", *asvs, "missing")
+    assert index.exists()
+    assert result.sort_index().equals(counts.loc[asvs].sort_index())
+
+
+@pytest.mark.parametrize(
+    "clustfile, cluster", [("clust.tsv", "cl7"), ("clust_numeric.tsv", "7")]
+)
+def test_lookup_cluster(data, tmp_path, capfd, clustfile, cluster):
+    counts = read_tsv(data / "counts.tsv")
+    clustdf = read_tsv(data / clustfile)
+    members = clustdf.index[clustdf["cluster"].astype(str) == cluster]
+    assert len(members) > 1
+    result = lookup(
+        data / "counts.tsv",
+        "--index", tmp_path / "counts.rowidx.npz",
+        "--cluster", cluster,
+        "--clustfile", data / clustfile,
+    )
+    assert "not found" not in capfd.readouterr().err
+    assert result.sort_index().equals(counts.loc[members].sort_index())
+
+
+def test_rebuild_out_of_date_index(data, tmp_path):
+    countsfile = tmp_path / "counts.tsv"
+    counts = read_tsv(data / "counts.tsv")
+    counts.to_csv(countsfile, sep="\t")
+    asvs = list(counts.index[:3])
+    lookup(countsfile, "--asv", *asvs)
+    # Rows with other lengths move the offsets of the following rows
+    counts.iloc[:2] += 1000
+    counts.to_csv(countsfile, sep="\t")
+    result = lookup(countsfile, "--asv", *asvs)
+    assert result.sort_index().equals(counts.loc[asvs].sort_index())
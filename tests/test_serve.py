@@ -0,0 +1,144 @@
+import http.client
+import json
+import os
+import threading
+import pandas as pd
+import pytest
+from clean_asv_data.__main__ import read_clustfile, read_metadata
+from clean_asv_data.clean_asv_data import main_cli as clean_cli
+from clean_asv_data.consensus_taxonomy import main_cli as consensus_cli
+from clean_asv_data.count_clusters import main_cli as count_clusters_cli
+from clean_asv_data.serve import AsvDataStore, load_counts, make_server
+from clean_asv_data.stats import main_cli as stats_cli
+from conftest import CHUNKSIZE, read_tsv, run
+
+RANKS = ["Kingdom", "Phylum", "Class", "Order", "Family", "Genus", "Species", "BOLD_bin"]
+
+
+@pytest.fixture(scope="module")
+def store(data):
+    metadata = read_metadata(data / "meta.tsv", index_name="sampleID_NGI")
+    blanks = list(metadata.loc[metadata["lab_sample_type"] == "extraction_neg"].index)
+    clustdf = read_clustfile(
+        data / "clust.tsv", columns=["cluster"] + RANKS, categorical=["cluster"] + RANKS
+    )
+    return AsvDataStore(
+        load_counts(data / "counts.tsv", chunksize=CHUNKSIZE),
+        clustdf,
+        metadata=metadata,
+        blanks=blanks,
+        ranks=RANKS,
+    )
+
+
+@pytest.fixture(scope="module")
+def server(store):
+    server = make_server(store, port=0, quiet=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get(server, path):
+    conn = http.client.HTTPConnection(*server.server_address)
+    try:
+        conn.request("GET", path)
+        response = conn.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        conn.close()
+
+
+def get_table(server, path, index):
+    status, records = get(server, path)
+    assert status == 200
+    return pd.DataFrame.from_records(records).set_index(index)
+
+
+def cli_args(data, tmp_path):
+    return [
+        "--countsfile", data / "counts.tsv",
+        "--metadata", data / "meta.tsv",
+        "--chunksize", CHUNKSIZE,
+        "--output", tmp_path / "out.tsv",
+    ]
+
+
+def test_stats(data, tmp_path, server):
+    run(stats_cli, *cli_args(data, tmp_path))
+    expected = read_tsv(tmp_path / "out.tsv")
+    result = get_table(server, "/stats", "ASV")
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+    top = get_table(server, "/stats?top=5&top_by=occurrence", "ASV")
+    pd.testing.assert_frame_equal(
+        top, expected.nlargest(5, "occurrence"), check_dtype=False
+    )
+
+
+def test_cluster_counts(data, tmp_path, server):
+    run(
+        count_clusters_cli,
+        *cli_args(data, tmp_path),
+        "--clustfile", data / "clust.tsv",
+    )
+    expected = read_tsv(tmp_path / "out.tsv")
+    result = get_table(server, "/cluster_counts", "cluster")
+    pd.testing.assert_frame_equal(result.sort_index(), expected, check_dtype=False)
+    result = get_table(server, "/cluster_counts?cluster=cl7,cl3", "cluster")
+    pd.testing.assert_frame_equal(
+        result, expected.loc[["cl7", "cl3"]], check_dtype=False
+    )
+    assert get(server, "/cluster_counts?cluster=nope")[0] == 404
+
+
+def test_consensus(data, tmp_path, server):
+    run(
+        consensus_cli,
+        *cli_args(data, tmp_path),
+        "--clustfile", data / "clust.tsv",
+        "--consensus_threshold", 70,
+    )
+    expected = read_tsv(tmp_path / "out.tsv")
+    result = get_table(server, "/consensus?threshold=70", "cluster")
+    assert (result["threshold"] == 70).all()
+    pd.testing.assert_frame_equal(
+        result.loc[:, expected.columns].sort_index(), expected
+    )
+
+
+@pytest.mark.parametrize("mode", ["asv", "cluster_occurrence"])
+def test_clean(data, tmp_path, server, mode):
+    run(
+        clean_cli,
+        *cli_args(data, tmp_path),
+        "--clustfile", data / "clust.tsv",
+        "--blank_removal_mode", mode,
+    )
+    status, result = get(server, f"/clean?asvs=1&blank_removal_mode={mode}")
+    assert status == 200
+    assert sorted(result) == ["d1", "d2"]
+    for dataset, summary in result.items():
+        cleaned = read_tsv(tmp_path / f"{dataset}.out.tsv")
+        assert sorted(summary["asvs"]) == sorted(cleaned.index)
+        assert summary["n_asvs"] == cleaned.shape[0]
+        assert summary["n_clusters"] == cleaned["cluster"].nunique()
+        assert summary["reads"] == cleaned["ASV_sum"].sum()
+
+
+def test_socket_not_replacing_file(store, tmp_path):
+    f = tmp_path / "server.sock"
+    f.write_text("not a socket")
+    with pytest.raises(SystemExit, match="ERROR: .* is not a socket"):
+        make_server(store, socket=str(f))
+    assert f.read_text() == "not a socket"
+
+
+def test_socket_replaced(store, tmp_path):
+    f = str(tmp_path / "server.sock")
+    for _ in range(2):
+        # The socket of the first server is left behind and replaced
+        server = make_server(store, socket=f)
+        server.server_close()
+        assert os.path.exists(f)
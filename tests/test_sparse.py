@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+import pytest
+from clean_asv_data.clean_asv_data import main_cli as clean_cli
+from clean_asv_data.count_clusters import main_cli as count_clusters_cli
+from conftest import CHUNKSIZE, read_tsv, run
+
+
+def read_mtx(f):
+    rows = pd.read_csv(f"{f}.rows.txt", header=None)[0].astype(str)
+    cols = pd.read_csv(f"{f}.cols.txt", header=None)[0].astype(str)
+    with open(f) as fhin:
+        assert fhin.readline().startswith("%%MatrixMarket matrix coordinate")
+        n_rows, n_cols, nnz = map(int, fhin.readline().split())
+        entries = pd.read_csv(fhin, sep=" ", header=None, names=["row", "col", "value"])
+    assert (n_rows, n_cols, nnz) == (len(rows), len(cols), entries.shape[0])
+    values = np.zeros((n_rows, n_cols), dtype=entries["value"].dtype)
+    values[entries["row"] - 1, entries["col"] - 1] = entries["value"]
+    return pd.DataFrame(values, index=rows, columns=cols)
+
+
+def read_parquet(f):
+    df = pd.read_parquet(f)
+    return df.pivot_table(
+        index=df.columns[0], columns="sample", values="value", observed=True
+    )
+
+
+def read_biom(f):
+    import h5py
+
+    def read_matrix(h5, axis, shape):
+        indptr = h5[f"{axis}/matrix/indptr"][:]
+        values = np.zeros(shape)
+        rows = np.repeat(np.arange(shape[0]), np.diff(indptr))
+        values[rows, h5[f"{axis}/matrix/indices"][:]] = h5[f"{axis}/matrix/data"][:]
+        return values
+
+    with h5py.File(f, "r") as h5:
+        obs = h5["observation/ids"].asstr()[:]
+        samples = h5["sample/ids"].asstr()[:]
+        assert list(h5.attrs["shape"]) == [len(obs), len(samples)]
+        values = read_matrix(h5, "observation", (len(obs), len(samples)))
+        # The sample-major matrix is the same matrix transposed
+        assert np.array_equal(
+            values, read_matrix(h5, "sample", (len(samples), len(obs))).T
+        )
+    return pd.DataFrame(values, index=obs, columns=samples)
+
+
+READERS = {"mtx": read_mtx, "parquet": read_parquet, "biom": read_biom}
+# Optional dependencies of the formats
+REQUIRES = {"parquet": "pyarrow", "biom": "h5py"}
+
+
+def assert_same_counts(dense, sparse):
+    """
+    Compares a dense table with a sparse one read back, in which rows or
+    columns without non-zeros may be missing
+    """
+    dense = dense.set_axis(dense.index.astype(str), axis=0)
+    sparse = sparse.reindex(index=dense.index, columns=dense.columns, fill_value=0)
+    assert np.array_equal(dense.to_numpy(), sparse.fillna(0).to_numpy())
+
+
+@pytest.mark.parametrize("fmt", READERS)
+def test_count_clusters(data, tmp_path, fmt):
+    if fmt in REQUIRES:
+        pytest.importorskip(REQUIRES[fmt])
+    args = [
+        "--countsfile", data / "counts.tsv",
+        "--clustfile", data / "clust.tsv",
+        "--metadata", data / "meta.tsv",
+        "--chunksize", CHUNKSIZE,
+    ]
+    run(count_clusters_cli, *args, "--output", tmp_path / "counts.tsv")
+    run(
+        count_clusters_cli,
+        *args,
+        "--output_format", fmt,
+        "--output", tmp_path / f"counts.{fmt}",
+    )
+    assert_same_counts(
+        read_tsv(tmp_path / "counts.tsv"), READERS[fmt](tmp_path / f"counts.{fmt}")
+    )
+
+
+@pytest.mark.parametrize("fmt", READERS)
+def test_clean_counts_output(data, tmp_path, fmt):
+    if fmt in REQUIRES:
+        pytest.importorskip(REQUIRES[fmt])
+    for counts_format in ["tsv", fmt]:
+        run(
+            clean_cli,
+            "--countsfile", data / "counts.tsv",
+            "--clustfile", data / "clust.tsv",
+            "--metadata", data / "meta.tsv",
+            "--chunksize", CHUNKSIZE,
+            "--output", tmp_path / "cleaned.tsv",
+            "--counts_output", f"counts.{counts_format}",
+            "--counts_format", counts_format,
+        )
+    for dataset in ["d1", "d2"]:
+        assert_same_counts(
+            read_tsv(tmp_path / f"{dataset}.counts.tsv"),
+            READERS[fmt](tmp_path / f"{dataset}.counts.{fmt}"),
+        )
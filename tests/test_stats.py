@@ -0,0 +1,36 @@
+import pytest
+from clean_asv_data.stats import main_cli as stats_cli
+from conftest import CHUNKSIZE, assert_same_file, read_tsv, run
+
+
+@pytest.mark.parametrize("top_by", ["reads", "occurrence"])
+def test_top_from_column_shard_partials(data, tmp_path, top_by):
+    """
+    ASVs are ranked on the merged aggregates, not on those of each shard
+    """
+    args = ["--metadata", data / "meta.tsv", "--top", 20, "--top_by", top_by]
+    partials = []
+    for f in ["counts_d1.tsv", "counts_d2.tsv"]:
+        partials.append(tmp_path / f"{f}.npz")
+        run(
+            stats_cli,
+            "--countsfile", data / f,
+            "--chunksize", CHUNKSIZE,
+            "--write_partial", partials[-1],
+            *args,
+        )
+    run(
+        stats_cli,
+        "--countsfile", data / "counts_joined.tsv",
+        "--chunksize", CHUNKSIZE,
+        "--output", tmp_path / "single.tsv",
+        *args,
+    )
+    run(
+        stats_cli,
+        "--from_partials", *partials,
+        "--output", tmp_path / "partials.tsv",
+        *args,
+    )
+    assert read_tsv(tmp_path / "single.tsv").shape[0] == 20
+    assert_same_file(tmp_path / "single.tsv", tmp_path / "partials.tsv")
@@ -0,0 +1,150 @@
+import os
+import pytest
+from clean_asv_data.__main__ import generate_reader, shared_scan
+from clean_asv_data.clean_asv_data import main_cli as clean_cli
+from clean_asv_data.consensus_taxonomy import main_cli as consensus_cli
+from clean_asv_data.count_clusters import main_cli as count_clusters_cli
+from clean_asv_data.stats import main_cli as stats_cli
+from clean_asv_data.workflow import main_cli as workflow_cli
+from conftest import CHUNKSIZE, assert_same_file, read_tsv, run
+
+OUTPUTS = [
+    "d1.cleaned.tsv",
+    "d2.cleaned.tsv",
+    "asv_stats.tsv",
+    "cluster_taxonomy.tsv",
+    "d1.cluster_counts.tsv",
+    "d2.cluster_counts.tsv",
+]
+
+
+def write_config(data, f, **params):
+    params = {
+        "countsfile": data / "counts.tsv",
+        "clustfile": data / "clust.tsv",
+        "metadata": data / "meta.tsv",
+        "chunksize": CHUNKSIZE,
+        "consensus_threshold": 70,
+        **params,
+    }
+    f.write_text("".join(f"{key}: {val}\n" for key, val in params.items()))
+    return f
+
+
+def workflow(config, outdir, capfd):
+    run(workflow_cli, "--outdir", outdir, configfile=config)
+    status = {}
+    for line in capfd.readouterr().err.splitlines():
+        step, _, state = line.partition("\t")
+        if state in ["done", "skipped"]:
+            status[step] = state
+    return status
+
+
+def test_same_output_as_single_tools(data, tmp_path, capfd):
+    config = write_config(data, tmp_path / "config.yml")
+    status = workflow(config, tmp_path / "wf", capfd)
+    assert set(status.values()) == {"done"}
+    assert "scan" in status
+    common = ["--countsfile", data / "counts.tsv", "--metadata", data / "meta.tsv"]
+    out = tmp_path / "single"
+    out.mkdir()
+    run(
+        clean_cli,
+        *common,
+        "--clustfile", data / "clust.tsv",
+        "--output", out / "cleaned.tsv",
+    )
+    run(stats_cli, *common, "--output", out / "asv_stats.tsv")
+    run(
+        consensus_cli,
+        *common,
+        "--clustfile", out / "d1.cleaned.tsv", out / "d2.cleaned.tsv",
+        "--consensus_threshold", 70,
+        "--output", out / "cluster_taxonomy.tsv",
+    )
+    for ds in ["d1", "d2"]:
+        run(
+            count_clusters_cli,
+            *common,
+            "--clustfile", out / f"{ds}.cleaned.tsv",
+            "--subset_val", ds,
+            "--output", out / f"{ds}.cluster_counts.tsv",
+        )
+    for f in OUTPUTS:
+        assert_same_file(out / f, tmp_path / "wf" / f)
+
+
+def test_reruns(data, tmp_path, capfd):
+    """
+    Steps are only rerun when their inputs, parameters or dependencies change
+    """
+    clustfile = tmp_path / "clust.tsv"
+    config = write_config(data, tmp_path / "config.yml", clustfile=clustfile)
+    clustfile.write_text((data / "clust.tsv").read_text())
+    outdir = tmp_path / "wf"
+    steps = ["scan", "clean", "stats", "consensus", "count:d1", "count:d2"]
+    assert workflow(config, outdir, capfd) == {step: "done" for step in steps}
+    assert workflow(config, outdir, capfd) == {step: "skipped" for step in steps}
+    # A newer clustfile reruns the steps using it, but not the scan
+    mtime = max(os.path.getmtime(f) for f in outdir.rglob("*")) + 0.001
+    os.utime(clustfile, (mtime, mtime))
+    assert workflow(config, outdir, capfd) == {
+        "scan": "skipped",
+        "clean": "done",
+        "stats": "skipped",
+        "consensus": "done",
+        "count:d1": "done",
+        "count:d2": "done",
+    }
+    # Parameters only rerun the steps using them
+    write_config(data, config, clustfile=clustfile, top=10)
+    status = workflow(config, outdir, capfd)
+    assert {step for step, state in status.items() if state == "done"} == {
+        "stats",
+        "count:d1",
+        "count:d2",
+    }
+    assert read_tsv(outdir / "asv_stats.tsv").shape[0] == 10
+    # Missing partials rerun the scan and all steps reading them
+    os.remove(outdir / ".workflow" / "scan" / "stats.npz")
+    assert workflow(config, outdir, capfd) == {step: "done" for step in steps}
+
+
+def test_shared_scan(data):
+    countsfile = str(data / "counts.tsv")
+    expected = [df.sum().sum() for df in generate_reader(countsfile, CHUNKSIZE, None)]
+
+    def consume():
+        return [df.sum().sum() for df in generate_reader(countsfile, CHUNKSIZE, None)]
+
+    def consume_twice():
+        # A second read is not shared
+        return consume() + consume()
+
+    def no_read():
+        return "done"
+
+    with shared_scan(countsfile, chunksize=CHUNKSIZE) as scan:
+        results = scan.run([consume, consume, consume_twice, no_read])
+    assert results == [expected, expected, expected * 2, "done"]
+    assert scan.n_chunks == len(expected)
+
+
+def test_shared_scan_error(data):
+    countsfile = str(data / "counts.tsv")
+    read = []
+
+    def consume():
+        for df in generate_reader(countsfile, CHUNKSIZE, None):
+            read.append(df.shape[0])
+
+    def fail():
+        for df in generate_reader(countsfile, CHUNKSIZE, None):
+            raise ValueError("failed")
+
+    with shared_scan(countsfile, chunksize=CHUNKSIZE) as scan:
+        with pytest.raises(ValueError, match="failed"):
+            scan.run([fail, consume])
+    # Other consumers read to the end
+    assert sum(read) == read_tsv(countsfile).shape[0]